@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -40,6 +41,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'portfolio.middleware.PerformanceMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -50,6 +52,10 @@ MIDDLEWARE_CLASSES = (
     'portfolio.middleware.StockExceptionMiddleware',
 )
 
+# sessions and messages live in signed cookies, no DB round-trip per request
+SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies'
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
 ROOT_URLCONF = 'benzinga.urls'
 
 WSGI_APPLICATION = 'benzinga.wsgi.application'
@@ -82,6 +88,139 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 from decimal import Decimal
 INIT_CACHE = Decimal('100000.00')
 
+# default lot policy of new accounts, see portfolio/lots.py
+# F: first in first out, L: last in first out, H: highest cost first
+DEFAULT_LOT_POLICY = 'H'
+
+# quotes, accounts and hot symbols are shared between web workers and
+# the refresh_quotes and process_orders workers through this cache, file based
+# works for one host, on Heroku every dyno is a host and memcached is used instead
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'benzinga-cache')),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
+# Benzinga API client, see portfolio/utils.py
+BENZINGA_API_URL = os.environ.get('BENZINGA_API_URL', 'http://data.benzinga.com/stock/')
+# connections kept alive per worker process
+BENZINGA_POOL_SIZE = 10
+# seconds
+BENZINGA_CONNECT_TIMEOUT = 1.0
+BENZINGA_READ_TIMEOUT = 3.0
+BENZINGA_RETRIES = 2
+# seconds, base of the jittered exponential backoff
+BENZINGA_RETRY_BACKOFF = 0.1
+# retries allowed per request on average
+BENZINGA_RETRY_BUDGET = 0.2
+# threads per worker process used by lookup_many
+BENZINGA_CONCURRENCY = 10
+# seconds, lookup_many returns partial results after it
+BENZINGA_BATCH_DEADLINE = 5.0
+# circuit breaker, opens when this share of the last BENZINGA_BREAKER_WINDOW calls
+# failed or took more than BENZINGA_BREAKER_SLOW_CALL seconds
+BENZINGA_BREAKER_WINDOW = 20
+BENZINGA_BREAKER_MIN_CALLS = 5
+BENZINGA_BREAKER_FAILURE_RATE = 0.5
+BENZINGA_BREAKER_SLOW_CALL = 2.0
+# seconds open before one probe call is let through
+BENZINGA_BREAKER_RESET_TIMEOUT = 10.0
+
+# Symbol master, see portfolio/symbols.py
+# once symbols are loaded by load_symbols, unknown symbols are rejected
+# without calling Benzinga
+SYMBOL_MASTER_ONLY = True
+# seconds before a worker reloads its symbol index
+SYMBOL_INDEX_TTL = 300
+
+# Account cache used by login_required, see portfolio/cache.py
+ACCOUNT_CACHE_ALIAS = 'default'
+# seconds in per-process cache, other workers may show a stale balance this long
+ACCOUNT_CACHE_LOCAL_TTL = 1
+# seconds in shared cache
+ACCOUNT_CACHE_TIMEOUT = 300
+
+# Leaderboard, see portfolio/leaderboard.py
+LEADERBOARD_SIZE = 20
+# seconds, mark prices of the last build are used to move accounts on trades
+LEADERBOARD_MARKS_TIMEOUT = 3600
+
+# Ledger snapshots, see portfolio/ledger.py
+# orders an account makes before snapshot_ledger takes a new snapshot
+LEDGER_SNAPSHOT_EVERY = 500
+
+# Order queue, see portfolio/orderqueue.py
+# buy and sell only queue orders, the process_orders worker executes them
+ASYNC_ORDERS = 'ASYNC_ORDERS' in os.environ
+# worker threads of process_orders
+ORDER_QUEUE_WORKERS = 2
+# orders claimed and executed in one transaction
+ORDER_QUEUE_BATCH_SIZE = 50
+# seconds an idle worker waits before looking for orders again
+ORDER_QUEUE_POLL_INTERVAL = 0.2
+# seconds before orders claimed by a dead worker are pending again
+ORDER_QUEUE_CLAIM_TIMEOUT = 60
+
+# Order archive, see portfolio/archive.py
+# archive_orders moves orders older than this many days out of the Order table
+ORDER_RETENTION_DAYS = 90
+# orders moved and deleted per transaction, also the chunk size of deletes on reset
+ORDER_ARCHIVE_BATCH_SIZE = 1000
+# the only copy of archived orders, must be durable storage shared with the web processes,
+# archive_orders refuses to run without it; not set on Heroku, whose filesystem is per dyno
+# and wiped on every restart
+ORDER_ARCHIVE_DIR = os.environ.get('ORDER_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive'))
+
+# Quote history, see portfolio/ticks.py
+# one file per symbol, empty to not record; Heroku's filesystem is wiped on every restart
+TICK_STORE_DIR = os.environ.get('TICK_STORE_DIR', os.path.join(BASE_DIR, 'ticks'))
+
+# Live quotes over Server-Sent Events, see portfolio/stream.py
+# streamed quotes are fetched by the refresh_quotes worker and read from the quote cache
+# seconds between polls of the shared poller, and of clients without a stream
+QUOTE_STREAM_INTERVAL = 2
+# streams per process, each holds one of gunicorn's --threads until it ends,
+# clients over it fall back to polling
+QUOTE_STREAM_MAX_CONNECTIONS = 2
+# seconds between keepalive comments
+QUOTE_STREAM_HEARTBEAT = 15
+# seconds before a stream is closed, browsers reconnect by themselves
+QUOTE_STREAM_MAX_AGE = 300
+QUOTE_STREAM_MAX_SYMBOLS = 20
+
+# refresh_quotes worker
+# seconds between refreshes of hot symbols, below QUOTE_CACHE_TTL so they never expire
+QUOTE_REFRESH_INTERVAL = 1.0
+QUOTE_REFRESH_BATCH_SIZE = 50
+# seconds a searched symbol stays hot
+QUOTE_REFRESH_HOT_AGE = 600
+# seconds between full reloads of limit order books, new orders are synced every refresh
+LIMIT_ORDER_RELOAD_INTERVAL = 60
+
+# Quote cache, see portfolio/cache.py
+# tiers are checked in order, faster ones first
+QUOTE_CACHE_BACKENDS = (
+    'portfolio.cache.LRUBackend',
+    'portfolio.cache.DjangoCacheBackend',
+)
+QUOTE_CACHE_SIZE = 1024
+QUOTE_CACHE_ALIAS = 'default'
+# seconds, for prices and sizes
+QUOTE_CACHE_TTL = 2
+# seconds, fields which barely change
+QUOTE_CACHE_FIELD_TTL = {
+    'name': 24 * 3600,
+    'industry': 24 * 3600,
+    'exchange': 24 * 3600,
+    'sector': 24 * 3600,
+    'symbol': 24 * 3600,
+}
+# seconds, how old a quote may be shown when Benzinga is unavailable,
+# stale quotes are never used to trade
+QUOTE_CACHE_STALE_TTL = 600
+
 ON_HEROKU = 'ON_HEROKU' in os.environ
 if ON_HEROKU:
     DEBUG = False
@@ -95,6 +234,22 @@ if ON_HEROKU:
     # Allow all host headers
     ALLOWED_HOSTS = ['*']
 
+    # web, worker and orders dynos share the cache through the MemCachier addon
+    from django.core.exceptions import ImproperlyConfigured
+    if 'MEMCACHIER_SERVERS' not in os.environ:
+        raise ImproperlyConfigured('The MemCachier addon is required, dynos cannot share a file based cache')
+    CACHES['default'] = {
+        'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+        'LOCATION': os.environ['MEMCACHIER_SERVERS'].replace(',', ';'),
+        'BINARY': True,
+        'USERNAME': os.environ.get('MEMCACHIER_USERNAME'),
+        'PASSWORD': os.environ.get('MEMCACHIER_PASSWORD'),
+        'OPTIONS': {'tcp_nodelay': True, 'no_block': True},
+    }
+
+    # only a mounted durable volume may hold the order archive
+    ORDER_ARCHIVE_DIR = os.environ.get('ORDER_ARCHIVE_DIR')
+
 # Static asset configuration
 STATIC_ROOT = 'staticfiles'
 STATIC_URL = '/static/'
@@ -0,0 +1,151 @@
+"""
+Portfolio analytics of an account, computed on NumPy arrays
+
+Lots and orders are loaded with one query each into arrays, every figure
+is then a handful of vectorized operations grouped by symbol with
+np.unique/np.bincount, so accounts with thousands of lots take
+milliseconds. Amounts are floats, they are for display only.
+
+Realized P&L comes from the order log and the open lots:
+    realized = sell proceeds - (buy cost - cost of open lots)
+which holds whatever lot policy closed the lots.
+"""
+import numpy as np
+
+from .models import HoldingStock, Order, ArchivedOrderTotal, BUY, SELL
+from .utils import display_lookup, lookup_many
+
+EXPOSURE_FIELDS = ('industry', 'exchange')
+
+
+def load_lots(account):
+    """
+    Returns open lots of account as arrays,
+    symbol, industry, exchange, quantity and price
+    """
+    rows = list(HoldingStock.objects.filter(account=account).values_list(
+        'stock__symbol', 'stock__industry', 'stock__exchange', 'quantity', 'price'))
+    columns = zip(*rows) or [()] * 5
+    return {
+        'symbol': np.array(columns[0], dtype=object),
+        'industry': np.array(columns[1], dtype=object),
+        'exchange': np.array(columns[2], dtype=object),
+        'quantity': np.array(columns[3], dtype=np.float64),
+        'price': np.array(columns[4], dtype=np.float64),
+    }
+
+
+def load_orders(account):
+    """
+    Returns orders of account as arrays, symbol, type, quantity and price
+    Archived orders are added as one buy and one sell of quantity 1 per stock
+    """
+    rows = list(Order.objects.filter(account=account).values_list(
+        'stock__symbol', 'type', 'quantity', 'price'))
+    for symbol, bought, sold in ArchivedOrderTotal.objects.filter(account=account).values_list(
+            'stock__symbol', 'bought', 'sold'):
+        rows.extend([(symbol, BUY, 1, bought), (symbol, SELL, 1, sold)])
+    columns = zip(*rows) or [()] * 4
+    return {
+        'symbol': np.array(columns[0], dtype=object),
+        'type': np.array(columns[1], dtype=object),
+        'quantity': np.array(columns[2], dtype=np.float64),
+        'price': np.array(columns[3], dtype=np.float64),
+    }
+
+
+def _group(keys, *weights):
+    """
+    Returns (unique keys, sums of every weight array per key)
+    """
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, [np.bincount(inverse, weights=w, minlength=len(unique)) for w in weights]
+
+
+def _amount(value):
+    # float noise does not belong in json, prices have 4 decimal places
+    return round(float(value), 4)
+
+
+def analyze(lots, orders, bids):
+    """
+    lots and orders are arrays from load_lots and load_orders,
+    bids is {symbol: bid}, symbols without a bid have no market value
+
+    Returns a dict of positions, totals and exposures
+    """
+    symbols = np.union1d(lots['symbol'], orders['symbol']).astype(object)
+    n = len(symbols)
+
+    # open lots per symbol
+    lot_index = np.searchsorted(symbols, lots['symbol'])
+    quantity = np.bincount(lot_index, weights=lots['quantity'], minlength=n)
+    cost = np.bincount(lot_index, weights=lots['quantity'] * lots['price'], minlength=n)
+
+    # order log per symbol
+    order_index = np.searchsorted(symbols, orders['symbol'])
+    amount = orders['quantity'] * orders['price']
+    bought = np.bincount(order_index, weights=amount * (orders['type'] == BUY), minlength=n)
+    sold = np.bincount(order_index, weights=amount * (orders['type'] == SELL), minlength=n)
+    realized = sold - (bought - cost)
+
+    bid = np.array([bids.get(s, np.nan) for s in symbols], dtype=np.float64)
+    market_value = quantity * bid
+    unrealized = market_value - cost
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_cost = np.where(quantity > 0, cost / quantity, np.nan)
+
+    priced = ~np.isnan(market_value)
+    open_ = quantity > 0
+    total_value = market_value[priced & open_].sum()
+
+    exposure = {}
+    lot_value = lots['quantity'] * bid[lot_index]
+    lot_priced = ~np.isnan(lot_value)
+    for field in EXPOSURE_FIELDS:
+        names, (values,) = _group(lots[field][lot_priced], lot_value[lot_priced])
+        order = np.argsort(-values)
+        exposure[field] = [
+            {'name': names[i], 'market_value': _amount(values[i]),
+             'weight': _amount(values[i] / total_value) if total_value else 0.0}
+            for i in order]
+
+    positions = [
+        {'symbol': symbols[i], 'quantity': int(quantity[i]), 'avg_cost': _amount(avg_cost[i]),
+         'cost': _amount(cost[i]), 'bid': _amount(bid[i]) if priced[i] else None,
+         'market_value': _amount(market_value[i]) if priced[i] else None,
+         'unrealized': _amount(unrealized[i]) if priced[i] else None,
+         'realized': _amount(realized[i])}
+        for i in np.flatnonzero(open_)]
+
+    return {
+        'positions': positions,
+        'cost': _amount(cost.sum()),
+        'market_value': _amount(total_value),
+        'unrealized': _amount(unrealized[priced & open_].sum()),
+        'realized': _amount(realized.sum()),
+        'exposure': exposure,
+        'unpriced': [symbols[i] for i in np.flatnonzero(open_ & ~priced)],
+    }
+
+
+def summarize(account, quotes=None):
+    """
+    Analytics of account against current bids,
+    quotes is {symbol: Quote} if caller has looked them up already
+    """
+    lots = load_lots(account)
+    orders = load_orders(account)
+    if quotes is None:
+        quotes, errors = lookup_many(set(lots['symbol']), fields=('bid',), func=display_lookup)
+
+    bids = {}
+    stale = False
+    for symbol, quote in quotes.items():
+        if quote.bid is not None:
+            bids[symbol.upper()] = float(quote.bid)
+            stale = stale or quote.stale
+
+    summary = analyze(lots, orders, bids)
+    summary['stale'] = stale
+    return summary
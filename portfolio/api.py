@@ -0,0 +1,205 @@
+"""
+JSON API, version 1
+
+GET responses carry ETags, quotes are tagged by the time they were fetched
+and portfolios by the account version. Both are known from quote and
+account caches, so a matching If-None-Match gets 304 before any
+serialization or DB query.
+
+An account version cached by another worker may be
+ACCOUNT_CACHE_LOCAL_TTL seconds old, so may be a 304 right after a trade.
+"""
+import json as jsonlib
+import time
+
+from requests.exceptions import ConnectionError, Timeout
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition, require_GET, require_POST
+
+from .cache import quote_cache
+from .decorators import api_login_required
+from .exceptions import (
+    PriceChangedException, NotEnoughStockInMarket, NotEnoughStockInHands,
+    CannotFindStockException, EmptySymbolException, NotEnoughFundExceptin,
+    NegativeQuantityException, StaleQuoteException)
+from .forms import TradeForm
+from .models import Account, Stock, Position, QueuedOrder, BUY, SELL
+from .orderqueue import enqueue
+from .symbols import check_symbol
+from .ticks import tick_store, INTERVALS
+from .utils import lookup, display_lookup
+
+QUOTE_FIELDS = ('symbol', 'name', 'bid', 'bidsize', 'ask', 'asksize')
+
+# raw ticks in one response, ask for bars for longer ranges
+MAX_TICKS = 10000
+
+TRADE_ERRORS = (
+    PriceChangedException, NotEnoughStockInMarket, NotEnoughStockInHands,
+    CannotFindStockException, EmptySymbolException, NotEnoughFundExceptin,
+    NegativeQuantityException, StaleQuoteException)
+
+
+def _json(content, status=200):
+    return HttpResponse(jsonlib.dumps(content), status=status, content_type='application/json')
+
+
+def _quote_tag(symbol, fetched_at):
+    return 'q-{0}-{1!r}'.format(symbol.upper(), fetched_at)
+
+
+def quote_tag(request, symbol):
+    # only a fresh cached quote can be answered with 304
+    quote = quote_cache.peek(symbol)
+    if quote is None or time.time() - quote.fetched_at >= quote_cache.ttl(QUOTE_FIELDS):
+        return None
+    return _quote_tag(symbol, quote.fetched_at)
+
+
+@require_GET
+@condition(etag_func=quote_tag)
+def quote(request, symbol):
+    try:
+        check_symbol(symbol)
+        quote = display_lookup(symbol, QUOTE_FIELDS)
+        quote.check()
+    except (ConnectionError, Timeout):
+        return _json({'error': 'Cannot connect to Benzinga'}, status=503)
+    except (CannotFindStockException, EmptySymbolException) as e:
+        return _json({'error': str(e)}, status=404)
+
+    content = quote.as_dict(QUOTE_FIELDS)
+    content['fetched_at'] = quote.fetched_at
+    content['stale'] = quote.stale
+
+    response = _json(content)
+    response['ETag'] = quote_etag(_quote_tag(symbol, quote.fetched_at))
+    return response
+
+
+def _timestamp(value):
+    return float(value) if value else None
+
+
+def _rows(array):
+    # nan does not exist in json
+    return [dict((name, None if value != value else value.item()) for name, value in zip(array.dtype.names, row))
+            for row in array]
+
+
+@require_GET
+def ticks(request, symbol):
+    """
+    Quote history of symbol, ?start= and ?end= are unix timestamps,
+    ?interval=1m|5m|1d returns OHLC bars instead of raw ticks, at most
+    MAX_BARS of them, the last MAX_BARS without ?start=
+    """
+    interval = request.GET.get('interval')
+    if interval and interval not in INTERVALS:
+        return _json({'error': 'interval is one of ' + ', '.join(sorted(INTERVALS))}, status=400)
+    try:
+        start = _timestamp(request.GET.get('start'))
+        end = _timestamp(request.GET.get('end'))
+    except ValueError:
+        return _json({'error': 'start and end are unix timestamps'}, status=400)
+
+    symbol = symbol.upper()
+    if interval:
+        try:
+            bars = tick_store.ohlc(symbol, interval, start, end)
+        except ValueError as e:
+            return _json({'error': str(e)}, status=400)
+        return _json({'symbol': symbol, 'interval': interval, 'bars': _rows(bars)})
+    records = tick_store.ticks(symbol, start, end, limit=MAX_TICKS + 1)
+    return _json({'symbol': symbol, 'ticks': _rows(records[:MAX_TICKS]),
+                  'truncated': len(records) > MAX_TICKS})
+
+
+def portfolio_tag(request):
+    return 'a-{0}-{1}'.format(request.account.pk, request.account.version)
+
+
+@api_login_required
+@require_GET
+@condition(etag_func=portfolio_tag)
+def portfolio(request):
+    positions = Position.objects.filter(account=request.account).\
+        select_related('stock').order_by('stock__symbol')
+    return _json({
+        'username': request.account.username,
+        'cash': str(request.account.amount),
+        'version': request.account.version,
+        'positions': [{
+            'symbol': p.stock.symbol,
+            'quantity': p.quantity,
+            'cost': str(p.cost),
+            'avg_price': str(p.avg_price),
+        } for p in positions],
+    })
+
+
+def _trade(request, type):
+    form = TradeForm(request.POST)
+    if not form.is_valid():
+        return _json({'error': 'Invalid order', 'fields': form.errors}, status=400)
+    symbol = form.cleaned_data['symbol'].upper()
+    quantity = form.cleaned_data['quantity']
+    price = form.cleaned_data['price']
+
+    if settings.ASYNC_ORDERS:
+        try:
+            check_symbol(symbol)
+        except CannotFindStockException as e:
+            return _json({'error': str(e)}, status=400)
+        order = enqueue(request.account, type, symbol, quantity, price)
+        return _json({'order': order.as_dict(), 'poll': reverse('portfolio.api.order', args=[order.pk])},
+                     status=202)
+
+    try:
+        check_symbol(symbol)
+        quote = lookup(symbol)
+        stock = Stock.get_stock_from_quote(quote)
+        if type == BUY:
+            request.account.buy(stock, quantity, price, quote)
+        else:
+            request.account.sell(stock, quantity, price, quote)
+    except (ConnectionError, Timeout):
+        return _json({'error': 'Cannot connect to Benzinga'}, status=503)
+    except TRADE_ERRORS as e:
+        return _json({'error': str(e)}, status=400)
+
+    account = Account.objects.values('amount', 'version').get(pk=request.account.pk)
+    return _json({
+        'order': {'symbol': symbol, 'type': type, 'quantity': quantity, 'price': str(price)},
+        'cash': str(account['amount']),
+        'version': account['version'],
+    })
+
+
+@api_login_required
+@require_GET
+def order(request, order_id):
+    """
+    Status of a queued order
+    """
+    try:
+        order = QueuedOrder.objects.get(pk=order_id, account=request.account)
+    except QueuedOrder.DoesNotExist:
+        return _json({'error': 'Cannot find order'}, status=404)
+    return _json({'order': order.as_dict()})
+
+
+@api_login_required
+@require_POST
+def buy(request):
+    return _trade(request, BUY)
+
+
+@api_login_required
+@require_POST
+def sell(request):
+    return _trade(request, SELL)
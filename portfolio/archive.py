@@ -0,0 +1,223 @@
+"""
+Order archive, old orders move out of the `Order` table into files
+
+archive_orders moves orders older than ORDER_RETENTION_DAYS in batches to
+    <ORDER_ARCHIVE_DIR>/<YYYY-MM-DD>/<account_id>.jsonl.gz
+one gzip member per batch, dated by created_at in UTC. Each batch is
+written and synced before its rows are deleted, so a crash in between
+only archives some orders twice, readers skip repeated ids.
+
+Ledger replays read archived orders back, the archive_orders command
+snapshots accounts first so replays up to now do not need to. Amounts bought and sold are
+kept in `ArchivedOrderTotal` for analytics.
+
+History reads both sides with the same (created_at, id) keyset and merges
+them, archived orders come back as unsaved `Order` instances.
+"""
+import gzip
+import json
+import os
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Account, Order, Stock, LotClose, ArchivedOrderTotal, BUY
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def archive_dir():
+    return getattr(settings, 'ORDER_ARCHIVE_DIR', None)
+
+
+def chunked_delete(queryset, chunk_size=None):
+    """
+    Deletes rows of queryset chunk_size at a time, each chunk in its own
+    transaction, so locks are held only briefly. Returns rows deleted
+    """
+    chunk_size = chunk_size or getattr(settings, 'ORDER_ARCHIVE_BATCH_SIZE', 1000)
+    model = queryset.model
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            model.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+
+
+def _path(root, day, account_id):
+    return os.path.join(root, day, '{0}.jsonl.gz'.format(account_id))
+
+
+def _record(order, symbol, closed_lots):
+    return {
+        'id': order['id'],
+        'created_at': order['created_at'].isoformat(),
+        'symbol': symbol,
+        'stock_id': order['stock_id'],
+        'type': order['type'],
+        'quantity': order['quantity'],
+        'price': str(order['price']),
+        'closed_lots': closed_lots,
+    }
+
+
+def _write(root, day, account_id, records):
+    directory = os.path.join(root, day)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(_path(root, day, account_id), 'ab') as raw:
+        # a new gzip member, gzip readers read members one after another
+        with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+def archive_batch(cutoff, batch_size=1000, root=None):
+    """
+    Archives up to batch_size orders created before cutoff,
+    returns the number archived
+    """
+    root = root or archive_dir()
+    orders = list(Order.objects.filter(created_at__lt=cutoff).order_by('id').values(
+        'id', 'account_id', 'stock_id', 'stock__symbol', 'created_at', 'type', 'quantity', 'price')[:batch_size])
+    if not orders:
+        return 0
+    ids = [o['id'] for o in orders]
+
+    closed = {}
+    for order_id, lot_id, quantity, price in LotClose.objects.filter(order_id__in=ids).\
+            order_by('id').values_list('order_id', 'lot_id', 'quantity', 'price'):
+        closed.setdefault(order_id, []).append([lot_id, quantity, str(price)])
+
+    files = {}
+    totals = {}
+    for o in orders:
+        day = o['created_at'].astimezone(timezone.utc).strftime(DATE_FORMAT)
+        files.setdefault((day, o['account_id']), []).append(
+            _record(o, o['stock__symbol'], closed.get(o['id'], [])))
+        total = totals.setdefault((o['account_id'], o['stock_id']), [Decimal(0), Decimal(0)])
+        total[0 if o['type'] == BUY else 1] += o['quantity'] * o['price']
+
+    for (day, account_id), records in sorted(files.items()):
+        _write(root, day, account_id, records)
+
+    with transaction.atomic():
+        for (account_id, stock_id), (bought, sold) in totals.items():
+            updated = ArchivedOrderTotal.objects.filter(account_id=account_id, stock_id=stock_id).update(
+                bought=F('bought') + bought, sold=F('sold') + sold)
+            if not updated:
+                ArchivedOrderTotal.objects.create(
+                    account_id=account_id, stock_id=stock_id, bought=bought, sold=sold)
+        Order.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+
+def archive_cutoff(days=None):
+    days = days if days is not None else getattr(settings, 'ORDER_RETENTION_DAYS', 90)
+    return timezone.now() - timedelta(days=days)
+
+
+def accounts_to_archive(days=None):
+    """
+    Accounts with orders older than days
+    """
+    account_ids = Order.objects.filter(created_at__lt=archive_cutoff(days)).\
+        values_list('account_id', flat=True).distinct()
+    return Account.objects.filter(pk__in=list(account_ids))
+
+
+def archive_orders(days=None, batch_size=None, root=None):
+    """
+    Moves orders older than days to the archive, returns the number moved
+    """
+    batch_size = batch_size or getattr(settings, 'ORDER_ARCHIVE_BATCH_SIZE', 1000)
+    cutoff = archive_cutoff(days)
+    archived = 0
+    while True:
+        count = archive_batch(cutoff, batch_size, root)
+        if not count:
+            return archived
+        archived += count
+
+
+def delete_archive(account, root=None):
+    """
+    Removes archived orders of account
+    """
+    root = root or archive_dir()
+    ArchivedOrderTotal.objects.filter(account=account).delete()
+    if not root or not os.path.isdir(root):
+        return
+    for day in os.listdir(root):
+        path = _path(root, day, account.pk)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _read(path):
+    seen = set()
+    records = []
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['id'] not in seen:
+                seen.add(record['id'])
+                records.append(record)
+    return records
+
+
+def _order(account, record):
+    order = Order(
+        id=record['id'], account=account, stock_id=record['stock_id'], type=record['type'],
+        quantity=record['quantity'], price=Decimal(record['price']),
+        created_at=parse_datetime(record['created_at']))
+    # only symbol is known, enough for history
+    order.stock = Stock(id=record['stock_id'], symbol=record['symbol'])
+    return order
+
+
+def archived_orders(account, symbol=None, type=None, start=None, end=None, before=None, root=None):
+    """
+    Yields archived orders of account newest first, filtered like
+    history.filter_orders, before is (created_at, id) to start after
+    """
+    root = root or archive_dir()
+    if not root or not os.path.isdir(root):
+        return
+    # accounts which never had orders archived do not touch the disk
+    if not ArchivedOrderTotal.objects.filter(account=account).exists():
+        return
+
+    # start and end are local dates and directories UTC ones, a day more covers the offset
+    days = sorted(os.listdir(root), reverse=True)
+    if start:
+        days = [d for d in days if d >= (start - timedelta(days=1)).strftime(DATE_FORMAT)]
+    if end:
+        days = [d for d in days if d <= (end + timedelta(days=1)).strftime(DATE_FORMAT)]
+    if before:
+        days = [d for d in days if d <= before[0].astimezone(timezone.utc).strftime(DATE_FORMAT)]
+
+    for day in days:
+        path = _path(root, day, account.pk)
+        if not os.path.exists(path):
+            continue
+        orders = [_order(account, r) for r in _read(path)
+                  if (not symbol or r['symbol'] == symbol.upper()) and (not type or r['type'] == type)]
+        orders.sort(key=lambda o: (o.created_at, o.id), reverse=True)
+        for order in orders:
+            date = timezone.localtime(order.created_at).date()
+            if (start and date < start) or (end and date > end):
+                continue
+            if before and (order.created_at, order.id) >= before:
+                continue
+            yield order
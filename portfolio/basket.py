@@ -0,0 +1,164 @@
+"""
+Basket orders: many buys and sells executed in one transaction
+
+All quotes of a basket are fetched in one batch and the whole basket is
+validated before anything is written, so it's all or nothing.
+Sells are executed before buys, so cash from sells can pay for buys.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+
+from .utils import lookup_many
+from .models import Stock, Order, HoldingStock, Position, LeaderboardEntry, BUY, SELL
+from .exceptions import BasketException, CannotFindStockException
+from .symbols import check_symbol
+
+TYPE_NAMES = {'b': BUY, 'buy': BUY, 's': SELL, 'sell': SELL}
+
+
+class BasketLine(object):
+    def __init__(self, type, symbol, quantity, price):
+        self.type = type
+        self.symbol = symbol.upper()
+        self.quantity = quantity
+        self.price = price
+        self.stock = None
+
+    def as_dict(self):
+        return {
+            'type': {BUY: 'buy', SELL: 'sell'}[self.type],
+            'symbol': self.symbol,
+            'quantity': self.quantity,
+            'price': str(self.price),
+        }
+
+
+def parse_line(type, symbol, quantity, price):
+    """
+    Returns BasketLine or raises ValueError
+    """
+    if unicode(type).lower() not in TYPE_NAMES:
+        raise ValueError(u'Unknown order type {0}'.format(type))
+    if not symbol or not unicode(symbol).isalpha():
+        raise ValueError(u'Invalid symbol {0}'.format(symbol))
+    try:
+        quantity = int(quantity)
+        price = Decimal(unicode(price))
+    except (TypeError, ValueError, InvalidOperation):
+        raise ValueError(u'Invalid quantity or price')
+    return BasketLine(TYPE_NAMES[unicode(type).lower()], unicode(symbol), quantity, price)
+
+
+def parse_basket(orders):
+    """
+    orders is a list of (type, symbol, quantity, price)
+    Returns list of BasketLine, raises BasketException if any line is invalid
+    """
+    lines, errors = [], []
+    for i, order in enumerate(orders):
+        try:
+            lines.append(parse_line(*order))
+        except (TypeError, ValueError) as e:
+            errors.append((i, unicode(e) if isinstance(e, ValueError) else u'Invalid order'))
+    if not orders:
+        errors.append((None, u'Basket is empty'))
+    if errors:
+        raise BasketException(errors)
+    return lines
+
+
+def validate_basket(account, lines):
+    """
+    Checks every line against its quote, account's holdings and fund
+    Sets `stock` of every line, raises BasketException with all errors
+    """
+    errors = []
+    for i, line in enumerate(lines):
+        try:
+            check_symbol(line.symbol)
+        except CannotFindStockException as e:
+            errors.append((i, unicode(e)))
+    if errors:
+        raise BasketException(errors)
+
+    quotes, lookup_errors = lookup_many([line.symbol for line in lines])
+
+    stocks = {}
+    for i, line in enumerate(lines):
+        if line.symbol in lookup_errors:
+            errors.append((i, u'Cannot connect to Benzinga.'))
+            continue
+        try:
+            if line.symbol not in stocks:
+                stocks[line.symbol] = Stock.get_stock_from_quote(quotes[line.symbol])
+            line.stock = stocks[line.symbol]
+            account._sync(line.type, line.stock, line.quantity, line.price, quotes[line.symbol])
+        except Exception as e:
+            errors.append((i, unicode(e)))
+
+    # sells go first, they can not use stocks bought in the same basket
+    holdings = dict(
+        Position.objects.filter(account=account, stock__in=stocks.values()).
+        values_list('stock_id', 'quantity'))
+    cash = account.amount
+    for i, line in enumerate(lines):
+        if line.type == SELL and line.stock is not None:
+            holdings[line.stock.id] = holdings.get(line.stock.id, 0) - line.quantity
+            if holdings[line.stock.id] < 0:
+                errors.append((i, u'You do not have enough stocks'))
+            cash += line.quantity * line.price
+    for i, line in enumerate(lines):
+        if line.type == BUY and line.stock is not None:
+            cash -= line.quantity * line.price
+            if cash < 0:
+                errors.append((i, u'You do not have enough money'))
+
+    if errors:
+        raise BasketException(sorted(errors))
+
+
+def execute_basket(account, lines):
+    """
+    Validates and executes all lines in one transaction
+    """
+    validate_basket(account, lines)
+
+    sells = [line for line in lines if line.type == SELL]
+    buys = [line for line in lines if line.type == BUY]
+
+    with transaction.atomic():
+        # fund is checked again under lock, anything may have changed since validation
+        account.change_amount(
+            sum((line.quantity * line.price for line in sells), Decimal(0)) -
+            sum((line.quantity * line.price for line in buys), Decimal(0)))
+
+        for line in sells:
+            # every sell order needs its id for LotClose
+            order = Order.objects.create(
+                account=account,
+                stock=line.stock,
+                quantity=line.quantity,
+                price=line.price,
+                type=SELL)
+            match = HoldingStock.close(account, line.stock, line.quantity, order)
+            Position.add(account, line.stock, -line.quantity, -match.cost)
+
+        Order.objects.bulk_create([
+            Order(account=account, stock=line.stock, quantity=line.quantity, price=line.price, type=BUY)
+            for line in buys])
+        HoldingStock.objects.bulk_create([
+            HoldingStock(account=account, stock=line.stock, quantity=line.quantity, price=line.price)
+            for line in buys])
+
+        bought = {}
+        for line in buys:
+            quantity, cost = bought.get(line.stock, (0, Decimal(0)))
+            bought[line.stock] = (quantity + line.quantity, cost + line.quantity * line.price)
+        for stock, (quantity, cost) in bought.items():
+            Position.add(account, stock, quantity, cost)
+
+    account.invalidate_cache()
+    LeaderboardEntry.record_trades(account, [
+        (line.symbol, line.quantity if line.type == BUY else -line.quantity, line.price)
+        for line in lines])
@@ -0,0 +1,400 @@
+"""
+Quote cache in front of Benzinga lookups, and account cache
+
+A quote is kept in several tiers (by default an in-process LRU and
+the Django cache), every field has its own TTL and concurrent misses
+for the same symbol are coalesced into one upstream call.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils.module_loading import import_by_path
+
+
+class LRUBackend(object):
+    """
+    Thread safe in-process LRU dict
+    """
+    name = 'local'
+
+    def __init__(self, size=None):
+        self.size = size or getattr(settings, 'QUOTE_CACHE_SIZE', 1024)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            # move it to the end, it's the most recently used one now
+            self._data[key] = value
+            return value
+
+    def set(self, key, value, timeout):
+        # quotes carry their own timestamp,
+        # LRUBackend only evicts by size
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCacheBackend(object):
+    """
+    Shares quotes between workers through one of settings.CACHES
+
+    The cache is shared with accounts and hot symbols, so clear only bumps
+    a generation which is part of every key, old entries expire on their own.
+    Processes reread the generation every `generation_ttl` seconds.
+    """
+    name = 'shared'
+    # bumped whenever the stored format changes, v3 stores Quote with volume
+    prefix = 'quote:v3:'
+    generation_key = 'quote:generation'
+
+    def __init__(self, alias=None, generation_ttl=1):
+        self.alias = alias or getattr(settings, 'QUOTE_CACHE_ALIAS', 'default')
+        self.generation_ttl = generation_ttl
+        # (expires at, generation)
+        self._generation = None
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.alias)
+        return self._cache
+
+    def key(self, key):
+        now = time.time()
+        entry = self._generation
+        if entry is None or entry[0] <= now:
+            entry = self._generation = (now + self.generation_ttl, self.cache.get(self.generation_key, 0))
+        return '{0}{1}:{2}'.format(self.prefix, entry[1], key)
+
+    def get(self, key):
+        return self.cache.get(self.key(key))
+
+    def set(self, key, value, timeout):
+        self.cache.set(self.key(key), value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.key(key))
+
+    def clear(self):
+        generation = self.cache.get(self.generation_key, 0) + 1
+        self.cache.set(self.generation_key, generation, None)
+        self._generation = (time.time() + self.generation_ttl, generation)
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Makes sure only one call per key is in flight,
+    other callers wait and share its result
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        Returns (result, shared)
+        shared is True if we waited for another thread's call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+
+class QuoteCache(object):
+    """
+    Entries are Quote instances, which carry their fetched_at.
+    An entry is fresh for a caller if it's younger than the smallest TTL
+    of the fields that caller reads.
+    Entries are kept at least `stale_ttl` seconds, see get_stale.
+    """
+
+    def __init__(self, backends, default_ttl=2, field_ttl=None, stale_ttl=600):
+        self.backends = list(backends)
+        self.default_ttl = default_ttl
+        self.field_ttl = dict(field_ttl or {})
+        self.stale_ttl = stale_ttl
+        self.max_ttl = max([default_ttl, stale_ttl] + list(self.field_ttl.values()))
+        self._flight = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @classmethod
+    def from_settings(cls):
+        backends = [
+            import_by_path(path)()
+            for path in getattr(settings, 'QUOTE_CACHE_BACKENDS', (
+                'portfolio.cache.LRUBackend',
+                'portfolio.cache.DjangoCacheBackend'))]
+        return cls(
+            backends,
+            default_ttl=getattr(settings, 'QUOTE_CACHE_TTL', 2),
+            field_ttl=getattr(settings, 'QUOTE_CACHE_FIELD_TTL', None),
+            stale_ttl=getattr(settings, 'QUOTE_CACHE_STALE_TTL', 600))
+
+    def ttl(self, fields=None):
+        if not fields:
+            return self.default_ttl
+        return min(self.field_ttl.get(f, self.default_ttl) for f in fields)
+
+    def get(self, symbol, fetch, fields=None):
+        """
+        Returns cached Quote of symbol,
+        calls fetch(symbol) if there's no fresh one
+        """
+        key = symbol.upper()
+        ttl = self.ttl(fields)
+
+        quote = self._get_fresh(key, ttl)
+        if quote is not None:
+            return quote
+
+        def fill():
+            # someone may have filled it while we were waiting for the lock
+            quote = self._get_fresh(key, ttl, count=False)
+            if quote is None:
+                quote = fetch(symbol)
+                self.set(symbol, quote)
+            return quote
+
+        self._incr('misses')
+        quote, shared = self._flight.do(key, fill)
+        if shared:
+            self._incr('coalesced')
+        return quote
+
+    def peek(self, symbol):
+        """
+        Returns Quote of symbol regardless of its age, or None
+        """
+        key = symbol.upper()
+        for backend in self.backends:
+            quote = backend.get(key)
+            if quote is not None:
+                return quote
+        return None
+
+    def get_stale(self, symbol):
+        """
+        Returns a copy of the last known Quote of symbol marked as stale,
+        or None if it's older than stale_ttl
+        Only for display, when Benzinga cannot be reached
+        """
+        quote = self.peek(symbol)
+        if quote is None or time.time() - quote.fetched_at >= self.stale_ttl:
+            return None
+        self._incr('stale_hits')
+        return quote.as_stale()
+
+    def set(self, symbol, quote):
+        for backend in self.backends:
+            backend.set(symbol.upper(), quote, self.max_ttl)
+
+    def delete(self, symbol):
+        for backend in self.backends:
+            backend.delete(symbol.upper())
+
+    def clear(self):
+        for backend in self.backends:
+            backend.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {'misses': 0, 'coalesced': 0}
+            for backend in self.backends:
+                self._stats[backend.name + '_hits'] = 0
+
+    def _get_fresh(self, key, ttl, count=True):
+        now = time.time()
+        for i, backend in enumerate(self.backends):
+            quote = backend.get(key)
+            if quote is None or now - quote.fetched_at >= ttl:
+                continue
+            # back fill faster tiers
+            for faster in self.backends[:i]:
+                faster.set(key, quote, self.max_ttl)
+            if count:
+                self._incr(backend.name + '_hits')
+            return quote
+        return None
+
+    def _incr(self, name):
+        with self._stats_lock:
+            self._stats[name] = self._stats.get(name, 0) + 1
+
+
+class AccountCache(object):
+    """
+    Account fields by username, in a short lived per-process dict
+    in front of the Django cache, so authenticated requests skip the DB
+
+    Cached accounts may be a bit stale,
+    anything changing the balance must load the account from DB
+    and invalidate it here
+    """
+    prefix = 'account:'
+
+    def __init__(self, alias='default', local_ttl=1, timeout=300):
+        self.alias = alias
+        self.local_ttl = local_ttl
+        self.timeout = timeout
+        self._local = {}
+        self._lock = threading.Lock()
+        self._cache = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            alias=getattr(settings, 'ACCOUNT_CACHE_ALIAS', 'default'),
+            local_ttl=getattr(settings, 'ACCOUNT_CACHE_LOCAL_TTL', 1),
+            timeout=getattr(settings, 'ACCOUNT_CACHE_TIMEOUT', 300))
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.alias)
+        return self._cache
+
+    def get(self, username, load):
+        """
+        Returns a dict of account fields,
+        load(username) is called on a miss and may raise DoesNotExist
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._local.get(username)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        fields = self.cache.get(self.prefix + username)
+        if fields is None:
+            fields = load(username)
+            self.cache.set(self.prefix + username, fields, self.timeout)
+        with self._lock:
+            self._local[username] = (now + self.local_ttl, fields)
+        return fields
+
+    def invalidate(self, username):
+        with self._lock:
+            self._local.pop(username, None)
+        self.cache.delete(self.prefix + username)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+
+class HotSymbols(object):
+    """
+    Symbols searched or traded recently, shared through the Django cache
+    so the refresh_quotes worker knows what to keep warm
+
+    Every process buffers touched symbols and merges them into the shared
+    set at most every `flush_interval` seconds, so a request costs no I/O.
+    Concurrent merges may drop a symbol now and then, it comes back on
+    its next touch.
+    """
+    key = 'hot_symbols'
+
+    def __init__(self, alias='default', flush_interval=5, max_age=600):
+        self.alias = alias
+        self.flush_interval = flush_interval
+        self.max_age = max_age
+        self._buffer = {}
+        self._flushed_at = 0
+        self._lock = threading.Lock()
+        self._cache = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            alias=getattr(settings, 'QUOTE_CACHE_ALIAS', 'default'),
+            max_age=getattr(settings, 'QUOTE_REFRESH_HOT_AGE', 600))
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.alias)
+        return self._cache
+
+    def touch(self, symbol):
+        now = time.time()
+        with self._lock:
+            self._buffer[symbol.upper()] = now
+            if now - self._flushed_at < self.flush_interval:
+                return
+            buffer, self._buffer = self._buffer, {}
+            self._flushed_at = now
+        self.flush(buffer)
+
+    def flush(self, buffer=None):
+        if buffer is None:
+            with self._lock:
+                buffer, self._buffer = self._buffer, {}
+        if not buffer:
+            return
+        hot = self.cache.get(self.key) or {}
+        hot.update(buffer)
+        self.cache.set(self.key, self._recent(hot), self.max_age)
+
+    def symbols(self):
+        return sorted(self._recent(self.cache.get(self.key) or {}))
+
+    def _recent(self, hot):
+        oldest = time.time() - self.max_age
+        return dict((symbol, seen) for symbol, seen in hot.items() if seen > oldest)
+
+
+quote_cache = QuoteCache.from_settings()
+account_cache = AccountCache.from_settings()
+hot_symbols = HotSymbols.from_settings()
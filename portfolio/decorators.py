@@ -1,13 +1,17 @@
+import json as jsonlib
 from functools import wraps
 from urllib import urlencode
 
-from requests.exceptions import Timeout
+from requests.exceptions import ConnectionError, Timeout
 
 from django.contrib import messages
+from django.http import HttpResponse
 from django.shortcuts import redirect
 
 from .models import Account, Stock
 from .utils import lookup as benzinga_lookup
+from .cache import hot_symbols
+from .symbols import check_symbol
 from .exceptions import EmptySymbolException, CannotFindStockException
 
 
@@ -23,9 +27,9 @@ def login_required(view_func):
 
         # to make this project simple
         # we do not save Account instance in context processor
+        # account comes from account cache, views changing it must reload it
         try:
-            request.account = Account.objects.get(
-                username=request.session['username'])
+            request.account = Account.get_cached(request.session['username'])
         except Account.DoesNotExist:
             pass
 
@@ -34,6 +38,22 @@ def login_required(view_func):
     return func
 
 
+def api_login_required(view_func):
+    """
+    Like login_required, but answers 401 instead of redirecting to login page
+    """
+
+    @wraps(view_func)
+    def func(request, *args, **kwargs):
+        try:
+            request.account = Account.get_cached(request.session['username'])
+        except (KeyError, Account.DoesNotExist):
+            return HttpResponse(jsonlib.dumps({'error': 'Login required'}), status=401, content_type='application/json')
+        return view_func(request, *args, **kwargs)
+
+    return func
+
+
 def stock_decorator(view_func):
     """
     Gets or crates Stock instance based on symbol in kwargs
@@ -45,13 +65,20 @@ def stock_decorator(view_func):
 
         if symbol:
             try:
-                json = benzinga_lookup(symbol)
-            except Timeout:
+                check_symbol(symbol)
+            except CannotFindStockException as e:
+                messages.warning(request, str(e))
+                raise
+
+            hot_symbols.touch(symbol)
+            try:
+                quote = benzinga_lookup(symbol)
+            except (ConnectionError, Timeout):
                 messages.error(request, u'Cannot connect to Benzinga.')
                 raise
 
             try:
-                stock = Stock.get_stock_from_json(json)
+                stock = Stock.get_stock_from_quote(quote)
             except CannotFindStockException as e:
                 messages.warning(request, str(e))
                 raise
@@ -60,7 +87,7 @@ def stock_decorator(view_func):
                 raise
 
             kwargs['stock'] = stock
-            kwargs['json'] = json
+            kwargs['quote'] = quote
 
             return view_func(request, *args, **kwargs)
 
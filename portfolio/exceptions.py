@@ -1,3 +1,6 @@
+from requests.exceptions import ConnectionError
+
+
 class CannotFindStockException(Exception):
     pass
 
@@ -24,3 +27,25 @@ class NotEnoughFundExceptin(Exception):
 
 class NegativeQuantityException(Exception):
     pass
+
+
+class StaleQuoteException(Exception):
+    pass
+
+
+class CircuitOpenException(ConnectionError):
+    """
+    Raised without calling Benzinga while the circuit breaker is open,
+    it's a ConnectionError so callers handle it like one
+    """
+    pass
+
+
+class BasketException(Exception):
+    """
+    Raised when any line of a basket is invalid,
+    `errors` is a list of (line number, message)
+    """
+    def __init__(self, errors):
+        super(BasketException, self).__init__('Basket is not executed')
+        self.errors = errors
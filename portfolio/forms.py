@@ -1,6 +1,8 @@
 from django import forms
 from django.core.validators import RegexValidator
 
+from .models import ORDER_TYPES
+
 
 class LoginForm(forms.Form):
     username = forms.CharField(
@@ -8,3 +10,34 @@ class LoginForm(forms.Form):
         max_length=32,
         validators=[RegexValidator(
             regex=r'\w+', message='Only a-zA-Z0-9_ allowed in username')])
+
+
+class BasketForm(forms.Form):
+    """
+    One order per line: <buy|sell> <symbol> <quantity> <price>
+    """
+    orders = forms.CharField(widget=forms.Textarea(attrs={'placeholder': 'buy F 10 16.68'}))
+
+    def clean_orders(self):
+        return [line.split() for line in self.cleaned_data['orders'].splitlines() if line.strip()]
+
+
+class TradeForm(forms.Form):
+    symbol = forms.RegexField(regex=r'^[a-zA-Z]+$', max_length=8)
+    quantity = forms.IntegerField(min_value=1)
+    price = forms.DecimalField(min_value=0)
+
+
+class LimitOrderForm(forms.Form):
+    type = forms.ChoiceField(choices=ORDER_TYPES)
+    symbol = forms.RegexField(regex=r'^[a-zA-Z]+$', max_length=8)
+    quantity = forms.IntegerField(min_value=1)
+    limit_price = forms.DecimalField(min_value=0, max_digits=8, decimal_places=4)
+
+
+class HistoryFilterForm(forms.Form):
+    symbol = forms.CharField(max_length=8, required=False)
+    type = forms.ChoiceField(choices=(('', 'All'),) + ORDER_TYPES, required=False)
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+    cursor = forms.RegexField(regex=r'^\d+-\d+$', required=False, widget=forms.HiddenInput)
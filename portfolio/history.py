@@ -0,0 +1,119 @@
+"""
+Order history with keyset pagination
+
+Orders are listed newest first by (created_at, id). A page cursor is the
+(created_at, id) of the last order on the previous page, so every page
+is one index range scan however deep the user pages, unlike OFFSET.
+Archived orders are paged by the same key and merged in, see archive.py.
+"""
+import calendar
+from datetime import datetime, timedelta
+from itertools import islice
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Order
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(order):
+    created_at = order.created_at if hasattr(order, 'created_at') else order[0]
+    pk = order.pk if hasattr(order, 'pk') else order[1]
+    micros = calendar.timegm(created_at.utctimetuple()) * 10 ** 6 + created_at.microsecond
+    return '{0}-{1}'.format(micros, pk)
+
+
+def decode_cursor(cursor):
+    """
+    Returns (created_at, id), raises ValueError for bad cursors
+    """
+    micros, pk = cursor.split('-')
+    return EPOCH + timedelta(microseconds=int(micros)), int(pk)
+
+
+def filter_orders(account, symbol=None, type=None, start=None, end=None):
+    """
+    start and end are dates, both included
+    """
+    orders = Order.objects.filter(account=account)
+    if symbol:
+        orders = orders.filter(stock__symbol=symbol.upper())
+    if type:
+        orders = orders.filter(type=type)
+    if start:
+        orders = orders.filter(created_at__gte=start)
+    if end:
+        orders = orders.filter(created_at__lt=end + timedelta(days=1))
+    return orders
+
+
+def after_cursor(orders, cursor):
+    created_at, pk = decode_cursor(cursor)
+    return orders.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+
+def _key(order):
+    return order.created_at, order.id
+
+
+def page(orders, cursor=None, size=50, archived=None):
+    """
+    Returns (orders, next cursor), next cursor is None on the last page
+    archived(before) yields archived orders newest first,
+    after (created_at, id) before, to merge with orders
+    """
+    if cursor:
+        orders = after_cursor(orders, cursor)
+    orders = list(orders.select_related('stock').order_by('-created_at', '-id')[:size + 1])
+    if archived is not None:
+        before = decode_cursor(cursor) if cursor else None
+        orders.extend(islice(archived(before), size + 1))
+        orders = sorted(orders, key=_key, reverse=True)[:size + 1]
+    if len(orders) > size:
+        return orders[:size], encode_cursor(orders[size - 1])
+    return orders, None
+
+
+EXPORT_FIELDS = ('id', 'created_at', 'stock__symbol', 'type', 'quantity', 'price')
+
+
+def _merge(live, archived):
+    """
+    Merges two iterators of rows in export order, newest first
+    """
+    row, other = next(live, None), next(archived, None)
+    while row is not None or other is not None:
+        if other is None or (row is not None and (row[1], row[0]) > (other[1], other[0])):
+            yield row
+            row = next(live, None)
+        else:
+            yield other
+            other = next(archived, None)
+
+
+def export_rows(orders, chunk_size=1000, archived=None):
+    """
+    Yields tuples of EXPORT_FIELDS chunk by chunk,
+    only one chunk is kept in memory
+    archived is an iterator of archived orders newest first to merge in
+    """
+    rows = _export_rows(orders, chunk_size)
+    if archived is None:
+        return rows
+    return _merge(rows, ((o.id, o.created_at, o.stock.symbol, o.type, o.quantity, o.price) for o in archived))
+
+
+def _export_rows(orders, chunk_size):
+    orders = orders.order_by('-created_at', '-id').values_list(*EXPORT_FIELDS)
+    cursor = None
+    while True:
+        chunk = after_cursor(orders, cursor) if cursor else orders
+        count = 0
+        for row in chunk[:chunk_size].iterator():
+            count += 1
+            yield row
+        if count < chunk_size:
+            return
+        cursor = encode_cursor((row[1], row[0]))
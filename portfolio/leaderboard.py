@@ -0,0 +1,88 @@
+"""
+Leaderboard of all accounts by cash plus holdings at mark prices
+
+build_leaderboard prices every held symbol once, values all accounts in one
+vectorized pass over Position rows and stores the snapshot.
+Trades move their account's value right away (see LeaderboardEntry.move).
+Ranks are read from the (value, account) index, top N is one range scan
+and my rank one count, so trades never touch other accounts' rows.
+"""
+from decimal import Decimal
+
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Account, Position, LeaderboardEntry
+from .utils import display_lookup, lookup_many
+
+
+def get_marks(symbols, deadline=None):
+    """
+    Returns {symbol: bid} of symbols, symbols without a quote are left out
+    """
+    quotes, errors = lookup_many(symbols, fields=('bid',), deadline=deadline, func=display_lookup)
+    return dict((symbol, quote.bid) for symbol, quote in quotes.items() if quote.bid is not None)
+
+
+def build_leaderboard(deadline=None):
+    """
+    Replaces the leaderboard snapshot, returns number of ranked accounts
+    Positions without a mark price are valued at cost
+    """
+    symbols = Position.objects.values_list('stock__symbol', flat=True).distinct()
+    marks = get_marks(set(s.upper() for s in symbols), deadline=deadline)
+
+    accounts = list(Account.objects.values_list('id', 'amount').order_by('id'))
+    positions = list(Position.objects.values_list('account_id', 'stock__symbol', 'quantity', 'cost'))
+    if not accounts:
+        LeaderboardEntry.objects.all().delete()
+        return 0
+
+    ids = np.array([a[0] for a in accounts])
+    cash = np.array([a[1] for a in accounts], dtype=np.float64)
+    if positions:
+        account_ids, position_symbols, quantity, cost = zip(*positions)
+        quantity = np.array(quantity, dtype=np.float64)
+        mark = np.array([marks.get(s.upper(), np.nan) for s in position_symbols], dtype=np.float64)
+        value = np.where(np.isnan(mark), np.array(cost, dtype=np.float64), quantity * mark)
+        holdings = np.bincount(np.searchsorted(ids, account_ids), weights=value, minlength=len(ids))
+    else:
+        holdings = np.zeros(len(ids))
+    total = cash + holdings
+
+    entries = [
+        LeaderboardEntry(account_id=int(ids[i]), value=Decimal('{0:.2f}'.format(total[i])))
+        for i in range(len(ids))]
+
+    with transaction.atomic():
+        LeaderboardEntry.objects.all().delete()
+        LeaderboardEntry.objects.bulk_create(entries, batch_size=500)
+    cache.set(LeaderboardEntry.MARKS_KEY, marks, getattr(settings, 'LEADERBOARD_MARKS_TIMEOUT', 3600))
+    return len(entries)
+
+
+def top(size=None):
+    """
+    Returns the size highest entries with their rank,
+    highest value first, ties by account id
+    """
+    size = size or getattr(settings, 'LEADERBOARD_SIZE', 20)
+    entries = list(LeaderboardEntry.objects.select_related('account').order_by('-value', 'account')[:size])
+    for rank, entry in enumerate(entries, 1):
+        entry.rank = rank
+    return entries
+
+
+def rank_of(account):
+    """
+    Returns LeaderboardEntry of account with its rank, None if it's not ranked yet
+    """
+    try:
+        entry = LeaderboardEntry.objects.get(account=account)
+    except LeaderboardEntry.DoesNotExist:
+        return None
+    entry.rank = entry.count_rank()
+    return entry
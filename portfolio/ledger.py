@@ -0,0 +1,212 @@
+"""
+Rebuilds cash and lots of accounts by replaying their `Order` log
+
+Orders are replayed by (created_at, id) from INIT_CACHE and no lots,
+buys open a lot and sells close lots by the account's lot policy,
+so the result can be checked against `Account.amount` and `HoldingStock`.
+An `AccountSnapshot` stores the state after some order, a replay starts
+from the latest snapshot before the wanted time and replays only the tail.
+
+Replay uses the current lot policy of the account, changing the policy
+makes older sells replay differently. Archived orders are read back from
+the archive and merged in, so replays to any time give the same result.
+"""
+import json
+from decimal import Decimal
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .archive import archived_orders
+from .lots import LOT_KEYS, match_lots
+from .models import Account, Order, HoldingStock, AccountSnapshot, BUY
+
+# replayed amounts may differ from the stored one by rounding
+TOLERANCE = Decimal('0.01')
+
+
+class Ledger(object):
+    """
+    State of one account, lots are {stock_id: [[lot_id, quantity, price], ...]}
+    lot_id of a replayed lot is the id of its buy order
+    """
+
+    def __init__(self, amount, lots=None, as_of=None, order_id=None):
+        self.amount = amount
+        self.lots = lots or {}
+        self.as_of = as_of
+        self.order_id = order_id
+        # orders which could not be applied
+        self.errors = []
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        lots = {}
+        for lot_id, stock_id, quantity, price in json.loads(snapshot.lots):
+            lots.setdefault(stock_id, []).append([lot_id, quantity, Decimal(price)])
+        return cls(snapshot.amount, lots, snapshot.as_of, snapshot.order_id)
+
+    def apply(self, order_id, created_at, stock_id, type, quantity, price, policy):
+        if type == BUY:
+            self.amount -= quantity * price
+            self.lots.setdefault(stock_id, []).append([order_id, quantity, price])
+        else:
+            self.amount += quantity * price
+            lots = sorted(self.lots.get(stock_id, []), key=LOT_KEYS[policy])
+            match = match_lots(lots, quantity)
+            if match.left:
+                self.errors.append('order {0} sells {1} more than held'.format(order_id, match.left))
+            closed = set(lot_id for lot_id, q, p in match.closed)
+            lots = [lot for lot in lots if lot[0] not in closed]
+            if match.partial:
+                for lot in lots:
+                    if lot[0] == match.partial[0]:
+                        lot[1] -= match.partial[1]
+            self.lots[stock_id] = lots
+        self.as_of = created_at
+        self.order_id = order_id
+
+    def lot_list(self):
+        """
+        Returns sorted (stock_id, quantity, price) of open lots
+        """
+        return sorted(
+            (stock_id, quantity, price)
+            for stock_id, lots in self.lots.items() for lot_id, quantity, price in lots if quantity)
+
+    def dumps(self):
+        return json.dumps([
+            [lot_id, stock_id, quantity, str(price)]
+            for stock_id, lots in sorted(self.lots.items()) for lot_id, quantity, price in lots if quantity])
+
+
+def orders_of(account, after=None, until=None):
+    """
+    Orders of account as tuples for Ledger.apply, in replay order
+    after is (as_of, order_id) of the last order already applied
+    """
+    orders = Order.objects.filter(account=account)
+    if after is not None and after[0] is not None:
+        as_of, order_id = after
+        orders = orders.filter(Q(created_at__gt=as_of) | Q(created_at=as_of, id__gt=order_id))
+    if until is not None:
+        orders = orders.filter(created_at__lte=until)
+    orders = orders.order_by('created_at', 'id').values_list(
+        'id', 'created_at', 'stock_id', 'type', 'quantity', 'price').iterator()
+    archived = _archived_orders(account, after, until)
+    return _merge(orders, iter(archived)) if archived else orders
+
+
+def _archived_orders(account, after=None, until=None):
+    """
+    Archived orders of account as tuples for Ledger.apply, in replay order
+    """
+    start = timezone.localtime(after[0]).date() if after is not None and after[0] is not None else None
+    end = timezone.localtime(until).date() if until is not None else None
+    orders = []
+    for o in archived_orders(account, start=start, end=end):
+        if start is not None and (o.created_at, o.id) <= after:
+            continue
+        if until is not None and o.created_at > until:
+            continue
+        orders.append((o.id, o.created_at, o.stock_id, o.type, o.quantity, o.price))
+    orders.reverse()
+    return orders
+
+
+def _merge(live, archived):
+    """
+    Merges two iterators of order tuples by (created_at, id)
+    """
+    order, other = next(live, None), next(archived, None)
+    while order is not None or other is not None:
+        if other is None or (order is not None and (order[1], order[0]) < (other[1], other[0])):
+            yield order
+            order = next(live, None)
+        else:
+            yield other
+            other = next(archived, None)
+
+
+def replay(account, until=None):
+    """
+    Returns Ledger of account as of until, or now
+    """
+    snapshots = AccountSnapshot.objects.filter(account=account).order_by('-as_of', '-order_id')
+    if until is not None:
+        snapshots = snapshots.filter(as_of__lte=until)
+    snapshot = snapshots.first()
+    ledger = Ledger.from_snapshot(snapshot) if snapshot else Ledger(settings.INIT_CACHE)
+
+    for order in orders_of(account, (ledger.as_of, ledger.order_id), until):
+        ledger.apply(*order, policy=account.lot_policy)
+    return ledger
+
+
+def take_snapshot(account, min_orders=1):
+    """
+    Stores a snapshot of account if at least min_orders were made
+    since its latest one, returns it or None
+    """
+    ledger = replay(account)
+    latest = AccountSnapshot.objects.filter(account=account).order_by('-as_of', '-order_id').first()
+    if ledger.order_id is None or (latest and latest.order_id == ledger.order_id):
+        return None
+    if min_orders > 1:
+        tail = Order.objects.filter(account=account)
+        if latest:
+            tail = tail.filter(Q(created_at__gt=latest.as_of) | Q(created_at=latest.as_of, id__gt=latest.order_id))
+        if tail.count() < min_orders:
+            return None
+    return AccountSnapshot.objects.create(
+        account=account, as_of=ledger.as_of, order_id=ledger.order_id,
+        amount=ledger.amount, lots=ledger.dumps())
+
+
+def verify(account):
+    """
+    Returns a list of differences between replayed and stored state
+    """
+    ledger = replay(account)
+    problems = list(ledger.errors)
+    amount = Account.objects.filter(pk=account.pk).values_list('amount', flat=True)[0]
+    if abs(ledger.amount - amount) >= TOLERANCE:
+        problems.append('amount is {0}, replayed {1}'.format(amount, ledger.amount))
+    lots = sorted(HoldingStock.objects.filter(account=account).values_list('stock_id', 'quantity', 'price'))
+    if lots != ledger.lot_list():
+        problems.append('lots are {0}, replayed {1}'.format(lots, ledger.lot_list()))
+    return problems
+
+
+def _verify_ids(account_ids):
+    return [(account.pk, verify(account)) for account in Account.objects.filter(pk__in=account_ids)]
+
+
+def _init_worker():
+    # a forked connection must not be shared with the parent
+    connection.close()
+
+
+def verify_accounts(account_ids=None, processes=1, chunk_size=100):
+    """
+    Verifies accounts, in several processes if processes > 1
+    Returns {account_id: problems} of accounts with problems
+    """
+    if account_ids is None:
+        account_ids = list(Account.objects.values_list('id', flat=True).order_by('id'))
+    chunks = [account_ids[i:i + chunk_size] for i in range(0, len(account_ids), chunk_size)]
+
+    if processes > 1:
+        connection.close()
+        pool = Pool(processes, initializer=_init_worker)
+        try:
+            results = pool.map(_verify_ids, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_verify_ids(chunk) for chunk in chunks]
+    return dict((pk, problems) for result in results for pk, problems in result if problems)
@@ -0,0 +1,71 @@
+"""
+Lot matching for sells
+
+A sell consumes `HoldingStock` lots in the order given by the account's
+policy. Matching only looks at (id, quantity, price) rows, so it can be
+done over one ordered query, and applying it needs one bulk delete for
+fully closed lots plus at most one update for a partially closed lot.
+"""
+from decimal import Decimal
+
+FIFO = 'F'
+LIFO = 'L'
+HIGHEST_COST = 'H'
+LOT_POLICIES = (
+    (FIFO, 'First in, first out'),
+    (LIFO, 'Last in, first out'),
+    (HIGHEST_COST, 'Highest cost first'),
+)
+
+# lot ids grow with time, so they give us the buying order
+LOT_ORDERINGS = {
+    FIFO: ('id',),
+    LIFO: ('-id',),
+    HIGHEST_COST: ('-price', 'id'),
+}
+
+# the same orderings for (lot_id, quantity, price) tuples in memory
+LOT_KEYS = {
+    FIFO: lambda lot: lot[0],
+    LIFO: lambda lot: -lot[0],
+    HIGHEST_COST: lambda lot: (-lot[2], lot[0]),
+}
+
+
+class LotMatch(object):
+    """
+    closed are (lot_id, quantity, price) of lots sold completely
+    partial is (lot_id, quantity, price) of the lot sold partly, quantity is the sold part
+    left is the quantity we could not match
+    """
+
+    def __init__(self, quantity):
+        self.closed = []
+        self.partial = None
+        self.left = quantity
+
+    @property
+    def consumed(self):
+        return self.closed + ([self.partial] if self.partial else [])
+
+    @property
+    def cost(self):
+        return sum((quantity * price for lot_id, quantity, price in self.consumed), Decimal(0))
+
+
+def match_lots(lots, quantity):
+    """
+    lots is an iterable of (lot_id, quantity, price) in policy order,
+    it's consumed only as far as needed
+    """
+    match = LotMatch(quantity)
+    for lot_id, lot_quantity, price in lots:
+        if lot_quantity <= match.left:
+            match.closed.append((lot_id, lot_quantity, price))
+            match.left -= lot_quantity
+        else:
+            match.partial = (lot_id, match.left, price)
+            match.left = 0
+        if match.left == 0:
+            break
+    return match
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.archive import archive_orders, accounts_to_archive, archive_dir
+from portfolio.ledger import take_snapshot
+
+
+class Command(BaseCommand):
+    help = ('Moves orders older than ORDER_RETENTION_DAYS from the Order table into '
+            'gzipped files under ORDER_ARCHIVE_DIR, in short batches. Run it daily.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=None,
+                    help='Archive orders older than this, defaults to ORDER_RETENTION_DAYS'),
+        make_option('--batch-size', type='int', default=None,
+                    help='Orders per transaction, defaults to ORDER_ARCHIVE_BATCH_SIZE'),
+    )
+
+    def handle(self, *args, **options):
+        # archived orders are deleted from the DB, the archive is their only copy
+        if not archive_dir():
+            raise CommandError('ORDER_ARCHIVE_DIR is not set, orders would be lost')
+        # replays from these snapshots do not read the archive
+        for account in accounts_to_archive(options['days']).iterator():
+            take_snapshot(account)
+        count = archive_orders(days=options['days'], batch_size=options['batch_size'])
+        self.stdout.write('Archived {0} orders'.format(count))
@@ -0,0 +1,165 @@
+import random
+import re
+import time
+from datetime import timedelta
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from portfolio.models import Stock, Account, Order, HoldingStock, Position
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ANALYZE ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+class Command(BaseCommand):
+    help = ('Seeds a throwaway test database and reports query plans and timings '
+            'of index, sell and history paths, without and with composite indexes')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--accounts', type='int', default=1000,
+                    help='Number of accounts, e.g. 100000'),
+        make_option('--orders', type='int', default=100000,
+                    help='Number of orders, e.g. 10000000'),
+        make_option('--stocks', type='int', default=500),
+        make_option('--lots', type='int', default=20,
+                    help='Lots per account'),
+        make_option('--runs', type='int', default=50,
+                    help='Runs per query'),
+        make_option('--batch-size', type='int', default=10000),
+    )
+
+    def handle(self, *args, **options):
+        self.options = options
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.seed()
+            self.drop_indexes()
+            self.report('before')
+            start = time.time()
+            self.create_indexes()
+            self.stdout.write('Created indexes in {0:.1f}s'.format(time.time() - start))
+            self.report('after')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def composite_indexes(self):
+        """
+        CREATE INDEX statements of index_together
+        """
+        statements = []
+        for model in (Order, HoldingStock):
+            for names in model._meta.index_together:
+                fields = [model._meta.get_field(name) for name in names]
+                statements.extend(connection.creation.sql_indexes_for_fields(model, fields, no_style()))
+        return statements
+
+    def drop_indexes(self):
+        cursor = connection.cursor()
+        for statement in self.composite_indexes():
+            name = re.match(r'CREATE INDEX (\S+) ON', statement).group(1)
+            cursor.execute('DROP INDEX {0}'.format(name))
+
+    def create_indexes(self):
+        cursor = connection.cursor()
+        for statement in self.composite_indexes():
+            cursor.execute(statement)
+        if connection.vendor == 'sqlite':
+            cursor.execute('ANALYZE')
+
+    def insert(self, model, columns, rows):
+        sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(c) for c in columns),
+            ', '.join(['%s'] * len(columns)))
+        cursor = connection.cursor()
+        batch_size = self.options['batch_size']
+        batch = []
+        with transaction.atomic():
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    cursor.executemany(sql, batch)
+                    batch = []
+            if batch:
+                cursor.executemany(sql, batch)
+
+    def seed(self):
+        options = self.options
+        start = time.time()
+        n_stocks, n_accounts = options['stocks'], options['accounts']
+
+        self.insert(Stock, ('symbol', 'name', 'industry', 'exchange'), (
+            ('S{0}'.format(i), 'Stock {0}'.format(i), 'Industry', 'NYSE')
+            for i in range(n_stocks)))
+        self.insert(Account, ('username', 'amount', 'lot_policy'), (
+            ('user{0}'.format(i), Decimal('100000.00'), 'H')
+            for i in range(n_accounts)))
+        stock_ids = list(Stock.objects.values_list('id', flat=True))
+        account_ids = list(Account.objects.values_list('id', flat=True))
+
+        now = timezone.now()
+        self.insert(Order, ('account_id', 'stock_id', 'quantity', 'price', 'created_at', 'type'), (
+            (random.choice(account_ids), random.choice(stock_ids), random.randint(1, 100),
+             Decimal(random.randint(100, 100000)) / 100,
+             now - timedelta(seconds=random.randint(0, 365 * 24 * 3600)), random.choice('BS'))
+            for i in range(options['orders'])))
+
+        # lots of an account are spread over a few stocks, so a sell matches several lots
+        lots = []
+        for account_id in account_ids:
+            stocks = random.sample(stock_ids, min(3, len(stock_ids)))
+            for i in range(options['lots']):
+                lots.append((account_id, random.choice(stocks), random.randint(1, 100),
+                             Decimal(random.randint(100, 100000)) / 100))
+        self.insert(HoldingStock, ('account_id', 'stock_id', 'quantity', 'price'), lots)
+
+        positions = {}
+        for account_id, stock_id, quantity, price in lots:
+            q, cost = positions.get((account_id, stock_id), (0, Decimal(0)))
+            positions[(account_id, stock_id)] = (q + quantity, cost + quantity * price)
+        self.insert(Position, ('account_id', 'stock_id', 'quantity', 'cost'), (
+            key + value for key, value in positions.items()))
+
+        if connection.vendor == 'sqlite':
+            connection.cursor().execute('ANALYZE')
+        self.stdout.write('Seeded {0} accounts, {1} orders, {2} lots in {3:.1f}s'.format(
+            n_accounts, options['orders'], len(lots), time.time() - start))
+
+    def querysets(self):
+        account = Account.objects.order_by('?')[0]
+        stock_id = HoldingStock.objects.filter(account=account).values_list('stock_id', flat=True)[0]
+        symbol = Stock.objects.order_by('?')[0].symbol
+        return [
+            ('symbol', Stock.objects.filter(symbol=symbol)),
+            ('index', Position.objects.filter(account=account).select_related('stock').order_by('stock__symbol')),
+            ('sell', HoldingStock.objects.filter(account=account, stock_id=stock_id).
+                order_by('-price', 'id').values_list('id', 'quantity', 'price')),
+            ('history', Order.objects.filter(account=account).order_by('-created_at', '-id')[:50]),
+        ]
+
+    def report(self, title):
+        self.stdout.write('\n== {0} =='.format(title))
+        cursor = connection.cursor()
+        for name, queryset in self.querysets():
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(EXPLAIN.get(connection.vendor, 'EXPLAIN ') + sql, params)
+            plan = '\n    '.join(' '.join(str(c) for c in row) for row in cursor.fetchall())
+
+            timings = []
+            for i in range(self.options['runs']):
+                start = time.time()
+                list(queryset._clone())
+                timings.append((time.time() - start) * 1000)
+            timings.sort()
+
+            self.stdout.write('{0}: median {1:.3f}ms, max {2:.3f}ms\n    {3}'.format(
+                name, timings[len(timings) // 2], timings[-1], plan))
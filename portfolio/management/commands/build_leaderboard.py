@@ -0,0 +1,21 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from portfolio.leaderboard import build_leaderboard
+
+
+class Command(BaseCommand):
+    help = ('Prices every held symbol once and rebuilds the leaderboard snapshot, '
+            'run it periodically, trades keep it up to date in between.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--deadline', type='float', default=None,
+                    help='Seconds to wait for quotes, positions without one are valued at cost'),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        count = build_leaderboard(deadline=options['deadline'])
+        self.stdout.write('Ranked {0} accounts in {1:.2f}s'.format(count, time.time() - start))
@@ -0,0 +1,165 @@
+import json
+import random
+import threading
+import time
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+class Market(object):
+    """
+    Prices of the fake market
+
+    A symbol starts at a price derived from its name. With a drift script
+    (a JSON file like {"F": ["16.68", "16.70"]}) it walks through the given
+    prices, one step per `tick` seconds. Otherwise it's a random walk.
+    """
+
+    def __init__(self, tick=1.0, volatility=0.001, script=None, unknown=()):
+        self.tick = tick
+        self.volatility = volatility
+        self.script = dict((k.upper(), [Decimal(p) for p in v]) for k, v in (script or {}).items())
+        self.unknown = set(s.upper() for s in unknown)
+        self.started = time.time()
+        self.prices = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def price(self, symbol):
+        step = int((time.time() - self.started) / self.tick)
+        if symbol in self.script:
+            prices = self.script[symbol]
+            return prices[step % len(prices)]
+
+        with self._lock:
+            last_step, price = self.prices.get(symbol, (0, None))
+            if price is None:
+                price = Decimal(10 + zlib.crc32(symbol) % 200)
+            for i in range(last_step, step):
+                price *= Decimal(1 + random.gauss(0, self.volatility))
+            price = max(price, Decimal('0.01')).quantize(Decimal('0.01'))
+            self.prices[symbol] = (step, price)
+            return price
+
+    def quote(self, symbol):
+        symbol = symbol.upper()
+        with self._lock:
+            self.calls[symbol] = self.calls.get(symbol, 0) + 1
+        if not symbol.isalpha():
+            return {'message': '404: Not Found'}
+        if symbol in self.unknown:
+            return {'status': 'error', 'msg': 'Symbol not found'}
+
+        price = self.price(symbol)
+        return {
+            'symbol': symbol,
+            'name': '{0} Inc'.format(symbol),
+            'industry': 'Fake Industry',
+            'exchange': 'FAKE',
+            'sector': 'Fake Sector',
+            'price': str(price),
+            'ask': str(price),
+            'bid': str(price - Decimal('0.01')),
+            'asksize': '100000',
+            'bidsize': '100000',
+            'volume': str(sum(self.calls.values())),
+        }
+
+    def stats(self):
+        with self._lock:
+            return {'calls': sum(self.calls.values()), 'symbols': dict(self.calls)}
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+
+        if path == '/_stats':
+            return self.send_json(200, server.market.stats())
+        if path == '/_reset':
+            server.market.reset()
+            return self.send_json(200, {})
+        if not path.startswith('/stock/'):
+            return self.send_json(404, {'message': '404: Not Found'})
+
+        time.sleep(max(0, random.gauss(server.latency, server.jitter)) / 1000.0)
+        if random.random() < server.error_rate:
+            return self.send_json(503, {'message': 'Service Unavailable'})
+        self.send_json(200, server.market.quote(path[len('/stock/'):]))
+
+    def send_json(self, status, content):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Command(BaseCommand):
+    help = ('Runs a local stand-in of data.benzinga.com/stock/<symbol>, '
+            'point settings.BENZINGA_API_URL (or $BENZINGA_API_URL) to http://HOST:PORT/stock/. '
+            'GET /_stats returns upstream call counts, GET /_reset clears them.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host', default='127.0.0.1'),
+        make_option('--port', type='int', default=8100),
+        make_option('--latency', type='float', default=50.0,
+                    help='Mean latency in ms'),
+        make_option('--jitter', type='float', default=10.0,
+                    help='Standard deviation of latency in ms'),
+        make_option('--error-rate', type='float', default=0.0,
+                    help='Share of requests answered with 503'),
+        make_option('--tick', type='float', default=1.0,
+                    help='Seconds between price changes'),
+        make_option('--volatility', type='float', default=0.001,
+                    help='Standard deviation of random walk per tick'),
+        make_option('--drift-script', default=None,
+                    help='JSON file of {symbol: [price, ...]} to replay'),
+        make_option('--unknown', action='append', default=[],
+                    help='Symbol answered as not found, can be given several times'),
+        make_option('--seed', type='int', default=None),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        script = None
+        if options['drift_script']:
+            with open(options['drift_script']) as f:
+                script = json.load(f)
+
+        server = FakeServer((options['host'], options['port']), Handler)
+        server.market = Market(
+            tick=options['tick'], volatility=options['volatility'],
+            script=script, unknown=options['unknown'])
+        server.latency = options['latency']
+        server.jitter = options['jitter']
+        server.error_rate = options['error_rate']
+        server.verbose = int(options['verbosity']) > 1
+
+        self.stdout.write('Fake Benzinga on http://{0}:{1}/stock/'.format(options['host'], options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
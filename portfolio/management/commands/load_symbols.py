@@ -0,0 +1,62 @@
+import csv
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from portfolio.models import Stock
+from portfolio.symbols import reset_symbol_index
+
+FIELDS = ('symbol', 'name', 'industry', 'exchange')
+
+
+class Command(BaseCommand):
+    args = '<csv file>'
+    help = ('Loads a symbol master csv file with header symbol,name,industry,exchange. '
+            'New symbols are inserted in bulk, existing ones are updated if they changed.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: load_symbols <csv file>')
+
+        with open(args[0], 'rb') as f:
+            reader = csv.DictReader(f)
+            missing = set(FIELDS) - set(reader.fieldnames or [])
+            if missing:
+                raise CommandError('Missing columns: {0}'.format(', '.join(sorted(missing))))
+            rows = {}
+            for row in reader:
+                values = dict(
+                    (field, row[field].decode('utf-8').strip()[:Stock._meta.get_field(field).max_length])
+                    for field in FIELDS)
+                values['symbol'] = values['symbol'].upper()
+                if values['symbol']:
+                    rows[values['symbol']] = values
+
+        created = updated = 0
+        symbols = sorted(rows)
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            for start in range(0, len(symbols), batch_size):
+                batch = symbols[start:start + batch_size]
+                existing = dict(
+                    (values[0], values)
+                    for values in Stock.objects.filter(symbol__in=batch).values_list(*(FIELDS + ('listed',))))
+
+                Stock.objects.bulk_create([
+                    Stock(listed=True, **rows[symbol]) for symbol in batch if symbol not in existing])
+                created += len(batch) - len(existing)
+
+                # stocks created from quotes before the master was loaded get listed too
+                for symbol, values in existing.items():
+                    if values != tuple(rows[symbol][field] for field in FIELDS) + (True,):
+                        Stock.objects.filter(symbol=symbol).update(listed=True, **rows[symbol])
+                        updated += 1
+
+        reset_symbol_index()
+        self.stdout.write('{0} symbols created, {1} updated, {2} unchanged'.format(
+            created, updated, len(symbols) - created - updated))
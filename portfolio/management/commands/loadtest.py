@@ -0,0 +1,172 @@
+import random
+import re
+import threading
+import time
+from optparse import make_option
+
+import requests
+
+from django.core.management.base import BaseCommand, CommandError
+
+ASK_RE = re.compile(r'id="ask-price">([0-9.]+)<')
+BID_RE = re.compile(r'id="bid-price">([0-9.]+)<')
+QUERIES_RE = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = {}
+        self.queries = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, step, latency, response):
+        with self._lock:
+            self.latencies.setdefault(step, []).append(latency)
+            queries = QUERIES_RE.search(response.headers.get('Server-Timing', ''))
+            if queries:
+                self.queries.append(int(queries.group(1)))
+            if response.status_code >= 400:
+                self.errors += 1
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+
+    @property
+    def count(self):
+        return sum(len(v) for v in self.latencies.values())
+
+
+class User(threading.Thread):
+    """
+    login -> (search -> buy -> sell) until deadline
+    """
+
+    def __init__(self, number, url, symbols, quantity, deadline, stats):
+        super(User, self).__init__()
+        self.daemon = True
+        self.username = 'loadtest{0}'.format(number)
+        self.url = url.rstrip('/')
+        self.symbols = symbols
+        self.quantity = quantity
+        self.deadline = deadline
+        self.stats = stats
+        self.session = requests.Session()
+
+    def request(self, step, path, method='get', **kwargs):
+        start = time.time()
+        try:
+            response = getattr(self.session, method)(self.url + path, allow_redirects=False, **kwargs)
+        except requests.RequestException:
+            self.stats.add_error()
+            raise
+        self.stats.add(step, (time.time() - start) * 1000, response)
+        return response
+
+    def login(self):
+        self.request('login_form', '/login/')
+        self.request('login', '/login/', method='post', data={
+            'username': self.username,
+            'csrfmiddlewaretoken': self.session.cookies.get('csrftoken', ''),
+        })
+
+    def run(self):
+        try:
+            self.login()
+        except requests.RequestException:
+            return
+        while time.time() < self.deadline:
+            try:
+                self.flow()
+            except requests.RequestException:
+                time.sleep(0.1)
+
+    def flow(self):
+        symbol = random.choice(self.symbols)
+        page = self.request('search', '/?symbol=' + symbol).text
+        ask = ASK_RE.search(page)
+        if ask:
+            self.request('buy', '/buy/{0}/{1}/{2}/'.format(symbol, self.quantity, ask.group(1)))
+        page = self.request('index', '/?symbol=' + symbol).text
+        bid = BID_RE.search(page)
+        if bid:
+            self.request('sell', '/sell/{0}/{1}/{2}/'.format(symbol, self.quantity, bid.group(1)))
+
+
+class Command(BaseCommand):
+    help = ('Drives login -> search -> buy -> sell flows against a running server and reports '
+            'requests/sec, latency percentiles, DB queries and upstream calls per request. '
+            'DB queries are read from Server-Timing headers. Run the server with BENZINGA_API_URL pointing '
+            'to fake_benzinga, e.g.\n'
+            '  python manage.py fake_benzinga --port 8100 &\n'
+            '  BENZINGA_API_URL=http://127.0.0.1:8100/stock/ gunicorn benzinga.wsgi &\n'
+            '  python manage.py loadtest --url http://127.0.0.1:8000 --fake-url http://127.0.0.1:8100')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--url', default='http://127.0.0.1:8000'),
+        make_option('--fake-url', default='http://127.0.0.1:8100',
+                    help='fake_benzinga server, to count upstream calls'),
+        make_option('--concurrency', type='int', default=10),
+        make_option('--duration', type='float', default=30.0,
+                    help='Seconds'),
+        make_option('--symbols', default='F,GM,AAPL,MSFT,IBM',
+                    help='Comma separated symbols, a few hot ones is the realistic case'),
+        make_option('--quantity', type='int', default=1),
+    )
+
+    def upstream_calls(self, fake_url):
+        try:
+            return requests.get(fake_url.rstrip('/') + '/_stats').json()['calls']
+        except requests.RequestException:
+            return None
+
+    def handle(self, *args, **options):
+        symbols = [s.strip().upper() for s in options['symbols'].split(',') if s.strip()]
+        if not symbols:
+            raise CommandError('No symbols')
+
+        stats = Stats()
+        calls_before = self.upstream_calls(options['fake_url'])
+        start = time.time()
+        deadline = start + options['duration']
+        users = [
+            User(i, options['url'], symbols, options['quantity'], deadline, stats)
+            for i in range(options['concurrency'])]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.time() - start
+        calls_after = self.upstream_calls(options['fake_url'])
+
+        self.stdout.write('{0} requests in {1:.1f}s, {2:.1f} requests/sec, {3} errors'.format(
+            stats.count, elapsed, stats.count / elapsed, stats.errors))
+        self.stdout.write('{0:<12}{1:>8}{2:>10}{3:>10}{4:>10}'.format('step', 'count', 'p50 ms', 'p90 ms', 'p99 ms'))
+        all_latencies = []
+        for step, latencies in sorted(stats.latencies.items()):
+            all_latencies.extend(latencies)
+            self.stdout.write('{0:<12}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10.1f}'.format(
+                step, len(latencies), percentile(latencies, 50),
+                percentile(latencies, 90), percentile(latencies, 99)))
+        self.stdout.write('{0:<12}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10.1f}'.format(
+            'all', len(all_latencies), percentile(all_latencies, 50),
+            percentile(all_latencies, 90), percentile(all_latencies, 99)))
+
+        if stats.queries:
+            self.stdout.write('DB queries per request: {0:.2f}'.format(
+                float(sum(stats.queries)) / len(stats.queries)))
+        else:
+            self.stdout.write('DB queries per request: unknown, no Server-Timing headers')
+        if calls_before is not None and calls_after is not None and stats.count:
+            self.stdout.write('Upstream calls per request: {0:.3f}'.format(
+                float(calls_after - calls_before) / stats.count))
+        else:
+            self.stdout.write('Upstream calls per request: unknown, cannot reach --fake-url')
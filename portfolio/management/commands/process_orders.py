@@ -0,0 +1,38 @@
+import threading
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from portfolio.orderqueue import work
+
+
+class Command(BaseCommand):
+    help = ('Executes orders queued with ASYNC_ORDERS on, '
+            'a few threads each claiming a batch of orders at a time.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=None,
+                    help='Worker threads, defaults to ORDER_QUEUE_WORKERS'),
+        make_option('--batch-size', type='int', default=None,
+                    help='Orders per transaction, defaults to ORDER_QUEUE_BATCH_SIZE'),
+    )
+
+    def handle(self, *args, **options):
+        count = options['threads'] or getattr(settings, 'ORDER_QUEUE_WORKERS', 2)
+        stop = threading.Event()
+        threads = [threading.Thread(target=work, kwargs={'batch_size': options['batch_size'], 'stop': stop})
+                   for i in range(count)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self.stdout.write('Started {0} order workers'.format(count))
+        try:
+            # join() can not be interrupted by ctrl-c in python 2
+            while any(t.is_alive() for t in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            stop.set()
+            for t in threads:
+                t.join()
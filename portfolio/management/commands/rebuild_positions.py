@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.positions import rebuild_positions, check_positions
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds Position table from HoldingStock lots, or only checks it with --check'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', default=False,
+                    help='Only report positions which do not match their lots'),
+        make_option('--account', action='append', dest='accounts', type='int',
+                    help='Account id, can be given several times'),
+    )
+
+    def handle(self, *args, **options):
+        accounts = options['accounts']
+
+        if options['check']:
+            mismatches = check_positions(accounts)
+            for account_id, stock_id, expected, actual in mismatches:
+                self.stdout.write('account {0} stock {1}: lots {2}, position {3}'.format(
+                    account_id, stock_id, expected, actual))
+            if mismatches:
+                raise CommandError('{0} positions are inconsistent'.format(len(mismatches)))
+            self.stdout.write('All positions are consistent')
+            return
+
+        count = rebuild_positions(accounts)
+        self.stdout.write('Rebuilt {0} positions'.format(count))
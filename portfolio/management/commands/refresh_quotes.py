@@ -0,0 +1,62 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from portfolio.cache import quote_cache, hot_symbols
+from portfolio.models import Position
+from portfolio.orderbook import order_books
+from portfolio.utils import refresh_many
+
+
+def hot_set():
+    """
+    Symbols held by any account, symbols with open limit orders
+    plus symbols searched or traded recently
+    """
+    held = Position.objects.values_list('stock__symbol', flat=True).distinct()
+    return sorted(set(s.upper() for s in held) | set(order_books.symbols()) | set(hot_symbols.symbols()))
+
+
+class Command(BaseCommand):
+    help = ('Keeps quotes of the hot symbol set fresh in the shared quote cache, '
+            'so web requests rarely wait on Benzinga, and fills limit orders they cross. '
+            'Runs as the worker process.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', default=None,
+                    help='Seconds between refreshes, should be below QUOTE_CACHE_TTL'),
+        make_option('--batch-size', type='int', default=None),
+        make_option('--once', action='store_true', default=False,
+                    help='Refresh once and exit'),
+    )
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or getattr(settings, 'QUOTE_REFRESH_INTERVAL', 1.0)
+        batch_size = options['batch_size'] or getattr(settings, 'QUOTE_REFRESH_BATCH_SIZE', 50)
+        reload_interval = getattr(settings, 'LIMIT_ORDER_RELOAD_INTERVAL', 60)
+        verbose = int(options['verbosity']) > 1
+        loaded_at = 0
+
+        while True:
+            start = time.time()
+            if start - loaded_at >= reload_interval:
+                order_books.load()
+                loaded_at = start
+            else:
+                order_books.sync()
+            symbols = hot_set()
+            failed = filled = 0
+            for i in range(0, len(symbols), batch_size):
+                quotes, errors = refresh_many(symbols[i:i + batch_size], deadline=interval)
+                failed += len(errors)
+                filled += order_books.on_quotes(quotes)
+            if verbose:
+                self.stdout.write('Refreshed {0} symbols, {1} failed, {2} limit orders filled in {3:.2f}s, '
+                                  'cache {4}'.format(len(symbols), failed, filled, time.time() - start,
+                                                     quote_cache.stats()))
+
+            if options['once']:
+                return
+            time.sleep(max(0, interval - (time.time() - start)))
@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from portfolio.ledger import take_snapshot
+from portfolio.models import Account
+
+
+class Command(BaseCommand):
+    help = ('Snapshots cash and lots of accounts which made enough orders since their latest snapshot, '
+            'so ledger replays only the tail. Run it periodically.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--min-orders', type='int', default=None,
+                    help='Orders since the latest snapshot, defaults to LEDGER_SNAPSHOT_EVERY'),
+        make_option('--account', action='append', dest='accounts', type='int',
+                    help='Account id, can be given several times'),
+    )
+
+    def handle(self, *args, **options):
+        min_orders = options['min_orders'] or getattr(settings, 'LEDGER_SNAPSHOT_EVERY', 500)
+        accounts = Account.objects.order_by('id')
+        if options['accounts']:
+            accounts = accounts.filter(pk__in=options['accounts'])
+
+        count = 0
+        for account in accounts.iterator():
+            if take_snapshot(account, min_orders) is not None:
+                count += 1
+        self.stdout.write('Took {0} snapshots'.format(count))
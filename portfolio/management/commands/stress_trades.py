@@ -0,0 +1,101 @@
+import os
+import tempfile
+import threading
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from portfolio.exceptions import NotEnoughStockInHands, NotEnoughFundExceptin
+from portfolio.models import Account, Stock, Order, BUY, SELL
+from portfolio.positions import check_positions
+from portfolio.quotes import Quote
+
+QUOTE = Quote.from_json({
+    'symbol': 'STRESS',
+    'name': 'Stress Test',
+    'industry': 'Testing',
+    'exchange': 'TEST',
+    'ask': '10.00',
+    'bid': '10.00',
+    'asksize': '1000000',
+    'bidsize': '1000000',
+})
+
+
+class Command(BaseCommand):
+    help = ('Runs concurrent buys and sells on one account without calling Benzinga, '
+            'then checks no update was lost and reports trades/sec. '
+            'Runs against a test database created and destroyed like the test runner does. '
+            'Use a database with row locks (e.g. PostgreSQL), SQLite serializes writers.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=8),
+        make_option('--trades', type='int', default=200,
+                    help='Trades per thread'),
+        make_option('--username', default='stress-test'),
+    )
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite' and not connection.settings_dict.get('TEST_NAME'):
+            # every thread has its own connection, and every connection to :memory: its own database
+            connection.settings_dict['TEST_NAME'] = os.path.join(tempfile.gettempdir(), 'stress_trades.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.stress(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def stress(self, options):
+        stock = Stock.get_stock_from_quote(QUOTE)
+        account = Account.objects.create(username=options['username'])
+
+        price = QUOTE.ask
+        errors = []
+
+        def trader(n):
+            try:
+                # every thread works on its own stale copy, like gunicorn workers do
+                me = Account.objects.get(pk=account.pk)
+                for i in range(options['trades']):
+                    try:
+                        if (n + i) % 2:
+                            me.buy(stock, 1, price, QUOTE)
+                        else:
+                            me.sell(stock, 1, price, QUOTE)
+                    except (NotEnoughStockInHands, NotEnoughFundExceptin):
+                        pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=trader, args=(n,)) for n in range(options['threads'])]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        orders = Order.objects.filter(account=account)
+        bought = orders.filter(type=BUY).count()
+        sold = orders.filter(type=SELL).count()
+        expected = settings.INIT_CACHE - (bought - sold) * price
+        amount = Account.objects.get(pk=account.pk).amount
+
+        self.stdout.write('{0} trades in {1:.2f}s, {2:.1f} trades/sec, {3} errors'.format(
+            bought + sold, elapsed, (bought + sold) / elapsed, len(errors)))
+        for e in errors[:5]:
+            self.stdout.write('  {0!r}'.format(e))
+        self.stdout.write('amount {0}, expected {1}'.format(amount, expected))
+
+        mismatches = check_positions([account.pk])
+        if errors:
+            raise CommandError('Trades failed')
+        if amount != expected or mismatches:
+            raise CommandError('Lost updates detected, positions: {0}'.format(mismatches))
+        self.stdout.write('No lost updates')
@@ -0,0 +1,26 @@
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.ledger import verify_accounts
+
+
+class Command(BaseCommand):
+    help = ('Replays the order log of every account and reports accounts whose cash or lots '
+            'do not match, accounts are verified in parallel processes')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=multiprocessing.cpu_count()),
+        make_option('--account', action='append', dest='accounts', type='int',
+                    help='Account id, can be given several times'),
+    )
+
+    def handle(self, *args, **options):
+        mismatches = verify_accounts(options['accounts'], processes=options['processes'])
+        for account_id, problems in sorted(mismatches.items()):
+            for problem in problems:
+                self.stdout.write('account {0}: {1}'.format(account_id, problem))
+        if mismatches:
+            raise CommandError('{0} accounts do not match their orders'.format(len(mismatches)))
+        self.stdout.write('All accounts match their orders')
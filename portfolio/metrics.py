@@ -0,0 +1,208 @@
+"""
+Request timings by view, kept as Prometheus histograms
+
+Every request gets a RequestTimings in a thread local. Upstream calls,
+DB queries and template rendering add to it, PerformanceMiddleware puts it
+into the histograms and the Server-Timing header.
+
+Histograms live in the process, so with several gunicorn workers
+each scrape of /metrics sees one worker.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, view='other'):
+        with self._lock:
+            values = self._values.get(view)
+            if values is None:
+                values = self._values[view] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def render(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help),
+            '# TYPE {0} histogram'.format(self.name),
+        ]
+        with self._lock:
+            items = sorted((view, list(values)) for view, values in self._values.items())
+        for view, values in items:
+            for bound, count in zip(self.buckets, values):
+                lines.append('{0}_bucket{{view="{1}",le="{2}"}} {3}'.format(self.name, view, bound, count))
+            lines.append('{0}_bucket{{view="{1}",le="+Inf"}} {2}'.format(self.name, view, values[-1]))
+            lines.append('{0}_sum{{view="{1}"}} {2}'.format(self.name, view, values[-2]))
+            lines.append('{0}_count{{view="{1}"}} {2}'.format(self.name, view, values[-1]))
+        return '\n'.join(lines)
+
+
+REQUEST = Histogram('portfolio_request_seconds', 'Time spent in a request')
+UPSTREAM = Histogram('portfolio_upstream_seconds', 'Time spent in Benzinga calls per request')
+UPSTREAM_CALLS = Histogram('portfolio_upstream_calls', 'Benzinga calls per request', COUNT_BUCKETS)
+DB = Histogram('portfolio_db_seconds', 'Time spent in DB queries per request')
+DB_QUERIES = Histogram('portfolio_db_queries', 'DB queries per request', COUNT_BUCKETS)
+RENDER = Histogram('portfolio_render_seconds', 'Time spent rendering templates per request')
+HISTOGRAMS = (REQUEST, UPSTREAM, UPSTREAM_CALLS, DB, DB_QUERIES, RENDER)
+
+
+class RequestTimings(object):
+    """
+    {kind: [count, seconds]}, kinds are upstream, db and render
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.view = 'other'
+        self.timings = {}
+        # lookup_many adds from pool threads
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds):
+        with self._lock:
+            timing = self.timings.setdefault(kind, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+
+    def get(self, kind):
+        return self.timings.get(kind, (0, 0.0))
+
+
+_local = threading.local()
+
+
+def begin():
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def end():
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings
+
+
+def current():
+    return getattr(_local, 'timings', None)
+
+
+def record(kind, seconds):
+    timings = current()
+    if timings is not None:
+        timings.add(kind, seconds)
+
+
+@contextmanager
+def timer(kind):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(kind, time.time() - start)
+
+
+def bind(func):
+    """
+    Wraps func so it records into the caller's request, for pool threads
+    """
+    timings = current()
+
+    def bound(*args, **kwargs):
+        _local.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timings = None
+    return bound
+
+
+def observe(timings):
+    total = time.time() - timings.start
+    view = timings.view
+    REQUEST.observe(total, view)
+    for kind, histogram, count_histogram in (('upstream', UPSTREAM, UPSTREAM_CALLS), ('db', DB, DB_QUERIES)):
+        count, seconds = timings.get(kind)
+        histogram.observe(seconds, view)
+        count_histogram.observe(count, view)
+    RENDER.observe(timings.get('render')[1], view)
+    return total
+
+
+def render(counters=None):
+    """
+    Prometheus text format of all histograms,
+    counters is {name: {label: value}} of extra counters
+    """
+    blocks = [histogram.render() for histogram in HISTOGRAMS]
+    for name, values in sorted((counters or {}).items()):
+        lines = ['# TYPE {0} counter'.format(name)]
+        for label, value in sorted(values.items()):
+            lines.append('{0}{{{1}}} {2}'.format(name, label, value))
+        blocks.append('\n'.join(lines))
+    return '\n'.join(blocks) + '\n'
+
+
+def server_timing(timings, total):
+    upstream_calls, upstream = timings.get('upstream')
+    queries, db = timings.get('db')
+    return ', '.join([
+        'upstream;dur={0:.1f};desc="{1} calls"'.format(upstream * 1000, upstream_calls),
+        'db;dur={0:.1f};desc="{1} queries"'.format(db * 1000, queries),
+        'render;dur={0:.1f}'.format(timings.get('render')[1] * 1000),
+        'total;dur={0:.1f}'.format(total * 1000),
+    ])
+
+
+class TimedCursor(object):
+    """
+    Times execute and executemany of a cursor into the current request
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=None):
+        with timer('db'):
+            return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        with timer('db'):
+            return self.cursor.executemany(sql, param_list)
+
+
+def instrument(connection):
+    """
+    Makes connection time every query, under Django's own cursor wrappers
+    so DEBUG query logging keeps working
+    Connections are per thread, so this is called for every request
+    """
+    if getattr(connection, '_timed', False):
+        return
+    create_cursor = connection.create_cursor
+
+    def timed_create_cursor():
+        return TimedCursor(create_cursor())
+
+    connection.create_cursor = timed_create_cursor
+    connection._timed = True
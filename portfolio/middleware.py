@@ -1,9 +1,13 @@
+import time
 from urllib import urlencode
 
+from django.db import connection
 from django.http import HttpResponseRedirect
 from django.contrib import messages
 from django.shortcuts import redirect
 
+from . import metrics
+
 
 class StockExceptionMiddleware(object):
     """
@@ -23,3 +27,37 @@ class GETQueryStringRedirectMiddleware(object):
         if isinstance(response, HttpResponseRedirect) and request.GET:
             response['Location'] += '?' + urlencode(request.GET)
         return response
+
+
+class PerformanceMiddleware(object):
+    """
+    Times upstream calls, DB queries and template rendering of every request,
+    tagged by view module and name, into histograms served on /metrics
+    and into a Server-Timing header
+    Should be the first middleware, so it sees the whole request
+    """
+    def process_request(self, request):
+        metrics.instrument(connection)
+        metrics.begin()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timings = metrics.current()
+        if timings is not None:
+            # views.buy and api.buy are different views
+            timings.view = '{0}.{1}'.format(
+                getattr(view_func, '__module__', None), getattr(view_func, '__name__', 'other'))
+
+    def process_template_response(self, request, response):
+        start = time.time()
+
+        def rendered(response):
+            metrics.record('render', time.time() - start)
+        response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        timings = metrics.end()
+        if timings is not None:
+            total = metrics.observe(timings)
+            response['Server-Timing'] = metrics.server_timing(timings, total)
+        return response
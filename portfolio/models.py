@@ -1,14 +1,16 @@
 from decimal import Decimal
 
 from django.db import models, transaction
-from django.db.models import Sum
+from django.db.models import F, Q
 from django.conf import settings
+from django.core.cache import cache
 
 from .utils import lookup as benzinga_lookup
+from .cache import account_cache
+from .lots import LOT_POLICIES, LOT_ORDERINGS, match_lots
 from .exceptions import (
     PriceChangedException, NotEnoughStockInMarket, NotEnoughStockInHands,
-    CannotFindStockException, EmptySymbolException, NotEnoughFundExceptin,
-    NegativeQuantityException)
+    NotEnoughFundExceptin, NegativeQuantityException, StaleQuoteException)
 
 BUY = 'B'
 SELL = 'S'
@@ -19,39 +21,33 @@ ORDER_TYPES = (
 
 
 class Stock(models.Model):
-    symbol = models.CharField(max_length=8)
+    symbol = models.CharField(max_length=8, unique=True)
     name = models.CharField(max_length=32, blank=True)
     industry = models.CharField(max_length=32, blank=True)
     exchange = models.CharField(max_length=16, blank=True)
+    # loaded from the symbol master by load_symbols,
+    # stocks created from quotes are not listed
+    listed = models.BooleanField(default=False, db_index=True)
 
     def __unicode(self):
         return u'{0}: {1}'.format(self.name, self.symbol)
 
     @staticmethod
-    def get_stock_from_json(json):
+    def get_stock_from_quote(quote):
         """
         Create Stock instance if it's not in our db
         and returns it
         """
-        if 'status' in json:
-            # json is not valid
-            raise CannotFindStockException('Cannot find stock')
-        if 'message' in json:
-            # json is not valid
-            raise EmptySymbolException('Cannot find stock')
-        if not json['industry'] or not json['exchange']:
-            # APPL has several null fields
-            # do know why, but we raise error
-            raise CannotFindStockException('Cannot find stock')
-
-        stock, created = Stock.objects.get_or_create(symbol=json['symbol'])
+        quote.check()
+
+        stock, created = Stock.objects.get_or_create(symbol=quote.symbol)
         if created:
             # we only update stock information when we create a Stock instance
             # if these fields change very often,
             # we should update them in cron jobs maybe
-            stock.name = json['name']
-            stock.industry = json['industry']
-            stock.exchange = json['exchange']
+            stock.name = quote.name
+            stock.industry = quote.industry
+            stock.exchange = quote.exchange
             stock.save()
         return stock
 
@@ -60,25 +56,55 @@ class Account(models.Model):
     """
     A simple user account implementation
     """
-    username = models.CharField(max_length=32)
+    username = models.CharField(max_length=32, unique=True)
     amount = models.DecimalField(max_digits=8, decimal_places=2, default=settings.INIT_CACHE)
+    # which lots are sold first, see lots.py
+    lot_policy = models.CharField(max_length=1, choices=LOT_POLICIES, default=settings.DEFAULT_LOT_POLICY)
+    # incremented whenever cash or holdings change, API ETags are built from it
+    version = models.PositiveIntegerField(default=0)
 
     def __unicode(self):
         return u'{0}: {1}'.format(self.username, self.amount)
 
-    def buy(self, stock, quantity, price, json=None):
+    CACHED_FIELDS = ('id', 'username', 'amount', 'lot_policy', 'version')
+
+    @staticmethod
+    def get_cached(username):
         """
-        Buy stock
+        Returns an Account from account cache, its amount may be stale
+        so it must not be used to buy or sell
         """
-        self._sync(BUY, stock, quantity, price, json=None)
+        def load(username):
+            return Account.objects.filter(username=username).values(*Account.CACHED_FIELDS).get()
+        return Account(**account_cache.get(username, load))
+
+    def invalidate_cache(self):
+        account_cache.invalidate(self.username)
 
-        # first check if we have enough fund to buy
-        if quantity * price > self.amount:
+    def change_amount(self, delta):
+        """
+        Adds delta to amount in DB with one conditional UPDATE,
+        so concurrent trades never lose updates and amount never goes negative
+        Should be called in a transaction, the account row is locked until it ends
+        """
+        accounts = Account.objects.filter(pk=self.pk)
+        if delta < 0:
+            accounts = accounts.filter(amount__gte=-delta)
+        if not accounts.update(amount=F('amount') + delta, version=F('version') + 1):
             raise NotEnoughFundExceptin('You do not have enough money')
+        self.amount += delta
+        self.version += 1
 
+    def buy(self, stock, quantity, price, quote=None):
+        """
+        Buy stock
+        """
+        self._sync(BUY, stock, quantity, price, quote=quote)
+
+        # locks are taken in the same order everywhere, account then position
         with transaction.atomic():
-            self.amount -= price * quantity
-            self.save()
+            # checks fund and takes money at once
+            self.change_amount(-price * quantity)
 
             # create Order log
             Order.objects.create(
@@ -95,26 +121,31 @@ class Account(models.Model):
                 quantity=quantity,
                 price=price)
 
-    def sell(self, stock, quantity, price, json=None):
+            Position.add(self, stock, quantity, price * quantity)
+
+        self.invalidate_cache()
+        LeaderboardEntry.record_trades(self, [(stock.symbol, quantity, price)])
+
+    def sell(self, stock, quantity, price, quote=None):
         """
         Sell stock
         """
-        self._sync(SELL, stock, quantity, price, json=None)
+        self._sync(SELL, stock, quantity, price, quote=quote)
 
-        # first check if we have enough stock to sell
-        sum = HoldingStock.objects.filter(stock=stock).\
-            aggregate(Sum('quantity'))['quantity__sum']
-
-        if sum < quantity:
+        # first check if we have enough stock to sell, without any lock
+        if Position.quantity_of(self, stock) < quantity:
             raise NotEnoughStockInHands('You do not have enough stocks')
 
+        # locks are taken in the same order everywhere, account then position
         with transaction.atomic():
+            self.change_amount(price * quantity)
 
-            self.amount += price * quantity
-            self.save()
+            # check again, concurrent sells wait for this lock
+            if Position.quantity_of(self, stock, lock=True) < quantity:
+                raise NotEnoughStockInHands('You do not have enough stocks')
 
             # create Order log
-            Order.objects.create(
+            order = Order.objects.create(
                 account=self,
                 stock=stock,
                 quantity=quantity,
@@ -122,18 +153,14 @@ class Account(models.Model):
                 type=SELL)
 
             # update HoldingStock
-            hss = HoldingStock.objects.filter(stock=stock).order_by('-price')
+            match = HoldingStock.close(self, stock, quantity, order)
 
-            for hs in hss:
-                if hs.quantity <= quantity:
-                    quantity -= hs.quantity
-                    hs.delete()
-                    break
+            Position.add(self, stock, -quantity, -match.cost)
 
-                hs.quantity = hs.quantity - quantity
-                hs.save()
+        self.invalidate_cache()
+        LeaderboardEntry.record_trades(self, [(stock.symbol, -quantity, price)])
 
-    def _sync(self, type, stock, quantity, price, json=None):
+    def _sync(self, type, stock, quantity, price, quote=None):
         """
         Before buy or sell stock,
         we double check latest price and quantity from Benzinga
@@ -150,13 +177,16 @@ class Account(models.Model):
         price_name = {BUY: 'ask', SELL: 'bid'}[type]
         quantity_name = {BUY: 'asksize', SELL: 'bidsize'}[type]
 
-        if json is None:
-            json = benzinga_lookup(stock.symbol)
+        if quote is None:
+            quote = benzinga_lookup(stock.symbol, fields=(price_name, quantity_name))
 
-        if Decimal(json[price_name]) != price:
+        if quote.stale:
+            raise StaleQuoteException('Benzinga is unavailable, cannot trade on an old price')
+
+        if getattr(quote, price_name) != price:
             raise PriceChangedException('Price changes, please refetch new price')
 
-        if int(json[quantity_name]) < quantity:
+        if getattr(quote, quantity_name) < quantity:
             # not enough stock to provide
             raise NotEnoughStockInMarket('There is not enough stocks in the market')
         return stock
@@ -174,6 +204,10 @@ class Order(models.Model):
 
     type = models.CharField(max_length=1, choices=ORDER_TYPES)
 
+    class Meta:
+        # order history of an account
+        index_together = [('account', 'created_at')]
+
 
 class HoldingStock(models.Model):
     """
@@ -184,3 +218,253 @@ class HoldingStock(models.Model):
     stock = models.ForeignKey('portfolio.Stock')
     quantity = models.PositiveIntegerField()
     price = models.DecimalField(max_digits=8, decimal_places=4)
+
+    class Meta:
+        # lots matched by a sell, ordered by price
+        index_together = [('account', 'stock', 'price')]
+
+    @staticmethod
+    def close(account, stock, quantity, order, policy=None):
+        """
+        Consumes lots of stock for a sell order by account's lot policy
+        and records them as `LotClose`
+        Takes a fixed number of queries however many lots are closed
+        """
+        lots = HoldingStock.objects.filter(account=account, stock=stock).\
+            order_by(*LOT_ORDERINGS[policy or account.lot_policy]).\
+            values_list('id', 'quantity', 'price')
+
+        match = match_lots(lots, quantity)
+        if match.left:
+            raise NotEnoughStockInHands('You do not have enough stocks')
+
+        if match.closed:
+            HoldingStock.objects.filter(id__in=[lot[0] for lot in match.closed]).delete()
+        if match.partial:
+            lot_id, sold, price = match.partial
+            HoldingStock.objects.filter(id=lot_id).update(quantity=F('quantity') - sold)
+
+        LotClose.objects.bulk_create([
+            LotClose(order=order, lot_id=lot_id, quantity=sold, price=price)
+            for lot_id, sold, price in match.consumed])
+        return match
+
+
+class LotClose(models.Model):
+    """
+    Which lot a sell order closed, and for how much
+    lot_id is kept as a plain id because lots are deleted once sold out
+    """
+    order = models.ForeignKey('portfolio.Order', related_name='closed_lots')
+    lot_id = models.IntegerField()
+    quantity = models.PositiveIntegerField()
+    # price paid for the lot
+    price = models.DecimalField(max_digits=8, decimal_places=4)
+
+    @property
+    def realized(self):
+        return (self.order.price - self.price) * self.quantity
+
+
+class Position(models.Model):
+    """
+    Total quantity and cost of one stock held by one account,
+    it's the sum of `HoldingStock` lots and is kept in sync by buy and sell
+    """
+    account = models.ForeignKey('portfolio.Account')
+    stock = models.ForeignKey('portfolio.Stock')
+    quantity = models.PositiveIntegerField(default=0)
+    cost = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+
+    class Meta:
+        unique_together = ('account', 'stock')
+
+    @property
+    def avg_price(self):
+        return self.cost / self.quantity if self.quantity else Decimal(0)
+
+    @staticmethod
+    def quantity_of(account, stock, lock=False):
+        """
+        lock=True locks the position row until the transaction ends
+        """
+        positions = Position.objects.select_for_update() if lock else Position.objects
+        quantities = positions.filter(account=account, stock=stock).\
+            values_list('quantity', flat=True)
+        return quantities[0] if quantities else 0
+
+    @staticmethod
+    def add(account, stock, quantity, cost):
+        """
+        Adds quantity and cost to the position, both can be negative
+        Should be called in the same transaction as the lots change
+        """
+        updated = Position.objects.filter(account=account, stock=stock).update(
+            quantity=F('quantity') + quantity, cost=F('cost') + cost)
+        if not updated:
+            Position.objects.create(account=account, stock=stock, quantity=quantity, cost=cost)
+        elif quantity < 0:
+            # do not keep empty positions
+            Position.objects.filter(account=account, stock=stock, quantity=0).delete()
+
+
+class LeaderboardEntry(models.Model):
+    """
+    Snapshot of account values, cash plus holdings at mark prices
+    Built by leaderboard.build_leaderboard, trades move values in between
+    Ranks are not stored, they are counted from values when read
+    """
+    MARKS_KEY = 'leaderboard:marks'
+
+    account = models.OneToOneField('portfolio.Account', related_name='leaderboard_entry')
+    value = models.DecimalField(max_digits=14, decimal_places=2)
+
+    class Meta:
+        # top N and rank of a value
+        index_together = [('value', 'account')]
+
+    @staticmethod
+    def record_trades(account, trades):
+        """
+        trades is a list of (symbol, quantity, price), quantity is negative for sells
+        Cash moves at trade price and holdings at mark price,
+        so the account value changes by quantity * (mark - price)
+        """
+        marks = cache.get(LeaderboardEntry.MARKS_KEY) or {}
+        delta = sum((quantity * (marks.get(symbol.upper(), price) - price)
+                     for symbol, quantity, price in trades), Decimal(0))
+        if delta:
+            LeaderboardEntry.move(account.pk, delta=delta)
+
+    @staticmethod
+    def move(account_id, delta=None, value=None):
+        """
+        Changes value of account by delta, or sets it to value
+        Only the account's own row is updated, so trades never wait on each other here
+        Accounts without entry are ranked on next build
+        """
+        entries = LeaderboardEntry.objects.filter(account_id=account_id)
+        return bool(entries.update(value=F('value') + delta if value is None else value))
+
+    def count_rank(self):
+        """
+        1 + accounts worth more, ties are ranked by account id
+        """
+        return LeaderboardEntry.objects.filter(
+            Q(value__gt=self.value) | Q(value=self.value, account_id__lt=self.account_id)).count() + 1
+
+
+class AccountSnapshot(models.Model):
+    """
+    Cash and open lots of an account right after one order,
+    replaying orders starts from the latest snapshot, see ledger.py
+    Orders are kept as plain ids, they may be archived
+    """
+    account = models.ForeignKey('portfolio.Account')
+    # (as_of, order_id) of the last order included
+    as_of = models.DateTimeField()
+    order_id = models.IntegerField()
+    amount = models.DecimalField(max_digits=14, decimal_places=4)
+    # json list of [lot_id, stock_id, quantity, price]
+    lots = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = [('account', 'as_of')]
+
+
+OPEN = 'O'
+FILLED = 'F'
+CANCELLED = 'C'
+REJECTED = 'R'
+LIMIT_ORDER_STATUSES = (
+    (OPEN, 'Open'),
+    (FILLED, 'Filled'),
+    (CANCELLED, 'Cancelled'),
+    (REJECTED, 'Rejected'),
+)
+
+
+class LimitOrder(models.Model):
+    """
+    Buy or sell order resting until the market reaches limit_price,
+    matched by orderbook.py
+    Funds and holdings are only checked when it's filled
+    """
+    account = models.ForeignKey('portfolio.Account')
+    stock = models.ForeignKey('portfolio.Stock')
+    type = models.CharField(max_length=1, choices=ORDER_TYPES)
+    quantity = models.PositiveIntegerField()
+    limit_price = models.DecimalField(max_digits=8, decimal_places=4)
+    status = models.CharField(max_length=1, choices=LIMIT_ORDER_STATUSES, default=OPEN)
+    fill_price = models.DecimalField(max_digits=8, decimal_places=4, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    filled_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # open orders loaded into order books, open orders of an account
+        index_together = [('status', 'id'), ('account', 'status')]
+
+    def cancel(self):
+        return bool(LimitOrder.objects.filter(pk=self.pk, status=OPEN).update(status=CANCELLED))
+
+
+class ArchivedOrderTotal(models.Model):
+    """
+    Amounts bought and sold per stock by orders moved to the archive,
+    analytics adds them to the live order log, see archive.py
+    """
+    account = models.ForeignKey('portfolio.Account')
+    stock = models.ForeignKey('portfolio.Stock')
+    bought = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+    sold = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+
+    class Meta:
+        unique_together = [('account', 'stock')]
+
+
+PENDING = 'P'
+RUNNING = 'R'
+EXECUTED = 'X'
+FAILED = 'E'
+QUEUED_ORDER_STATUSES = (
+    (PENDING, 'Pending'),
+    (RUNNING, 'Running'),
+    (EXECUTED, 'Executed'),
+    (FAILED, 'Failed'),
+)
+
+
+class QueuedOrder(models.Model):
+    """
+    Buy or sell submitted with ASYNC_ORDERS on,
+    executed by the process_orders worker, see orderqueue.py
+    """
+    account = models.ForeignKey('portfolio.Account')
+    # the stock may not exist until the order's quote is looked up
+    symbol = models.CharField(max_length=8)
+    type = models.CharField(max_length=1, choices=ORDER_TYPES)
+    quantity = models.PositiveIntegerField()
+    price = models.DecimalField(max_digits=8, decimal_places=4)
+    status = models.CharField(max_length=1, choices=QUEUED_ORDER_STATUSES, default=PENDING)
+    error = models.CharField(max_length=255, blank=True)
+    # token of the worker thread which claimed it
+    worker = models.CharField(max_length=32, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    executed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # claiming pending orders, orders of an account by status
+        index_together = [('status', 'id'), ('account', 'status')]
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'symbol': self.symbol,
+            'type': self.type,
+            'quantity': self.quantity,
+            'price': str(self.price),
+            'status': self.get_status_display().lower(),
+            'error': self.error or None,
+        }
@@ -0,0 +1,185 @@
+"""
+Per-symbol order books of resting limit orders
+
+Open `LimitOrder` rows are mirrored into one OrderBook per symbol, buys in
+a heap by highest limit, sells in a heap by lowest limit, oldest first at
+the same limit. Every quote update pops the crossing orders from the top,
+so a fill costs O(log n) however many orders rest in the book.
+
+A crossed order larger than the quoted size is parked in a heap by
+quantity and only goes back once a quote's size could fill it, at most
+MAX_SKIPPED orders are parked per quote, so huge marketable orders cost
+nothing while the size stays below them.
+
+Only one process should match, the refresh_quotes worker does it.
+Filling claims the row with a conditional UPDATE, so an order cancelled
+after it was loaded is skipped.
+"""
+import heapq
+import logging
+import threading
+
+from django.db import transaction
+from django.utils import timezone
+
+from .exceptions import (
+    PriceChangedException, NotEnoughStockInMarket, NotEnoughStockInHands,
+    NotEnoughFundExceptin, StaleQuoteException)
+from .models import LimitOrder, BUY, SELL, OPEN, FILLED, REJECTED
+
+logger = logging.getLogger(__name__)
+
+FILL_ERRORS = (
+    PriceChangedException, NotEnoughStockInMarket, NotEnoughStockInHands,
+    NotEnoughFundExceptin, StaleQuoteException)
+
+# crossed orders too large for the quote parked per match
+MAX_SKIPPED = 10
+
+
+class OrderBook(object):
+    def __init__(self, symbol):
+        self.symbol = symbol
+        # (-limit, id, quantity)
+        self._buys = []
+        # (limit, id, quantity)
+        self._sells = []
+        # parked orders larger than the quote, (quantity, limit key, id)
+        self._large_buys = []
+        self._large_sells = []
+
+    def __len__(self):
+        return len(self._buys) + len(self._sells) + len(self._large_buys) + len(self._large_sells)
+
+    def add(self, order_id, type, quantity, limit):
+        if type == BUY:
+            heapq.heappush(self._buys, (-limit, order_id, quantity))
+        else:
+            heapq.heappush(self._sells, (limit, order_id, quantity))
+
+    def match(self, quote):
+        """
+        Pops orders crossed by quote, best limit first,
+        buys fill at ask within asksize and sells at bid within bidsize
+        An order larger than what's left is parked, so one huge order
+        can not hold up the ones behind it
+        Returns a list of (order_id, type, quantity, price)
+        """
+        fills = []
+        if quote.ask is not None:
+            fills.extend((order_id, BUY, quantity, quote.ask) for order_id, quantity in _pop_crossed(
+                self._buys, self._large_buys, lambda limit: -limit >= quote.ask, quote.asksize or 0))
+        if quote.bid is not None:
+            fills.extend((order_id, SELL, quantity, quote.bid) for order_id, quantity in _pop_crossed(
+                self._sells, self._large_sells, lambda limit: limit <= quote.bid, quote.bidsize or 0))
+        return fills
+
+
+def _pop_crossed(heap, large, crossed, size):
+    """
+    Pops orders of heap while crossed(limit), returns (order_id, quantity)
+    of those fitting in size, the others are parked in large
+    Parked orders fitting in size are back in heap first
+    """
+    while large and large[0][0] <= size:
+        quantity, limit, order_id = heapq.heappop(large)
+        heapq.heappush(heap, (limit, order_id, quantity))
+
+    fills = []
+    skipped = 0
+    while heap and size and crossed(heap[0][0]):
+        order = heapq.heappop(heap)
+        if order[2] <= size:
+            size -= order[2]
+            fills.append((order[1], order[2]))
+            continue
+        heapq.heappush(large, (order[2], order[0], order[1]))
+        skipped += 1
+        if skipped == MAX_SKIPPED:
+            break
+    return fills
+
+
+def fill(order_id, price, quote):
+    """
+    Executes a limit order at price, returns True if it's filled
+    Orders which cannot be executed anymore are rejected
+    """
+    order = LimitOrder.objects.select_related('account', 'stock').get(pk=order_id)
+    try:
+        with transaction.atomic():
+            claimed = LimitOrder.objects.filter(pk=order_id, status=OPEN).update(
+                status=FILLED, fill_price=price, filled_at=timezone.now())
+            if not claimed:
+                # cancelled meanwhile
+                return False
+            if order.type == BUY:
+                order.account.buy(order.stock, order.quantity, price, quote)
+            else:
+                order.account.sell(order.stock, order.quantity, price, quote)
+    except FILL_ERRORS as e:
+        logger.info('Limit order %s rejected: %s', order_id, e)
+        LimitOrder.objects.filter(pk=order_id, status=OPEN).update(status=REJECTED)
+        return False
+    # the trade invalidated the account before the fill was committed,
+    # a request in between may have cached the old balance again
+    order.account.invalidate_cache()
+    return True
+
+
+class OrderBooks(object):
+    def __init__(self):
+        self.books = {}
+        self.last_id = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Reloads all open orders, an order committed after a newer one
+        was synced is only seen here
+        """
+        with self._lock:
+            self.books = {}
+            self.last_id = 0
+        self.sync()
+
+    def sync(self):
+        """
+        Adds orders placed since last sync, with one indexed query
+        """
+        orders = LimitOrder.objects.filter(status=OPEN, id__gt=self.last_id).order_by('id').\
+            values_list('id', 'stock__symbol', 'type', 'quantity', 'limit_price')
+        with self._lock:
+            for order_id, symbol, type, quantity, limit in orders.iterator():
+                symbol = symbol.upper()
+                if symbol not in self.books:
+                    self.books[symbol] = OrderBook(symbol)
+                self.books[symbol].add(order_id, type, quantity, limit)
+                self.last_id = order_id
+
+    def symbols(self):
+        with self._lock:
+            return [symbol for symbol, book in self.books.items() if book]
+
+    def on_quotes(self, quotes):
+        """
+        Matches books against {symbol: Quote}, returns number of filled orders
+        """
+        filled = 0
+        for symbol, quote in quotes.items():
+            if quote.error is not None or quote.stale:
+                continue
+            with self._lock:
+                book = self.books.get(symbol.upper())
+                fills = book.match(quote) if book else []
+            for order_id, type, quantity, price in fills:
+                try:
+                    if fill(order_id, price, quote):
+                        filled += 1
+                except Exception:
+                    # the order stays open in DB and is back in its book on next load
+                    logger.exception('Cannot fill limit order %s', order_id)
+        return filled
+
+
+order_books = OrderBooks()
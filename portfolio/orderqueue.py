@@ -0,0 +1,150 @@
+"""
+Order queue, buys and sells executed off the request thread
+
+With ASYNC_ORDERS on, views only insert a `QueuedOrder` and return.
+process_orders runs a few worker threads, each claims up to a batch of
+pending orders with a conditional UPDATE, looks up one quote per symbol
+for all of them and executes them in one transaction, a savepoint per
+order so a failed one does not fail the batch.
+
+The queue is the database, there is no broker. A claim older than
+ORDER_QUEUE_CLAIM_TIMEOUT goes back to pending, an order is only marked
+executed by the worker which still holds its claim, in the same
+transaction as the trade, so it's never executed twice.
+"""
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from requests.exceptions import ConnectionError, Timeout
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.utils import timezone
+
+from .exceptions import (
+    PriceChangedException, NotEnoughStockInMarket, NotEnoughStockInHands,
+    CannotFindStockException, EmptySymbolException, NotEnoughFundExceptin,
+    NegativeQuantityException, StaleQuoteException)
+from .models import Account, Stock, QueuedOrder, BUY, PENDING, RUNNING, EXECUTED, FAILED
+from .utils import lookup_many
+
+logger = logging.getLogger(__name__)
+
+TRADE_ERRORS = (
+    PriceChangedException, NotEnoughStockInMarket, NotEnoughStockInHands,
+    CannotFindStockException, EmptySymbolException, NotEnoughFundExceptin,
+    NegativeQuantityException, StaleQuoteException)
+
+QUOTE_FIELDS = ('bid', 'ask', 'bidsize', 'asksize')
+
+
+class ClaimLost(Exception):
+    """
+    The claim expired and another worker took the order
+    """
+
+
+def enqueue(account, type, symbol, quantity, price):
+    return QueuedOrder.objects.create(
+        account=account, type=type, symbol=symbol.upper(), quantity=quantity, price=price)
+
+
+def claim(worker, batch_size=None, timeout=None):
+    """
+    Marks up to batch_size pending orders as running by worker,
+    returns them oldest first
+    """
+    batch_size = batch_size or getattr(settings, 'ORDER_QUEUE_BATCH_SIZE', 50)
+    timeout = timeout or getattr(settings, 'ORDER_QUEUE_CLAIM_TIMEOUT', 60)
+    now = timezone.now()
+
+    # workers which died with orders claimed
+    QueuedOrder.objects.filter(status=RUNNING, claimed_at__lt=now - timedelta(seconds=timeout)).\
+        update(status=PENDING, worker='')
+
+    ids = list(QueuedOrder.objects.filter(status=PENDING).order_by('id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    # other workers may claim some of them first
+    QueuedOrder.objects.filter(id__in=ids, status=PENDING).update(status=RUNNING, worker=worker, claimed_at=now)
+    return list(QueuedOrder.objects.filter(id__in=ids, status=RUNNING, worker=worker).order_by('id'))
+
+
+def _finish(order, worker, status, error=''):
+    finished = QueuedOrder.objects.filter(pk=order.pk, status=RUNNING, worker=worker).update(
+        status=status, error=error[:255], executed_at=timezone.now())
+    if not finished:
+        raise ClaimLost(order.pk)
+
+
+def execute(orders, worker):
+    """
+    Executes claimed orders, returns the number executed
+    """
+    quotes, errors = lookup_many(set(o.symbol for o in orders), fields=QUOTE_FIELDS)
+    accounts = Account.objects.in_bulk(set(o.account_id for o in orders))
+    stocks = {}
+    executed = 0
+
+    # accounts are locked in id order by every worker, so batches never deadlock
+    orders = sorted(orders, key=lambda o: (o.account_id, o.id))
+    with transaction.atomic():
+        for order in orders:
+            account = accounts[order.account_id]
+            try:
+                with transaction.atomic():
+                    if order.symbol in errors:
+                        error = errors[order.symbol]
+                        _finish(order, worker, FAILED, 'Cannot connect to Benzinga'
+                                if isinstance(error, (ConnectionError, Timeout)) else str(error))
+                        continue
+                    quote = quotes[order.symbol]
+                    try:
+                        with transaction.atomic():
+                            if order.symbol not in stocks:
+                                stocks[order.symbol] = Stock.get_stock_from_quote(quote)
+                            if order.type == BUY:
+                                account.buy(stocks[order.symbol], order.quantity, order.price, quote)
+                            else:
+                                account.sell(stocks[order.symbol], order.quantity, order.price, quote)
+                            _finish(order, worker, EXECUTED)
+                            executed += 1
+                    except TRADE_ERRORS as e:
+                        _finish(order, worker, FAILED, str(e))
+                    except DatabaseError as e:
+                        # only this order's savepoint is rolled back, the batch goes on
+                        logger.exception('Queued order %s failed', order.pk)
+                        _finish(order, worker, FAILED, 'Cannot execute order')
+            except ClaimLost:
+                logger.warning('Queued order %s was claimed by another worker', order.pk)
+
+    # trades invalidated accounts before the batch was committed,
+    # a request in between may have cached the old balance again
+    for account in accounts.values():
+        account.invalidate_cache()
+    return executed
+
+
+def work(poll_interval=None, batch_size=None, stop=None):
+    """
+    Claims and executes orders until stop is set
+    """
+    poll_interval = poll_interval or getattr(settings, 'ORDER_QUEUE_POLL_INTERVAL', 0.2)
+    worker = uuid.uuid4().hex
+    stop = stop or threading.Event()
+    try:
+        while not stop.is_set():
+            try:
+                orders = claim(worker, batch_size)
+                if orders:
+                    execute(orders, worker)
+                    continue
+            except Exception:
+                # claimed orders go back to pending once the claim expires
+                logger.exception('Cannot execute queued orders')
+            time.sleep(poll_interval)
+    finally:
+        connection.close()
@@ -0,0 +1,64 @@
+"""
+Rebuilds and checks `Position` rows against `HoldingStock` lots
+"""
+from decimal import Decimal
+
+from django.db import transaction
+
+from .models import HoldingStock, Position
+
+
+def positions_from_lots(accounts=None):
+    """
+    Returns {(account_id, stock_id): (quantity, cost)} summed from lots
+    """
+    lots = HoldingStock.objects.all()
+    if accounts is not None:
+        lots = lots.filter(account__in=accounts)
+
+    positions = {}
+    for account_id, stock_id, quantity, price in lots.values_list(
+            'account_id', 'stock_id', 'quantity', 'price').iterator():
+        q, cost = positions.get((account_id, stock_id), (0, Decimal(0)))
+        positions[(account_id, stock_id)] = (q + quantity, cost + quantity * price)
+    return positions
+
+
+def rebuild_positions(accounts=None):
+    """
+    Replaces Position rows with sums of lots
+    Returns number of positions
+    """
+    positions = positions_from_lots(accounts)
+    with transaction.atomic():
+        old = Position.objects.all()
+        if accounts is not None:
+            old = old.filter(account__in=accounts)
+        old.delete()
+        Position.objects.bulk_create([
+            Position(account_id=account_id, stock_id=stock_id, quantity=quantity, cost=cost)
+            for (account_id, stock_id), (quantity, cost) in positions.items()
+            if quantity])
+    return len(positions)
+
+
+def check_positions(accounts=None):
+    """
+    Returns a list of (account_id, stock_id, expected, actual),
+    expected and actual are (quantity, cost) or None if the row is missing
+    """
+    expected = positions_from_lots(accounts)
+    actual = Position.objects.all()
+    if accounts is not None:
+        actual = actual.filter(account__in=accounts)
+    actual = dict(
+        ((account_id, stock_id), (quantity, cost))
+        for account_id, stock_id, quantity, cost in actual.values_list(
+            'account_id', 'stock_id', 'quantity', 'cost').iterator())
+
+    mismatches = []
+    for key in set(expected) | set(actual):
+        e, a = expected.get(key), actual.get(key)
+        if e != a:
+            mismatches.append(key + (e, a))
+    return sorted(mismatches)
@@ -0,0 +1,108 @@
+"""
+Quote, the parsed form of a Benzinga response
+
+A response is classified once when it's parsed, error shapes included,
+numeric fields stay strings until they are read and are converted only
+once. Quotes are what the client returns, the quote cache stores and
+trades check prices against.
+"""
+import time
+from decimal import Decimal
+
+from .exceptions import CannotFindStockException, EmptySymbolException
+
+# error shapes
+NOT_FOUND = 'not_found'    # {"status": "error", ...}, unknown symbol
+EMPTY = 'empty'            # {"message": "404: Not Found"}, empty or bad symbol
+INCOMPLETE = 'incomplete'  # AAPL has several null fields, do not know why
+
+TEXT_FIELDS = ('symbol', 'name', 'industry', 'exchange', 'sector')
+NUMERIC_FIELDS = ('bid', 'ask', 'price', 'bidsize', 'asksize', 'volume')
+
+
+def _decimal(value):
+    return Decimal(value) if value not in (None, '') else None
+
+
+def _int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def _numeric(name, convert):
+    slot = '_' + name
+
+    def get(self):
+        value = getattr(self, slot)
+        if isinstance(value, basestring):
+            value = convert(value)
+            setattr(self, slot, value)
+        return value
+    return property(get)
+
+
+class Quote(object):
+    __slots__ = TEXT_FIELDS + ('fetched_at', 'stale', 'error') + tuple('_' + f for f in NUMERIC_FIELDS)
+
+    bid = _numeric('bid', _decimal)
+    ask = _numeric('ask', _decimal)
+    price = _numeric('price', _decimal)
+    bidsize = _numeric('bidsize', _int)
+    asksize = _numeric('asksize', _int)
+    volume = _numeric('volume', _int)
+
+    @classmethod
+    def from_json(cls, json, fetched_at=None):
+        quote = cls()
+        quote.fetched_at = fetched_at or time.time()
+        quote.stale = False
+        if 'status' in json:
+            quote.error = NOT_FOUND
+        elif 'message' in json or not json.get('symbol'):
+            quote.error = EMPTY
+        elif not json.get('industry') or not json.get('exchange'):
+            quote.error = INCOMPLETE
+        else:
+            quote.error = None
+        for field in TEXT_FIELDS:
+            setattr(quote, field, json.get(field) or '')
+        for field in NUMERIC_FIELDS:
+            value = json.get(field)
+            setattr(quote, '_' + field, unicode(value) if value is not None else None)
+        return quote
+
+    def check(self):
+        """
+        Raises if the quote is not a tradable stock
+        """
+        if self.error == EMPTY:
+            raise EmptySymbolException('Cannot find stock')
+        if self.error is not None:
+            raise CannotFindStockException('Cannot find stock')
+
+    def as_stale(self):
+        """
+        Returns a copy marked as stale
+        """
+        quote = Quote()
+        quote.__setstate__(self.__getstate__())
+        quote.stale = True
+        return quote
+
+    def as_dict(self, fields=TEXT_FIELDS + NUMERIC_FIELDS):
+        content = {}
+        for field in fields:
+            value = getattr(self, field)
+            content[field] = str(value) if isinstance(value, Decimal) else value
+        return content
+
+    # pickled as a flat tuple, so cache entries stay small
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in Quote.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(Quote.__slots__, state):
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return '<Quote {0} bid={1} ask={2}{3}>'.format(
+            self.symbol, self._bid, self._ask, ' error=' + self.error if self.error else '')
@@ -0,0 +1,164 @@
+"""
+Live quotes for Server-Sent Events
+
+Quotes are fetched by the refresh_quotes worker only. Streamed symbols are
+marked hot, so the worker keeps them fresh in the shared quote cache, and
+one QuotePoller thread per process reads them from there once per interval
+and hands changed quotes to every subscriber of that symbol. Web processes
+never call Benzinga for streams, however many of them there are.
+
+A stream holds a gunicorn thread, so a process serves at most
+QUOTE_STREAM_MAX_CONNECTIONS of them, clients over that poll cached_quotes.
+
+Quotes the worker has not refreshed within their TTL are sent marked as
+stale, and not at all once older than QUOTE_CACHE_STALE_TTL.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import quote_cache, hot_symbols
+
+logger = logging.getLogger(__name__)
+
+STREAM_FIELDS = ('bid', 'bidsize', 'ask', 'asksize')
+
+
+class Subscription(object):
+    """
+    Keeps only the latest quote per symbol,
+    a slow client skips intermediate quotes instead of piling them up
+    """
+
+    def __init__(self, symbols):
+        self.symbols = set(s.upper() for s in symbols)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def push(self, symbol, quote):
+        with self._lock:
+            self._pending[symbol] = quote
+            self._event.set()
+
+    def wait(self, timeout):
+        """
+        Returns {symbol: quote} changed since last call, maybe empty after timeout
+        """
+        self._event.wait(timeout)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._event.clear()
+        return pending
+
+
+def cached_quotes(symbols, fields=None, deadline=None):
+    """
+    Like lookup_many, but only reads the quote cache and marks symbols hot
+    for the refresh_quotes worker, returns (quotes, errors)
+    Quotes older than their TTL are marked as stale, older than
+    stale_ttl of the quote cache left out
+    """
+    now = time.time()
+    ttl = quote_cache.ttl(fields)
+    quotes = {}
+    for symbol in symbols:
+        hot_symbols.touch(symbol)
+        quote = quote_cache.peek(symbol)
+        if quote is None or now - quote.fetched_at >= quote_cache.stale_ttl:
+            continue
+        if now - quote.fetched_at >= ttl:
+            quote = quote.as_stale()
+        quotes[symbol.upper()] = quote
+    return quotes, {}
+
+
+def as_event(symbol, quote):
+    event = quote.as_dict(STREAM_FIELDS)
+    event['symbol'] = symbol
+    event['stale'] = quote.stale
+    return event
+
+
+class QuotePoller(object):
+    def __init__(self, interval=None, fetch_many=cached_quotes, max_subscriptions=None):
+        self.interval = interval or getattr(settings, 'QUOTE_STREAM_INTERVAL', 2)
+        self.fetch_many = fetch_many
+        self.max_subscriptions = max_subscriptions or getattr(settings, 'QUOTE_STREAM_MAX_CONNECTIONS', 2)
+        self._count = 0
+        self._subscriptions = {}
+        self._last = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def subscribe(self, symbols):
+        """
+        Returns a Subscription, or None if this process streams
+        max_subscriptions already
+        """
+        subscription = Subscription(symbols)
+        with self._lock:
+            if self._count >= self.max_subscriptions:
+                return None
+            self._count += 1
+            for symbol in subscription.symbols:
+                self._subscriptions.setdefault(symbol, set()).add(subscription)
+                # new subscribers start with the last quote we know
+                if symbol in self._last:
+                    subscription.push(symbol, self._last[symbol])
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='quote-poller')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._count -= 1
+            for symbol in subscription.symbols:
+                subscribers = self._subscriptions.get(symbol)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[symbol]
+                    self._last.pop(symbol, None)
+
+    def poll_once(self):
+        with self._lock:
+            symbols = list(self._subscriptions)
+        if not symbols:
+            return
+
+        quotes, errors = self.fetch_many(symbols, fields=STREAM_FIELDS, deadline=self.interval)
+        with self._lock:
+            for symbol, quote in quotes.items():
+                if quote.error is not None:
+                    continue
+                quote = as_event(symbol, quote)
+                if self._last.get(symbol) == quote:
+                    continue
+                self._last[symbol] = quote
+                for subscription in self._subscriptions.get(symbol, ()):
+                    subscription.push(symbol, quote)
+
+    def _run(self):
+        while True:
+            if not self._subscriptions:
+                # sleep until someone subscribes
+                self._wakeup.wait()
+            self._wakeup.clear()
+            start = time.time()
+            try:
+                self.poll_once()
+            except Exception:
+                # never let the shared poller die, next round retries
+                logger.exception('Quote poller failed')
+            time.sleep(max(0, self.interval - (time.time() - start)))
+
+
+quote_poller = QuotePoller()
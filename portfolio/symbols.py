@@ -0,0 +1,97 @@
+"""
+In-process index of known symbols for autocomplete and local validation
+
+Symbols and every word of stock names are kept in sorted lists,
+so a prefix search is two bisects and a slice.
+The index is built from listed stocks, the ones load_symbols loaded from the
+symbol master, and rebuilt every SYMBOL_INDEX_TTL seconds, so symbols loaded
+by load_symbols reach every worker.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+from .models import Stock
+from .exceptions import CannotFindStockException
+
+
+class SymbolIndex(object):
+    def __init__(self, stocks):
+        """
+        stocks is an iterable of (symbol, name)
+        """
+        self.names = {}
+        words = set()
+        for symbol, name in stocks:
+            symbol = symbol.upper()
+            self.names[symbol] = name
+            for word in name.lower().split():
+                words.add((word, symbol))
+        self.symbols = sorted(self.names)
+        self.words = sorted(words)
+
+    def __contains__(self, symbol):
+        return symbol.upper() in self.names
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def complete(self, prefix, limit=10):
+        """
+        Returns up to limit (symbol, name), symbol matches first
+        """
+        prefix = prefix.strip()
+        if not prefix:
+            return []
+
+        found = []
+        upper = prefix.upper()
+        i = bisect_left(self.symbols, upper)
+        while i < len(self.symbols) and len(found) < limit and self.symbols[i].startswith(upper):
+            found.append(self.symbols[i])
+            i += 1
+
+        lower = prefix.lower()
+        i = bisect_left(self.words, (lower,))
+        while i < len(self.words) and len(found) < limit and self.words[i][0].startswith(lower):
+            symbol = self.words[i][1]
+            if symbol not in found:
+                found.append(symbol)
+            i += 1
+
+        return [(symbol, self.names[symbol]) for symbol in found]
+
+
+_index = None
+_built_at = 0
+_lock = threading.Lock()
+
+
+def symbol_index():
+    global _index, _built_at
+    with _lock:
+        if _index is None or time.time() - _built_at > getattr(settings, 'SYMBOL_INDEX_TTL', 300):
+            _index = SymbolIndex(Stock.objects.filter(listed=True).values_list('symbol', 'name').iterator())
+            _built_at = time.time()
+        return _index
+
+
+def reset_symbol_index():
+    global _index
+    with _lock:
+        _index = None
+
+
+def check_symbol(symbol):
+    """
+    Raises CannotFindStockException for symbols out of our symbol master,
+    without asking Benzinga
+    Nothing is rejected until a symbol master is loaded
+    """
+    if not getattr(settings, 'SYMBOL_MASTER_ONLY', True):
+        return
+    index = symbol_index()
+    if len(index) and symbol not in index:
+        raise CannotFindStockException('Cannot find stock')
@@ -1,11 +1,49 @@
+import json
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
 from decimal import Decimal
 
-from django.test import TestCase
+from requests.exceptions import Timeout
 
-from .models import Stock, Account, Order, BUY, SELL, HoldingStock
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.core.cache import cache, get_cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils import timezone
+
+from .cache import QuoteCache, LRUBackend, DjangoCacheBackend
+from .quotes import Quote
+from .utils import BenzingaClient, RetryBudget, CircuitBreaker, lookup_many, display_lookup
+from .models import (
+    Stock, Account, Order, BUY, SELL, HoldingStock, Position, LotClose, LeaderboardEntry,
+    LimitOrder, FILLED, CANCELLED, REJECTED, ArchivedOrderTotal,
+    QueuedOrder, RUNNING, EXECUTED, FAILED)
+from .lots import FIFO, LIFO, HIGHEST_COST
+from .basket import parse_basket, execute_basket
+from .history import filter_orders, page, export_rows
+from .symbols import SymbolIndex, check_symbol, reset_symbol_index
+from .stream import QuotePoller
+from .cache import quote_cache, account_cache, HotSymbols
+from .positions import check_positions, rebuild_positions
+from .analytics import summarize
+from .leaderboard import build_leaderboard, top, rank_of
+from .ledger import replay, take_snapshot, verify, verify_accounts
+from .orderbook import OrderBook, OrderBooks, fill
+from .ticks import TickStore
+from .archive import archive_orders, archived_orders
+from .orderqueue import enqueue, claim, execute
+from . import metrics, utils, ticks, orderbook
 from .exceptions import (
     CannotFindStockException, EmptySymbolException, NotEnoughStockInHands,
-    NotEnoughFundExceptin, NotEnoughStockInMarket)
+    NotEnoughFundExceptin, NotEnoughStockInMarket, BasketException,
+    StaleQuoteException, CircuitOpenException)
 
 
 VALID_JSON = {
@@ -46,9 +84,13 @@ EMPTY_JSON = {
 }
 
 
+def make_quote(json=VALID_JSON, fetched_at=None, **fields):
+    return Quote.from_json(dict(json, **fields), fetched_at=fetched_at)
+
+
 class StockTestCase(TestCase):
     def test_valid_json(self):
-        stock = Stock.get_stock_from_json(VALID_JSON)
+        stock = Stock.get_stock_from_quote(make_quote())
         self.assertEqual(stock.symbol, VALID_JSON['symbol'])
         self.assertEqual(stock.name, VALID_JSON['name'])
         self.assertEqual(stock.industry, VALID_JSON['industry'])
@@ -56,16 +98,35 @@ class StockTestCase(TestCase):
 
     def test_bad_json(self):
         with self.assertRaises(EmptySymbolException):
-            Stock.get_stock_from_json(EMPTY_JSON)
+            Stock.get_stock_from_quote(make_quote(EMPTY_JSON))
 
         with self.assertRaises(CannotFindStockException):
-            Stock.get_stock_from_json(NOT_FOUND_JSON)
+            Stock.get_stock_from_quote(make_quote(NOT_FOUND_JSON))
+
+
+class QuoteTestCase(SimpleTestCase):
+    def test_parse(self):
+        quote = make_quote()
+        self.assertIsNone(quote.error)
+        self.assertEqual(quote.ask, Decimal('16.68'))
+        # converted once and kept
+        self.assertIs(quote.ask, quote.ask)
+        self.assertEqual(quote.asksize, int(VALID_JSON['asksize']))
+        self.assertEqual(make_quote(NOT_FOUND_JSON).error, 'not_found')
+        self.assertEqual(make_quote(EMPTY_JSON).error, 'empty')
+
+    def test_pickle(self):
+        quote = pickle.loads(pickle.dumps(make_quote(), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(quote.symbol, VALID_JSON['symbol'])
+        self.assertEqual(quote.bid, Decimal(VALID_JSON['bid']))
+        self.assertTrue(quote.as_stale().stale)
+        self.assertFalse(quote.stale)
 
 
 class OrderTestCase(TestCase):
     def setUp(self):
         self.account = Account.objects.create(username='test')
-        self.stock = Stock.get_stock_from_json(VALID_JSON)
+        self.stock = Stock.get_stock_from_quote(make_quote())
 
     def test_order(self):
         price = Decimal(VALID_JSON['ask'])
@@ -75,7 +136,7 @@ class OrderTestCase(TestCase):
         self.account.amount = Decimal(1.0)
         self.account.save()
         with self.assertRaises(NotEnoughFundExceptin):
-            self.account.buy(self.stock, 1, price, VALID_JSON)
+            self.account.buy(self.stock, 1, price, make_quote())
 
         # not we get some money
         self.account.amount = Decimal(100000.0)
@@ -84,12 +145,12 @@ class OrderTestCase(TestCase):
         # if we buy more stocks than we can get from the market
         # we expect NotEnoughStockInMarket
         with self.assertRaises(NotEnoughStockInMarket):
-            self.account.buy(self.stock, 100000, price, VALID_JSON)
+            self.account.buy(self.stock, 100000, price, make_quote())
 
         # if we only buy one, that's ok
         # however in real life,
         # it's not wise at all considering the commission fee
-        self.account.buy(self.stock, quantity, price, VALID_JSON)
+        self.account.buy(self.stock, quantity, price, make_quote())
 
         account = Account.objects.get(id=self.account.id)
         self.assertEquals(
@@ -106,7 +167,7 @@ class OrderTestCase(TestCase):
             1)
 
         # what if I buy the same stock again?
-        self.account.buy(self.stock, quantity, price, VALID_JSON)
+        self.account.buy(self.stock, quantity, price, make_quote())
 
         account = Account.objects.get(id=self.account.id)
         self.assertEquals(
@@ -124,9 +185,9 @@ class OrderTestCase(TestCase):
         price = Decimal(VALID_JSON['bid'])
         # we do not have enough stock to sell
         with self.assertRaises(NotEnoughStockInHands):
-            self.account.sell(self.stock, 3, price, VALID_JSON)
+            self.account.sell(self.stock, 3, price, make_quote())
 
-        account.sell(self.stock, 1, price, VALID_JSON)
+        account.sell(self.stock, 1, price, make_quote())
         self.assertEquals(
             Order.objects.filter(account=account, type=SELL).count(),
             1)
@@ -135,8 +196,909 @@ class OrderTestCase(TestCase):
             1)
 
         # we sell the last one
-        self.account.sell(self.stock, 1, price, VALID_JSON)
+        self.account.sell(self.stock, 1, price, make_quote())
 
         # we don't have this stock any more
         with self.assertRaises(NotEnoughStockInHands):
-            self.account.sell(self.stock, 1, price, VALID_JSON)
+            self.account.sell(self.stock, 1, price, make_quote())
+
+
+class QuoteCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+        self.cache = QuoteCache(
+            [LRUBackend(size=2)], default_ttl=60, field_ttl={'name': 3600, 'bid': 0})
+
+    def fetch(self, symbol):
+        self.calls.append(symbol)
+        return make_quote(symbol=symbol)
+
+    def test_hit_and_miss(self):
+        self.cache.get('F', self.fetch)
+        self.cache.get('f', self.fetch)
+        self.assertEqual(self.calls, ['F'])
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        self.assertEqual(self.cache.stats()['local_hits'], 1)
+
+    def test_field_ttl(self):
+        self.cache.get('F', self.fetch, fields=('name',))
+        self.cache.get('F', self.fetch, fields=('name',))
+        self.assertEqual(len(self.calls), 1)
+        # bid has no ttl, it's always fetched
+        self.cache.get('F', self.fetch, fields=('name', 'bid'))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_lru_eviction(self):
+        for symbol in ('A', 'B', 'C', 'A'):
+            self.cache.get(symbol, self.fetch)
+        self.assertEqual(self.calls, ['A', 'B', 'C', 'A'])
+
+    def test_single_flight(self):
+        def slow_fetch(symbol):
+            time.sleep(0.05)
+            return self.fetch(symbol)
+
+        threads = [
+            threading.Thread(target=self.cache.get, args=('F', slow_fetch))
+            for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, ['F'])
+
+    def test_clear_shared(self):
+        shared = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='test_clear_shared')
+        backends = [DjangoCacheBackend(generation_ttl=0), DjangoCacheBackend(generation_ttl=0)]
+        for backend in backends:
+            backend._cache = shared
+        shared.set('account:test', 1)
+        backends[0].set('F', make_quote(), 60)
+
+        backends[0].clear()
+        self.assertIsNone(backends[0].get('F'))
+        self.assertIsNone(backends[1].get('F'))
+        # the rest of the cache is left alone
+        self.assertEqual(shared.get('account:test'), 1)
+        backends[1].set('F', make_quote(), 60)
+        self.assertIsNotNone(backends[0].get('F'))
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __init__(self, json):
+        self._json = json
+
+    def json(self):
+        return self._json
+
+
+class FakeSession(object):
+    """
+    Raises Timeout `failures` times before answering
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def get(self, url, timeout=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise Timeout()
+        return FakeResponse(VALID_JSON)
+
+
+class BenzingaClientTestCase(SimpleTestCase):
+    def test_retry(self):
+        client = BenzingaClient(retries=2, backoff=0)
+        client.session = FakeSession(failures=2)
+        self.assertEqual(client.get('F').symbol, VALID_JSON['symbol'])
+        self.assertEqual(client.session.calls, 3)
+
+        client.session = FakeSession(failures=3)
+        with self.assertRaises(Timeout):
+            client.get('F')
+        self.assertEqual(client.session.calls, 3)
+
+    def test_retry_budget(self):
+        client = BenzingaClient(retries=2, backoff=0, retry_budget=RetryBudget(ratio=0, reserve=1))
+        client.session = FakeSession(failures=2)
+        with self.assertRaises(Timeout):
+            client.get('F')
+        # only one retry was allowed by budget
+        self.assertEqual(client.session.calls, 2)
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    def test_open_and_probe(self):
+        breaker = CircuitBreaker(min_calls=2, failure_rate=0.5, reset_timeout=0.05)
+        client = BenzingaClient(retries=0, backoff=0, breaker=breaker)
+        client.session = FakeSession(failures=2)
+        for i in range(2):
+            with self.assertRaises(Timeout):
+                client.get('F')
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        # fails fast without calling Benzinga
+        with self.assertRaises(CircuitOpenException):
+            client.get('F')
+        self.assertEqual(client.session.calls, 2)
+
+        time.sleep(0.06)
+        self.assertEqual(client.get('F').symbol, VALID_JSON['symbol'])
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_slow_calls(self):
+        breaker = CircuitBreaker(min_calls=2, failure_rate=0.5, slow_call=1.0)
+        breaker.record(True, 0.1)
+        breaker.record(True, 5.0)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_stale_quote(self):
+        quote_cache.set('F', make_quote(fetched_at=time.time() - 60))
+        breaker = utils.client.breaker
+        breaker._open()
+        try:
+            quote = display_lookup('F')
+            self.assertTrue(quote.stale)
+            self.assertEqual(quote.ask, Decimal(VALID_JSON['ask']))
+            with self.assertRaises(CircuitOpenException):
+                utils.lookup('F')
+        finally:
+            breaker.state = CircuitBreaker.CLOSED
+            quote_cache.clear()
+
+
+class LookupManyTestCase(SimpleTestCase):
+    def setUp(self):
+        quote_cache.clear()
+
+    def tearDown(self):
+        quote_cache.clear()
+
+    def test_lookup_many(self):
+        quote_cache.set('F', make_quote())
+        quote_cache.set('GM', make_quote(symbol='GM'))
+        quotes, errors = lookup_many(['F', 'gm', 'GM', 'f'])
+        self.assertEqual(sorted(quotes), ['F', 'GM'])
+        self.assertEqual(errors, {})
+
+
+class PositionTestCase(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(username='test')
+        self.stock = Stock.get_stock_from_quote(make_quote())
+
+    def test_position(self):
+        self.account.buy(self.stock, 2, Decimal('16.68'), make_quote())
+        self.account.buy(self.stock, 1, Decimal('17.00'), make_quote(ask='17.00'))
+        position = Position.objects.get(account=self.account, stock=self.stock)
+        self.assertEqual(position.quantity, 3)
+        self.assertEqual(position.cost, Decimal('16.68') * 2 + Decimal('17.00'))
+
+        # lots with higher price are sold first
+        self.account.sell(self.stock, 2, Decimal('16.67'), make_quote())
+        position = Position.objects.get(account=self.account, stock=self.stock)
+        self.assertEqual(position.quantity, 1)
+        self.assertEqual(position.cost, Decimal('16.68'))
+        self.assertEqual(check_positions(), [])
+
+        self.account.sell(self.stock, 1, Decimal('16.67'), make_quote())
+        self.assertFalse(Position.objects.filter(account=self.account).exists())
+        self.assertEqual(check_positions(), [])
+
+    def test_rebuild(self):
+        self.account.buy(self.stock, 2, Decimal('16.68'), make_quote())
+        Position.objects.update(quantity=5)
+        self.assertEqual(len(check_positions()), 1)
+        rebuild_positions()
+        self.assertEqual(check_positions(), [])
+
+
+class AnalyticsTestCase(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(username='test')
+        self.stock = Stock.get_stock_from_quote(make_quote())
+
+    def test_summary(self):
+        self.account.buy(self.stock, 2, Decimal('16.68'), make_quote())
+        self.account.buy(self.stock, 2, Decimal('17.00'), make_quote(ask='17.00'))
+        # sells the 17.00 lot first, realizing 2 * (16.67 - 17.00)
+        self.account.sell(self.stock, 2, Decimal('16.67'), make_quote())
+
+        # lots, orders and archived order totals
+        with self.assertNumQueries(3):
+            summary = summarize(self.account, {'F': make_quote(bid='18.00')})
+        position, = summary['positions']
+        self.assertEqual(position['quantity'], 2)
+        self.assertAlmostEqual(position['avg_cost'], 16.68)
+        self.assertAlmostEqual(summary['market_value'], 36.0)
+        self.assertAlmostEqual(summary['unrealized'], 36.0 - 2 * 16.68)
+        self.assertAlmostEqual(summary['realized'], 2 * (16.67 - 17.00))
+        self.assertEqual(summary['exposure']['industry'][0]['name'], VALID_JSON['industry'])
+        self.assertAlmostEqual(summary['exposure']['industry'][0]['weight'], 1.0)
+
+    def test_empty(self):
+        summary = summarize(self.account, {})
+        self.assertEqual(summary['positions'], [])
+        self.assertEqual(summary['market_value'], 0)
+
+
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        self.stock = Stock.get_stock_from_quote(make_quote())
+        self.a = Account.objects.create(username='a', amount=Decimal(1000))
+        self.b = Account.objects.create(username='b', amount=Decimal(900))
+        self.c = Account.objects.create(username='c', amount=Decimal(800))
+        quote_cache.set('F', make_quote())
+
+    def tearDown(self):
+        quote_cache.clear()
+        cache.delete(LeaderboardEntry.MARKS_KEY)
+
+    def ranks(self):
+        return [(e.account.username, e.value) for e in top()]
+
+    def test_build(self):
+        # 20 F at 16.68, marked at bid 16.67
+        self.c.buy(self.stock, 20, Decimal('16.68'), make_quote())
+        self.assertEqual(build_leaderboard(), 3)
+        self.assertEqual(self.ranks(), [
+            ('a', Decimal(1000)), ('b', Decimal(900)), ('c', Decimal('799.80'))])
+
+    def test_trade_moves_rank(self):
+        build_leaderboard()
+        cache.set(LeaderboardEntry.MARKS_KEY, {'F': Decimal('40')})
+        # 10 F bought at 16.68 are worth 400
+        self.c.buy(self.stock, 10, Decimal('16.68'), make_quote())
+        self.assertEqual(rank_of(self.c).rank, 1)
+        self.assertEqual(rank_of(self.c).value, Decimal('1033.20'))
+        self.assertEqual([u for u, v in self.ranks()], ['c', 'a', 'b'])
+
+        LeaderboardEntry.move(self.c.pk, value=Decimal(0))
+        self.assertEqual([u for u, v in self.ranks()], ['a', 'b', 'c'])
+        self.assertEqual([e.rank for e in top()], [1, 2, 3])
+        self.assertEqual(rank_of(self.c).rank, 3)
+
+        # a trade updates its own entry only
+        with self.assertNumQueries(1):
+            LeaderboardEntry.move(self.a.pk, delta=Decimal(-200))
+        self.assertEqual(rank_of(self.b).rank, 1)
+
+
+class LedgerTestCase(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(username='test')
+        self.stock = Stock.get_stock_from_quote(make_quote())
+
+    def test_replay(self):
+        self.account.buy(self.stock, 2, Decimal('16.68'), make_quote())
+        self.account.buy(self.stock, 2, Decimal('17.00'), make_quote(ask='17.00'))
+        first = Order.objects.order_by('id')[0]
+        self.account.sell(self.stock, 3, Decimal('16.67'), make_quote())
+
+        self.assertEqual(verify(self.account), [])
+        self.assertEqual(replay(self.account).lot_list(), [(self.stock.pk, 1, Decimal('16.68'))])
+        self.assertEqual(replay(self.account, until=first.created_at).amount,
+                         settings.INIT_CACHE - 2 * Decimal('16.68'))
+
+        Account.objects.filter(pk=self.account.pk).update(amount=settings.INIT_CACHE)
+        self.assertEqual(len(verify_accounts()[self.account.pk]), 1)
+
+    def test_snapshot(self):
+        self.account.buy(self.stock, 2, Decimal('16.68'), make_quote())
+        snapshot = take_snapshot(self.account)
+        self.assertIsNotNone(snapshot)
+        self.assertIsNone(take_snapshot(self.account))
+
+        # orders before the snapshot are not read again
+        Order.objects.filter(pk=snapshot.order_id).update(quantity=1)
+        self.account.sell(self.stock, 1, Decimal('16.67'), make_quote())
+        ledger = replay(self.account)
+        self.assertEqual(ledger.lot_list(), [(self.stock.pk, 1, Decimal('16.68'))])
+        self.assertEqual(verify(self.account), [])
+
+
+class LotMatchingTestCase(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(username='test')
+        self.stock = Stock.get_stock_from_quote(make_quote())
+        # lots: 2 at 10, 2 at 12, 2 at 11
+        for price in ('10', '12', '11'):
+            HoldingStock.objects.create(
+                account=self.account, stock=self.stock, quantity=2, price=Decimal(price))
+        Position.add(self.account, self.stock, 6, Decimal(66))
+
+    def sell(self, policy, quantity):
+        self.account.lot_policy = policy
+        self.account.sell(self.stock, quantity, Decimal(VALID_JSON['bid']), make_quote(bidsize='100'))
+        return sorted(HoldingStock.objects.filter(account=self.account).values_list('price', 'quantity'))
+
+    def test_fifo(self):
+        self.assertEqual(self.sell(FIFO, 3), [(Decimal(11), 2), (Decimal(12), 1)])
+
+    def test_lifo(self):
+        self.assertEqual(self.sell(LIFO, 3), [(Decimal(10), 2), (Decimal(12), 1)])
+
+    def test_highest_cost(self):
+        self.assertEqual(self.sell(HIGHEST_COST, 3), [(Decimal(10), 2), (Decimal(11), 1)])
+        closed = LotClose.objects.order_by('-price')
+        self.assertEqual([(c.price, c.quantity) for c in closed], [(Decimal(12), 2), (Decimal(11), 1)])
+        self.assertEqual(
+            sum(c.realized for c in closed),
+            (Decimal(VALID_JSON['bid']) - 12) * 2 + Decimal(VALID_JSON['bid']) - 11)
+        self.assertEqual(check_positions(), [])
+
+    def test_fixed_queries(self):
+        with CaptureQueriesContext(connection) as single:
+            self.sell(FIFO, 1)
+        for i in range(50):
+            HoldingStock.objects.create(
+                account=self.account, stock=self.stock, quantity=1, price=Decimal(9))
+        Position.add(self.account, self.stock, 50, Decimal(450))
+
+        # the same number of queries as selling a single lot
+        with CaptureQueriesContext(connection) as many:
+            self.sell(FIFO, 55)
+        self.assertEqual(LotClose.objects.count(), 1 + 53)
+        self.assertEqual(len(many), len(single))
+
+
+class BasketTestCase(TestCase):
+    def setUp(self):
+        quote_cache.clear()
+        quote_cache.set('F', make_quote())
+        quote_cache.set('GM', make_quote(symbol='GM', name='General Motors', ask='30.00'))
+        self.account = Account.objects.create(username='test')
+        reset_symbol_index()
+
+    def tearDown(self):
+        quote_cache.clear()
+
+    def test_basket(self):
+        execute_basket(self.account, parse_basket([
+            ('buy', 'F', 2, '16.68'),
+            ('b', 'gm', '1', '30.00'),
+        ]))
+        self.assertEqual(Order.objects.filter(account=self.account, type=BUY).count(), 2)
+        self.assertEqual(HoldingStock.objects.filter(account=self.account).count(), 2)
+        account = Account.objects.get(id=self.account.id)
+        self.assertEqual(account.amount, Decimal('100000') - Decimal('16.68') * 2 - 30)
+
+        execute_basket(account, parse_basket([('sell', 'F', 2, '16.67')]))
+        self.assertEqual(HoldingStock.objects.filter(account=self.account).count(), 1)
+        self.assertEqual(check_positions(), [])
+
+    def test_all_or_nothing(self):
+        with self.assertRaises(BasketException) as cm:
+            execute_basket(self.account, parse_basket([
+                ('buy', 'F', 2, '16.68'),
+                ('buy', 'GM', 1, '29.00'),
+                ('sell', 'F', 1, '16.67'),
+            ]))
+        self.assertEqual([i for i, msg in cm.exception.errors], [1, 2])
+        self.assertFalse(Order.objects.exists())
+
+    def test_parse_errors(self):
+        with self.assertRaises(BasketException) as cm:
+            parse_basket([('hold', 'F', 1, '1'), ('buy', 'F', 'x', '1'), ('buy', 'F')])
+        self.assertEqual([i for i, msg in cm.exception.errors], [0, 1, 2])
+
+
+class HistoryTestCase(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(username='test')
+        self.stock = Stock.get_stock_from_quote(make_quote())
+        for i in range(7):
+            Order.objects.create(
+                account=self.account, stock=self.stock, quantity=i + 1,
+                price=Decimal(1), type=BUY if i % 2 else SELL)
+        # orders created in the same microsecond are ordered by id
+        Order.objects.filter(quantity__lte=3).update(created_at=Order.objects.get(quantity=1).created_at)
+
+    def test_keyset_pages(self):
+        orders = filter_orders(self.account)
+        seen = []
+        cursor = None
+        while True:
+            orders_page, cursor = page(orders, cursor, size=3)
+            seen.extend(o.quantity for o in orders_page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [7, 6, 5, 4, 3, 2, 1])
+
+    def test_filter(self):
+        orders, cursor = page(filter_orders(self.account, symbol='f', type=BUY))
+        self.assertEqual([o.quantity for o in orders], [6, 4, 2])
+        self.assertIsNone(cursor)
+
+    def test_export(self):
+        rows = list(export_rows(filter_orders(self.account), chunk_size=2))
+        self.assertEqual([row[4] for row in rows], [7, 6, 5, 4, 3, 2, 1])
+
+
+class SymbolIndexTestCase(TestCase):
+    def setUp(self):
+        reset_symbol_index()
+
+    def tearDown(self):
+        reset_symbol_index()
+
+    def test_complete(self):
+        index = SymbolIndex([
+            ('F', 'Ford Motor Company'), ('FB', 'Facebook'),
+            ('GM', 'General Motors'), ('AAPL', 'Apple Inc')])
+        self.assertEqual([s for s, name in index.complete('f')], ['F', 'FB'])
+        self.assertEqual([s for s, name in index.complete('mot')], ['F', 'GM'])
+        self.assertEqual([s for s, name in index.complete('f', limit=1)], ['F'])
+        self.assertEqual(index.complete(' '), [])
+        self.assertIn('aapl', index)
+
+    def test_check_symbol(self):
+        # nothing is rejected without a symbol master
+        check_symbol('XYZ')
+
+        # stocks created from quotes are not a symbol master
+        Stock.get_stock_from_quote(make_quote())
+        reset_symbol_index()
+        check_symbol('XYZ')
+
+        Stock.objects.create(symbol='GM', name='General Motors', listed=True)
+        reset_symbol_index()
+        check_symbol('gm')
+        with self.assertRaises(CannotFindStockException):
+            check_symbol('XYZ')
+
+
+class AccountCacheTestCase(TestCase):
+    def setUp(self):
+        account_cache.clear()
+        self.account = Account.objects.create(username='test')
+        self.account.invalidate_cache()
+        self.stock = Stock.get_stock_from_quote(make_quote())
+
+    def test_cached_account(self):
+        self.assertEqual(Account.get_cached('test').amount, self.account.amount)
+        with self.assertNumQueries(0):
+            account = Account.get_cached('test')
+        self.assertEqual(account.pk, self.account.pk)
+
+        with self.assertRaises(Account.DoesNotExist):
+            Account.get_cached('nobody')
+
+    def test_invalidation(self):
+        Account.get_cached('test')
+        self.account.buy(self.stock, 1, Decimal(VALID_JSON['ask']), make_quote())
+        self.assertEqual(
+            Account.get_cached('test').amount,
+            settings.INIT_CACHE - Decimal(VALID_JSON['ask']))
+
+
+class QuotePollerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+        self.quotes = {'F': make_quote(), 'GM': make_quote(symbol='GM')}
+
+    def fetch_many(self, symbols, fields=None, deadline=None):
+        self.calls.append(sorted(symbols))
+        return dict((s, self.quotes[s]) for s in symbols), {}
+
+    def test_fan_out(self):
+        poller = QuotePoller(interval=1, fetch_many=self.fetch_many)
+        # do not start the polling thread, we poll by hand
+        poller._thread = threading.current_thread()
+        a = poller.subscribe(['F'])
+        b = poller.subscribe(['f', 'GM'])
+
+        poller.poll_once()
+        self.assertEqual(self.calls, [['F', 'GM']])
+        self.assertEqual(list(a.wait(0)), ['F'])
+        self.assertEqual(sorted(b.wait(0)), ['F', 'GM'])
+
+        # only changes are sent
+        self.quotes['GM'] = make_quote(symbol='GM', bid='1.00')
+        poller.poll_once()
+        self.assertEqual(a.wait(0), {})
+        self.assertEqual(b.wait(0)['GM']['bid'], '1.00')
+
+        poller.unsubscribe(a)
+        poller.unsubscribe(b)
+        poller.poll_once()
+        self.assertEqual(len(self.calls), 2)
+
+    def test_max_subscriptions(self):
+        poller = QuotePoller(interval=1, fetch_many=self.fetch_many, max_subscriptions=1)
+        poller._thread = threading.current_thread()
+        a = poller.subscribe(['F'])
+        self.assertIsNone(poller.subscribe(['GM']))
+        poller.unsubscribe(a)
+        self.assertIsNotNone(poller.subscribe(['GM']))
+
+
+class StreamPollTestCase(TestCase):
+    def setUp(self):
+        Account.objects.create(username='test')
+        self.client.post('/login/', {'username': 'test'})
+        quote_cache.set('F', make_quote())
+
+    def tearDown(self):
+        quote_cache.clear()
+
+    def test_poll(self):
+        # read from quote cache only, symbols without a cached quote are left out
+        quotes = json.loads(self.client.get('/stream/poll/?symbols=F,GM').content)
+        self.assertEqual(quotes, [{'symbol': 'F', 'bid': VALID_JSON['bid'], 'bidsize': 6,
+                                   'ask': VALID_JSON['ask'], 'asksize': 22, 'stale': False}])
+
+    def test_old_quotes(self):
+        quote_cache.set('F', make_quote(fetched_at=time.time() - 60))
+        quote_cache.set('GM', make_quote(symbol='GM', fetched_at=time.time() - settings.QUOTE_CACHE_STALE_TTL))
+        quotes = json.loads(self.client.get('/stream/poll/?symbols=F,GM').content)
+        self.assertEqual([(q['symbol'], q['stale']) for q in quotes], [('F', True)])
+
+
+class HotSymbolsTestCase(SimpleTestCase):
+    def test_touch(self):
+        hot = HotSymbols(flush_interval=60, max_age=60)
+        hot.cache.delete(hot.key)
+        hot.touch('f')
+        hot.touch('GM')
+        # GM is buffered until next flush
+        self.assertEqual(hot.symbols(), ['F'])
+        hot.flush()
+        self.assertEqual(hot.symbols(), ['F', 'GM'])
+        hot.cache.delete(hot.key)
+
+
+class ContentionTestCase(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(username='test')
+        self.stock = Stock.get_stock_from_quote(make_quote())
+        self.price = Decimal(VALID_JSON['ask'])
+
+    def test_no_lost_update(self):
+        # two workers holding the same stale account
+        a = Account.objects.get(pk=self.account.pk)
+        b = Account.objects.get(pk=self.account.pk)
+        a.buy(self.stock, 1, self.price, make_quote())
+        b.buy(self.stock, 2, self.price, make_quote())
+        self.assertEqual(
+            Account.objects.get(pk=self.account.pk).amount,
+            settings.INIT_CACHE - self.price * 3)
+
+    def test_stale_quote(self):
+        with self.assertRaises(StaleQuoteException):
+            self.account.buy(self.stock, 1, self.price, make_quote().as_stale())
+
+    def test_fund_check_uses_db(self):
+        stale = Account.objects.get(pk=self.account.pk)
+        Account.objects.filter(pk=self.account.pk).update(amount=Decimal(10))
+        with self.assertRaises(NotEnoughFundExceptin):
+            stale.buy(self.stock, 1, self.price, make_quote())
+        self.assertFalse(Order.objects.exists())
+
+
+class MetricsTestCase(TestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', buckets=(0.1, 1.0))
+        histogram.observe(0.05, 'index')
+        histogram.observe(0.5, 'index')
+        text = histogram.render()
+        self.assertIn('test_seconds_bucket{view="index",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{view="index",le="1.0"} 2', text)
+        self.assertIn('test_seconds_count{view="index"} 2', text)
+
+    def test_server_timing(self):
+        Account.objects.create(username='test')
+        self.client.post('/login/', {'username': 'test'})
+        response = self.client.get('/')
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('render;dur=', response['Server-Timing'])
+
+        response = self.client.get('/metrics')
+        self.assertIn('portfolio_request_seconds_count{view="portfolio.views.index"}', response.content)
+        self.assertIn('portfolio_quote_cache_total{result="misses"}', response.content)
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        Account.objects.create(username='test')
+        self.client.post('/login/', {'username': 'test'})
+        quote_cache.set('F', make_quote())
+
+    def tearDown(self):
+        quote_cache.clear()
+        account_cache.invalidate('test')
+
+    def test_quote_etag(self):
+        response = self.client.get('/api/v1/quote/F/')
+        self.assertEqual(json.loads(response.content)['ask'], VALID_JSON['ask'])
+        response = self.client.get('/api/v1/quote/F/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_portfolio_etag(self):
+        etag = self.client.get('/api/v1/portfolio/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/v1/portfolio/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.post('/api/v1/buy/', {'symbol': 'F', 'quantity': 2, 'price': VALID_JSON['ask']})
+        self.assertEqual(json.loads(response.content)['version'], 1)
+        response = self.client.get('/api/v1/portfolio/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['positions'][0]['quantity'], 2)
+
+    def test_trade_error(self):
+        response = self.client.post('/api/v1/sell/', {'symbol': 'F', 'quantity': 2, 'price': VALID_JSON['bid']})
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/v1/portfolio/').status_code, 401)
+
+
+class OrderBookTestCase(SimpleTestCase):
+    def test_match(self):
+        book = OrderBook('F')
+        book.add(1, BUY, 10, Decimal('16.00'))
+        book.add(2, BUY, 10, Decimal('17.00'))
+        book.add(3, BUY, 5, Decimal('17.00'))
+        book.add(4, SELL, 5, Decimal('16.60'))
+        book.add(5, SELL, 5, Decimal('16.70'))
+
+        # ask 16.68 x 22 fills both buys at 17 by time, bid 16.67 x 6 one sell
+        fills = book.match(make_quote())
+        self.assertEqual([f[0] for f in fills], [2, 3, 4])
+        self.assertEqual(fills[0][3], Decimal('16.68'))
+        self.assertEqual(fills[2][3], Decimal('16.67'))
+        self.assertEqual(len(book), 2)
+
+    def test_large_order(self):
+        book = OrderBook('F')
+        book.add(1, BUY, 30, Decimal('17.00'))
+        book.add(2, BUY, 1, Decimal('17.00'))
+        # asksize 22 cannot fill the first order, it does not hold up the second one
+        self.assertEqual([f[0] for f in book.match(make_quote())], [2])
+        self.assertEqual(len(book), 1)
+        self.assertEqual([f[0] for f in book.match(make_quote(asksize='30'))], [1])
+
+    def test_many_large_orders(self):
+        book = OrderBook('F')
+        for i in range(100):
+            book.add(i, BUY, 30, Decimal('17.00'))
+        book.add(100, BUY, 1, Decimal('16.90'))
+        # asksize 22, MAX_SKIPPED large orders are parked per quote
+        for i in range(100 // orderbook.MAX_SKIPPED):
+            self.assertEqual(book.match(make_quote()), [])
+        self.assertEqual([f[0] for f in book.match(make_quote())], [100])
+        # parked orders are not scanned again while the size stays below them
+        self.assertEqual(book._buys, [])
+        self.assertEqual(book.match(make_quote()), [])
+        self.assertEqual(len(book), 100)
+        self.assertEqual([f[0] for f in book.match(make_quote(asksize='60'))], [0, 1])
+        self.assertEqual(len(book), 98)
+
+
+class LimitOrderTestCase(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(username='test')
+        self.stock = Stock.get_stock_from_quote(make_quote())
+
+    def place(self, type, quantity, limit, account=None):
+        return LimitOrder.objects.create(
+            account=account or self.account, stock=self.stock, type=type,
+            quantity=quantity, limit_price=Decimal(limit))
+
+    def test_fill(self):
+        buy = self.place(BUY, 10, '17.00')
+        cancelled = self.place(BUY, 10, '17.00')
+        rejected = self.place(SELL, 5, '16.00', account=Account.objects.create(username='other'))
+        books = OrderBooks()
+        books.load()
+        cancelled.cancel()
+
+        # the other account has nothing to sell
+        self.assertEqual(books.on_quotes({'F': make_quote()}), 1)
+        statuses = dict(LimitOrder.objects.values_list('id', 'status'))
+        self.assertEqual(statuses, {buy.id: FILLED, cancelled.id: CANCELLED, rejected.id: REJECTED})
+        self.assertEqual(Position.quantity_of(self.account, self.stock), 10)
+        self.assertEqual(LimitOrder.objects.get(pk=buy.pk).fill_price, Decimal('16.68'))
+
+        # stale quotes never fill
+        self.place(BUY, 1, '17.00')
+        books.sync()
+        self.assertEqual(books.on_quotes({'F': make_quote().as_stale()}), 0)
+        self.assertEqual(books.symbols(), ['F'])
+
+    def test_fill_invalidates_cache(self):
+        order = self.place(BUY, 10, '17.00')
+        cached = Account.get_cached('test')
+        fields = dict((name, getattr(cached, name)) for name in Account.CACHED_FIELDS)
+        buy = Account.buy
+
+        def buy_and_cache(account, *args, **kwargs):
+            buy(account, *args, **kwargs)
+            # a request before the fill commits caches the old balance
+            account_cache.cache.set(account_cache.prefix + account.username, fields)
+
+        Account.buy = buy_and_cache
+        try:
+            self.assertTrue(fill(order.pk, Decimal('16.68'), make_quote()))
+        finally:
+            Account.buy = buy
+        amount = Account.get_cached('test').amount
+        account_cache.invalidate('test')
+        self.assertEqual(amount, settings.INIT_CACHE - 10 * Decimal('16.68'))
+
+
+class TickStoreTestCase(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = TickStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_ohlc(self):
+        for t, price in ((60, '10'), (90, '12'), (119, '9'), (120, '11'), (400, '13')):
+            self.store.append(make_quote(fetched_at=t, price=price))
+        self.store.append(make_quote(EMPTY_JSON, fetched_at=500))
+
+        self.assertEqual(list(self.store.ticks('f', 90, 400)['price']), [12, 9, 11])
+        self.assertEqual(self.store.ticks('F')[0]['volume'], int(VALID_JSON['volume']))
+
+        bars = self.store.ohlc('F', '1m', 0, 600)
+        self.assertEqual(list(bars['time']), [60, 120, 360])
+        self.assertEqual(tuple(bars[0])[1:5], (10, 12, 9, 9))
+        self.assertEqual(list(bars['ticks']), [3, 1, 1])
+        self.assertEqual(len(self.store.ohlc('F', '5m', end=300)), 1)
+        self.assertEqual(len(self.store.ohlc('AAPL', '1d')), 0)
+
+        # a bucket split between chunks is one bar
+        chunk_size, ticks.CHUNK_SIZE = ticks.CHUNK_SIZE, 2
+        try:
+            self.assertEqual(list(self.store.ohlc('F', '1m', 0, 600)), list(bars))
+        finally:
+            ticks.CHUNK_SIZE = chunk_size
+
+        # no range is the last MAX_BARS bars, longer ranges are refused
+        self.assertEqual(len(self.store.ohlc('F', '1m')), 0)
+        with self.assertRaises(ValueError):
+            self.store.ohlc('F', '1m', 0, 60 * ticks.MAX_BARS + 1)
+
+    def test_torn_record(self):
+        self.store.append(make_quote(fetched_at=1))
+        with open(self.store.path('F'), 'ab') as f:
+            f.write('\0' * 5)
+        self.assertEqual(len(self.store.ticks('F')), 1)
+        self.store.append(make_quote(fetched_at=2))
+        self.assertEqual(list(self.store.ticks('F')['time']), [1, 2])
+        with self.assertRaises(ValueError):
+            self.store.path('../F')
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(ORDER_ARCHIVE_DIR=self.root)
+        self.settings.enable()
+        self.account = Account.objects.create(username='test')
+        self.stock = Stock.get_stock_from_quote(make_quote())
+        for quantity in (3, 2):
+            self.account.buy(self.stock, quantity, Decimal('16.68'), make_quote())
+        self.account.sell(self.stock, 4, Decimal('16.67'), make_quote())
+        self.account.buy(self.stock, 1, Decimal('16.68'), make_quote())
+        # the first three orders are 100 days old
+        old = timezone.now() - timedelta(days=100)
+        for i, order in enumerate(Order.objects.order_by('id')[:3]):
+            Order.objects.filter(pk=order.pk).update(created_at=old + timedelta(minutes=i))
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def test_archive(self):
+        realized = summarize(self.account, {'F': make_quote()})['realized']
+        self.assertEqual(archive_orders(days=90, batch_size=2), 3)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(verify(self.account), [])
+        # replays read the archive
+        first = timezone.now() - timedelta(days=100)
+        self.assertEqual(replay(self.account, until=first).amount, settings.INIT_CACHE - 3 * Decimal('16.68'))
+        self.assertEqual(replay(self.account, until=first + timedelta(minutes=2)).lot_list(),
+                         [(self.stock.pk, 1, Decimal('16.68'))])
+        self.assertEqual(summarize(self.account, {'F': make_quote()})['realized'], realized)
+        self.assertEqual(ArchivedOrderTotal.objects.get().sold, 4 * Decimal('16.67'))
+
+        # live and archived orders page and export as one history
+        orders, cursor = page(filter_orders(self.account), size=2,
+                              archived=lambda before: archived_orders(self.account, before=before))
+        self.assertEqual([o.quantity for o in orders], [1, 4])
+        orders, cursor = page(filter_orders(self.account), cursor, size=2,
+                              archived=lambda before: archived_orders(self.account, before=before))
+        self.assertEqual([o.quantity for o in orders], [2, 3])
+        self.assertIsNone(cursor)
+        rows = export_rows(filter_orders(self.account), archived=archived_orders(self.account, type=SELL))
+        self.assertEqual([row[4] for row in rows], [1, 4])
+
+    def test_no_archive_dir(self):
+        with override_settings(ORDER_ARCHIVE_DIR=None):
+            with self.assertRaises(CommandError):
+                call_command('archive_orders', days=90)
+        self.assertEqual(Order.objects.count(), 4)
+
+    def test_reset(self):
+        archive_orders(days=90)
+        self.client.post('/login/', {'username': 'test'})
+        self.client.get('/reset/')
+        account_cache.invalidate('test')
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(list(archived_orders(self.account)), [])
+        self.assertFalse(ArchivedOrderTotal.objects.exists())
+
+
+class OrderQueueTestCase(TestCase):
+    def setUp(self):
+        self.account = Account.objects.create(username='test')
+        quote_cache.set('F', make_quote())
+
+    def tearDown(self):
+        quote_cache.clear()
+        account_cache.invalidate('test')
+
+    def test_execute(self):
+        bought = enqueue(self.account, BUY, 'f', 2, Decimal('16.68'))
+        changed = enqueue(self.account, BUY, 'F', 2, Decimal('16.00'))
+        sold = enqueue(self.account, SELL, 'F', 3, Decimal('16.67'))
+
+        orders = claim('a')
+        self.assertEqual(claim('b'), [])
+        self.assertEqual(execute(orders, 'a'), 1)
+        statuses = dict(QueuedOrder.objects.values_list('id', 'status'))
+        self.assertEqual(statuses, {bought.id: EXECUTED, changed.id: FAILED, sold.id: FAILED})
+        self.assertEqual(QueuedOrder.objects.get(pk=sold.pk).error, 'You do not have enough stocks')
+        self.assertEqual(Position.quantity_of(self.account, Stock.objects.get(symbol='F')), 2)
+
+    def test_database_error(self):
+        broken = enqueue(self.account, BUY, 'F', 7, Decimal('16.68'))
+        bought = enqueue(self.account, BUY, 'F', 2, Decimal('16.68'))
+        buy = Account.buy
+
+        def failing_buy(account, stock, quantity, price, quote=None):
+            if quantity == 7:
+                raise IntegrityError('broken')
+            return buy(account, stock, quantity, price, quote)
+
+        Account.buy = failing_buy
+        try:
+            self.assertEqual(execute(claim('a'), 'a'), 1)
+        finally:
+            Account.buy = buy
+        self.assertEqual(QueuedOrder.objects.get(pk=broken.pk).status, FAILED)
+        self.assertEqual(QueuedOrder.objects.get(pk=bought.pk).status, EXECUTED)
+
+    def test_reset(self):
+        enqueue(self.account, BUY, 'F', 2, Decimal('16.68'))
+        self.client.post('/login/', {'username': 'test'})
+        self.client.get('/reset/')
+        self.assertEqual(execute(claim('a'), 'a'), 0)
+        self.assertEqual(QueuedOrder.objects.get().status, FAILED)
+
+    def test_expired_claim(self):
+        enqueue(self.account, BUY, 'F', 2, Decimal('16.68'))
+        orders = claim('a')
+        QueuedOrder.objects.update(claimed_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(len(claim('b')), 1)
+        # the first worker lost its claim and must not execute
+        self.assertEqual(execute(orders, 'a'), 0)
+        self.assertEqual(QueuedOrder.objects.get().status, RUNNING)
+        self.assertEqual(Order.objects.count(), 0)
+
+    @override_settings(ASYNC_ORDERS=True)
+    def test_api(self):
+        self.client.post('/login/', {'username': 'test'})
+        response = self.client.post('/api/v1/buy/', {'symbol': 'F', 'quantity': 2, 'price': VALID_JSON['ask']})
+        self.assertEqual(response.status_code, 202)
+        content = json.loads(self.client.get(json.loads(response.content)['poll']).content)
+        self.assertEqual(content['order']['status'], 'pending')
+        self.assertEqual(Order.objects.count(), 0)
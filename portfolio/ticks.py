@@ -0,0 +1,207 @@
+"""
+Quote history, one append-only binary file per symbol
+
+Every quote fetched from Benzinga is appended to <TICK_STORE_DIR>/<SYMBOL>.ticks
+as a fixed size TICK_DTYPE record, there is no header and no index. Records
+are read through a read-only numpy memmap, so a range query binary searches
+the time column and only touches the pages of the records it returns.
+
+Appends are one O_APPEND write of a whole record, so processes can share
+a file. Records are in append order, which is time order give or take
+the few milliseconds two processes may race by. A record cut short by a
+crash is ignored by reads and cut off by the next append.
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TICK_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('price', '<f8'),
+    ('bid', '<f8'),
+    ('ask', '<f8'),
+    ('bidsize', '<i4'),
+    ('asksize', '<i4'),
+    # Benzinga's volume of the day so far
+    ('volume', '<i8'),
+])
+INTERVALS = {'1m': 60, '5m': 300, '1d': 86400}
+# bars in one ohlc query, a day of 1m bars
+MAX_BARS = 1440
+# records aggregated at a time
+CHUNK_SIZE = 1 << 18
+
+SYMBOL_RE = re.compile(r'^[A-Z]+$')
+
+
+def _float(value):
+    return float(value) if value is not None else np.nan
+
+
+class TickStore(object):
+    def __init__(self, root):
+        self.root = root
+        self._created = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(getattr(settings, 'TICK_STORE_DIR', None))
+
+    def path(self, symbol):
+        symbol = symbol.upper()
+        # symbols come from URLs, never let one out of root
+        if not SYMBOL_RE.match(symbol):
+            raise ValueError('Invalid symbol {0!r}'.format(symbol))
+        return os.path.join(self.root, symbol + '.ticks')
+
+    def append(self, quote):
+        """
+        Appends quote to the history of its symbol,
+        quotes with errors are not recorded
+        """
+        if not self.root or quote.error is not None:
+            return
+        record = np.array([(
+            quote.fetched_at, _float(quote.price), _float(quote.bid), _float(quote.ask),
+            quote.bidsize or 0, quote.asksize or 0, quote.volume or 0)], dtype=TICK_DTYPE)
+        if not self._created:
+            with self._lock:
+                if not os.path.isdir(self.root):
+                    os.makedirs(self.root)
+                self._created = True
+        fd = os.open(self.path(quote.symbol), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size % TICK_DTYPE.itemsize:
+                os.ftruncate(fd, size - size % TICK_DTYPE.itemsize)
+            os.write(fd, record.tobytes())
+        finally:
+            os.close(fd)
+
+    def _map(self, symbol):
+        path = self.path(symbol)
+        try:
+            count = os.path.getsize(path) // TICK_DTYPE.itemsize
+        except OSError:
+            count = 0
+        if not count:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        return np.memmap(path, dtype=TICK_DTYPE, mode='r', shape=(count,))
+
+    def _range(self, symbol, start=None, end=None):
+        """
+        Returns (mapped records, first, last) of records with start <= time < end
+        """
+        ticks = self._map(symbol)
+        times = ticks['time']
+        first = np.searchsorted(times, start, side='left') if start is not None else 0
+        last = np.searchsorted(times, end, side='left') if end is not None else len(ticks)
+        return ticks, first, last
+
+    def ticks(self, symbol, start=None, end=None, limit=None):
+        """
+        Returns records of symbol with start <= time < end as a structured
+        array, the first `limit` of them if given, times are unix timestamps
+        """
+        ticks, first, last = self._range(symbol, start, end)
+        if limit is not None:
+            last = min(last, first + limit)
+        # copy out of the map, so the file is not held open by the result
+        return np.array(ticks[first:last])
+
+    def ohlc(self, symbol, interval, start=None, end=None):
+        """
+        Downsamples prices of symbol into buckets of interval, one of INTERVALS,
+        aligned to UTC. end defaults to now and start to MAX_BARS intervals
+        before end, longer ranges raise ValueError. Ticks are read
+        CHUNK_SIZE records at a time.
+
+        Returns a structured array of time (bucket start), open, high, low,
+        close, volume (of the day at the last tick) and ticks
+        """
+        seconds = INTERVALS[interval]
+        end = end if end is not None else time.time()
+        start = start if start is not None else end - seconds * MAX_BARS
+        if end - start > seconds * MAX_BARS:
+            raise ValueError('Ranges of {0} bars at most'.format(MAX_BARS))
+
+        ticks, first, last = self._range(symbol, start, end)
+        bars = np.zeros(0, dtype=OHLC_DTYPE)
+        for i in range(first, last, CHUNK_SIZE):
+            bars = _join(bars, _bars(np.array(ticks[i:min(i + CHUNK_SIZE, last)]), seconds))
+        return bars
+
+    def symbols(self):
+        if not self.root or not os.path.isdir(self.root):
+            return []
+        return sorted(name[:-len('.ticks')] for name in os.listdir(self.root) if name.endswith('.ticks'))
+
+
+def _bars(ticks, seconds):
+    ticks = ticks[~np.isnan(ticks['price'])]
+    if not len(ticks):
+        return np.zeros(0, dtype=OHLC_DTYPE)
+
+    buckets = np.floor(ticks['time'] / seconds) * seconds
+    # ticks are in time order, so each bucket is one run
+    first = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    last = np.r_[first[1:] - 1, len(ticks) - 1]
+    price = ticks['price']
+
+    bars = np.zeros(len(first), dtype=OHLC_DTYPE)
+    bars['time'] = buckets[first]
+    bars['open'] = price[first]
+    bars['high'] = np.maximum.reduceat(price, first)
+    bars['low'] = np.minimum.reduceat(price, first)
+    bars['close'] = price[last]
+    bars['volume'] = ticks['volume'][last]
+    bars['ticks'] = last - first + 1
+    return bars
+
+
+def _join(bars, more):
+    """
+    Appends bars of the next chunk, a bucket split between chunks is merged
+    """
+    if len(bars) and len(more) and bars[-1]['time'] == more[0]['time']:
+        more = more.copy()
+        more[0]['open'] = bars[-1]['open']
+        more[0]['high'] = max(bars[-1]['high'], more[0]['high'])
+        more[0]['low'] = min(bars[-1]['low'], more[0]['low'])
+        more[0]['ticks'] += bars[-1]['ticks']
+        bars = bars[:-1]
+    return np.concatenate([bars, more])
+
+
+OHLC_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<i8'),
+    ('ticks', '<i8'),
+])
+
+
+def record(quote):
+    """
+    Appends quote to tick_store, history is best effort,
+    a full disk must not fail the lookup
+    """
+    try:
+        tick_store.append(quote)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning('Cannot record tick of %s: %s', quote.symbol, e)
+
+
+tick_store = TickStore.from_settings()
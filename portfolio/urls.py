@@ -11,7 +11,27 @@ urlpatterns = patterns('portfolio.views',
     url(r'^login/$', 'login'),
     url(r'^logout/$', 'logout'),
     url(r'^reset/$', 'reset'),
+    url(r'^basket/$', 'basket'),
+    url(r'^history/$', 'history'),
+    url(r'^autocomplete/$', 'autocomplete'),
+    url(r'^stream/$', 'stream'),
+    url(r'^stream/poll/$', 'stream_poll'),
+    url(r'^analytics/$', 'analytics'),
+    url(r'^leaderboard/$', 'leaderboard'),
+    url(r'^limit/$', 'limit_orders'),
+    url(r'^limit/(?P<order_id>\d+)/cancel/$', 'cancel_limit_order'),
+    url(r'^metrics$', 'metrics'),
+    url(r'^history/export/$', 'history_export'),
 
     url(r'^buy/' + STOCK_PATTERN + QUANTITY_PATTERN + PRICE_PATTERN + '$', 'buy'),
     url(r'^sell/' + STOCK_PATTERN + QUANTITY_PATTERN + PRICE_PATTERN + '$', 'sell'),
 )
+
+urlpatterns += patterns('portfolio.api',
+    url(r'^api/v1/quote/' + STOCK_PATTERN + '$', 'quote'),
+    url(r'^api/v1/ticks/' + STOCK_PATTERN + '$', 'ticks'),
+    url(r'^api/v1/portfolio/$', 'portfolio'),
+    url(r'^api/v1/buy/$', 'buy'),
+    url(r'^api/v1/sell/$', 'sell'),
+    url(r'^api/v1/orders/(?P<order_id>\d+)/$', 'order'),
+)
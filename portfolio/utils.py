@@ -1,8 +1,285 @@
+import random
+import threading
+import time
+from collections import deque
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from django.conf import settings
+
+from .cache import quote_cache
+from .quotes import Quote
+from .ticks import record as record_tick
+from .exceptions import CircuitOpenException
+from . import metrics
+
+BENZINGA_API_URL = getattr(settings, 'BENZINGA_API_URL', 'http://data.benzinga.com/stock/')
+
+
+class RetryBudget(object):
+    """
+    Every request deposits `ratio` token and every retry withdraws one,
+    so retries can never be more than `ratio` of all requests
+    (plus a small reserve), even when Benzinga is down
+    """
+
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling Benzinga when `failure_rate` of the last `window` calls
+    failed or took longer than `slow_call` seconds, so workers fail fast
+    instead of piling up behind a dead upstream
+
+    closed -> open when the failure rate is reached
+    open -> half open after `reset_timeout` seconds, one probe call goes through
+    half open -> closed if the probe succeeds, open again if it fails
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window=20, min_calls=5, failure_rate=0.5, slow_call=2.0, reset_timeout=10.0):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened = 0
+        self.rejected = 0
+        self._results = deque(maxlen=window)
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, ok, seconds):
+        failed = not ok or seconds >= self.slow_call
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+                return
+            if self.state == self.OPEN:
+                return
+            self._results.append(failed)
+            if len(self._results) >= self.min_calls and \
+                    sum(self._results) >= self.failure_rate * len(self._results):
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened += 1
+        self._opened_at = time.time()
+        self._results.clear()
+
+
+class BenzingaClient(object):
+    """
+    Keeps one requests.Session per process,
+    so connections to Benzinga are pooled and kept alive
+    """
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(self, base_url=BENZINGA_API_URL, pool_size=10,
+                 connect_timeout=1.0, read_timeout=3.0,
+                 retries=2, backoff=0.1, retry_budget=None, breaker=None):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+        })
+        # we only talk to one host, one pool with pool_size connections is enough
+        # retries are done by ourselves, with backoff and budget
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            base_url=BENZINGA_API_URL,
+            pool_size=getattr(settings, 'BENZINGA_POOL_SIZE', 10),
+            connect_timeout=getattr(settings, 'BENZINGA_CONNECT_TIMEOUT', 1.0),
+            read_timeout=getattr(settings, 'BENZINGA_READ_TIMEOUT', 3.0),
+            retries=getattr(settings, 'BENZINGA_RETRIES', 2),
+            backoff=getattr(settings, 'BENZINGA_RETRY_BACKOFF', 0.1),
+            retry_budget=RetryBudget(getattr(settings, 'BENZINGA_RETRY_BUDGET', 0.2)),
+            breaker=CircuitBreaker(
+                window=getattr(settings, 'BENZINGA_BREAKER_WINDOW', 20),
+                min_calls=getattr(settings, 'BENZINGA_BREAKER_MIN_CALLS', 5),
+                failure_rate=getattr(settings, 'BENZINGA_BREAKER_FAILURE_RATE', 0.5),
+                slow_call=getattr(settings, 'BENZINGA_BREAKER_SLOW_CALL', 2.0),
+                reset_timeout=getattr(settings, 'BENZINGA_BREAKER_RESET_TIMEOUT', 10.0)))
+
+    def get(self, symbol):
+        """
+        Returns Quote of symbol
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenException('Benzinga is unavailable, try again later')
+        start = time.time()
+        try:
+            json = self._get(symbol)
+        except Exception:
+            self.breaker.record(False, time.time() - start)
+            raise
+        self.breaker.record(True, time.time() - start)
+        return Quote.from_json(json)
+
+    def _get(self, symbol):
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                r = self.session.get(self.base_url + symbol, timeout=self.timeout)
+                if r.status_code in self.RETRY_STATUS:
+                    r.raise_for_status()
+                return r.json()
+            except (ConnectionError, Timeout, requests.HTTPError):
+                if attempt >= self.retries or not self.retry_budget.withdraw():
+                    raise
+            attempt += 1
+            # full jitter, so retries from all workers do not come back at once
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+
+client = BenzingaClient.from_settings()
+
+
+def fetch(symbol):
+    """
+    Calls Benzinga API directly, bypasses quote cache,
+    and records the quote into tick history
+    """
+    with metrics.timer('upstream'):
+        quote = client.get(symbol)
+    record_tick(quote)
+    return quote
+
+
+def lookup(symbol, fields=None):
+    """
+    Returns Quote of symbol from quote cache
+
+    fields are the keys caller is going to read,
+    an entry is used as long as all of them are still fresh
+    """
+    return quote_cache.get(symbol, fetch, fields)
+
+
+def display_lookup(symbol, fields=None):
+    """
+    Like lookup, but returns the last known quote, marked as stale,
+    when Benzinga cannot be reached
+    Only for showing quotes, never trade on its result
+    """
+    try:
+        return lookup(symbol, fields)
+    except (ConnectionError, Timeout, requests.HTTPError):
+        quote = quote_cache.get_stale(symbol)
+        if quote is None:
+            raise
+        return quote
+
+
+def refresh(symbol, fields=None):
+    """
+    Fetches symbol from Benzinga and stores it in quote cache
+    """
+    quote = fetch(symbol)
+    quote_cache.set(symbol, quote)
+    return quote
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    # created lazily, so every gunicorn worker gets its own threads after fork
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, 'BENZINGA_CONCURRENCY', 10))
+        return _pool
+
+
+def lookup_many(symbols, fields=None, deadline=None, func=lookup):
+    """
+    Looks up several symbols concurrently, with func(symbol, fields)
+
+    Returns (quotes, errors), both are dicts keyed by upper case symbol.
+    Symbols not answered within deadline seconds are reported as Timeout errors.
+    """
+    if deadline is None:
+        deadline = getattr(settings, 'BENZINGA_BATCH_DEADLINE', 5.0)
+
+    pending = {}
+    for symbol in symbols:
+        key = symbol.upper()
+        if key not in pending:
+            pending[key] = _get_pool().apply_async(metrics.bind(func), (symbol, fields))
 
-BENZINGA_API_URL = 'http://data.benzinga.com/stock/'
+    quotes, errors = {}, {}
+    end = time.time() + deadline
+    for key, result in pending.items():
+        try:
+            quotes[key] = result.get(max(0, end - time.time()))
+        except TimeoutError:
+            # the call keeps running in the pool and fills quote cache later
+            errors[key] = Timeout('Deadline exceeded')
+        except Exception as e:
+            errors[key] = e
+    return quotes, errors
 
 
-def lookup(symbol):
-    r = requests.get(BENZINGA_API_URL + symbol)
-    return r.json()
+def refresh_many(symbols, deadline=None):
+    """
+    Like lookup_many, but always fetches from Benzinga and refills quote cache
+    """
+    return lookup_many(symbols, deadline=deadline, func=refresh)
@@ -1,13 +1,36 @@
+import csv
+import datetime
+import json as jsonlib
+import time
 from decimal import Decimal
+from urllib import urlencode
 
-from django.shortcuts import render, redirect
+from requests.exceptions import ConnectionError, Timeout
+
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
 from django.contrib import messages
 from django.conf import settings
+from django.db.models import F
 
-from .utils import lookup as benzinga_lookup
-from .forms import LoginForm
+from .utils import client, lookup, display_lookup, lookup_many
+from .forms import LoginForm, BasketForm, LimitOrderForm, HistoryFilterForm
+from .history import filter_orders, page, export_rows, EXPORT_FIELDS
+from .archive import archived_orders, chunked_delete, delete_archive
+from .orderqueue import enqueue
+from .basket import parse_basket, execute_basket
+from .analytics import summarize
+from .leaderboard import top, rank_of
+from .exceptions import BasketException, CannotFindStockException, EmptySymbolException
+from .symbols import symbol_index, check_symbol
+from .stream import quote_poller, cached_quotes, as_event, STREAM_FIELDS
+from .cache import hot_symbols, quote_cache
+from . import metrics as perf_metrics
 from .decorators import login_required, stock_decorator
-from .models import Stock, HoldingStock, Account, Order
+from .models import (
+    Stock, HoldingStock, Account, Order, Position, LeaderboardEntry, AccountSnapshot, LimitOrder,
+    QueuedOrder, BUY, SELL, OPEN, CANCELLED, PENDING, RUNNING, FAILED)
 
 
 def login(request):
@@ -22,28 +45,49 @@ def login(request):
 
         return redirect('portfolio.views.index')
 
-    return render(request, 'portfolio/login.html', {'form': form})
+    return TemplateResponse(request, 'portfolio/login.html', {'form': form})
 
 
 @login_required
 def index(request):
-    holding_stocks = HoldingStock.objects.filter(account=request.account).order_by('stock__symbol')
+    positions = list(Position.objects.filter(account=request.account)
+                     .select_related('stock').order_by('stock__symbol'))
+
+    # price all positions in one batch, a missing quote just leaves the value empty
+    quotes, errors = lookup_many(
+        set(p.stock.symbol for p in positions), fields=('bid',), func=display_lookup)
+    market_value = Decimal(0)
+    stale = False
+    for p in positions:
+        quote = quotes.get(p.stock.symbol.upper())
+        if quote is not None and quote.bid is not None:
+            p.market_value = quote.bid * p.quantity
+            market_value += p.market_value
+            stale = stale or quote.stale
 
-    context = {'holding_stocks': holding_stocks}
+    context = {
+        'positions': positions,
+        'market_value': market_value,
+        'market_value_stale': stale,
+        'summary': summarize(request.account, quotes),
+    }
+    if settings.ASYNC_ORDERS:
+        context['queued_orders'] = QueuedOrder.objects.filter(account=request.account).order_by('-id')[:5]
 
     if 'symbol' in request.GET:
         symbol = request.GET['symbol']
-        json = benzinga_lookup(symbol)
-        stock = Stock.get_stock_from_json(json)
+        check_symbol(symbol)
+        hot_symbols.touch(symbol)
+        quote = display_lookup(symbol)
+        stock = Stock.get_stock_from_quote(quote)
         context['stock'] = stock
-        context['bid_price'] = json['bid']
-        context['bid_size'] = json['bidsize']
-        context['ask_price'] = json['ask']
-        context['ask_size'] = json['asksize']
+        context['quote'] = quote
+        if quote.stale:
+            context['quote_fetched_at'] = datetime.datetime.fromtimestamp(quote.fetched_at)
     else:
         stock = None
 
-    return render(request, 'portfolio/index.html', context)
+    return TemplateResponse(request, 'portfolio/index.html', context)
 
 
 @login_required
@@ -52,33 +96,361 @@ def logout(request):
     return redirect('portfolio.views.login')
 
 
+def _reload_account(request):
+    # cached account may be stale, basket validation needs the real balance
+    request.account = Account.objects.get(pk=request.account.pk)
+
+
 @login_required
 def reset(request):
-    # delete all Account related data
-    Order.objects.filter(account=request.account).delete()
-    HoldingStock.objects.filter(account=request.account).delete()
-    request.account.amount = settings.INIT_CACHE
-    request.account.save()
+    # delete all Account related data, in chunks so a heavy account does not lock the tables
+    chunked_delete(Order.objects.filter(account=request.account))
+    chunked_delete(HoldingStock.objects.filter(account=request.account))
+    chunked_delete(Position.objects.filter(account=request.account))
+    delete_archive(request.account)
+    AccountSnapshot.objects.filter(account=request.account).delete()
+    LimitOrder.objects.filter(account=request.account, status=OPEN).update(status=CANCELLED)
+    # running ones too, their worker then can not mark them executed and rolls them back
+    QueuedOrder.objects.filter(account=request.account, status__in=(PENDING, RUNNING)).update(
+        status=FAILED, error='Account was reset')
+    Account.objects.filter(pk=request.account.pk).update(
+        amount=settings.INIT_CACHE, version=F('version') + 1)
+    request.account.invalidate_cache()
+    LeaderboardEntry.move(request.account.pk, value=settings.INIT_CACHE)
     return logout(request)
 
 
+def _queue(request, type, symbol, quantity, price):
+    """
+    Queues the order for the process_orders worker, see orderqueue.py
+    """
+    try:
+        check_symbol(symbol)
+    except CannotFindStockException as e:
+        messages.warning(request, str(e))
+        raise
+    quantity = int(quantity)
+    if quantity <= 0:
+        messages.warning(request, 'Only positive quantity number is allowed')
+        return redirect('portfolio.views.index')
+
+    hot_symbols.touch(symbol)
+    enqueue(request.account, type, symbol, quantity, Decimal(price))
+    messages.info(request, 'Queued order to {0} {1} {2} at ${3}'.format(
+        'buy' if type == BUY else 'sell', quantity, symbol.upper(), price))
+    return redirect('portfolio.views.index')
+
+
 @login_required
+def buy(request, symbol, quantity, price):
+    if settings.ASYNC_ORDERS:
+        return _queue(request, BUY, symbol, quantity, price)
+    return _buy(request, symbol=symbol, quantity=quantity, price=price)
+
+
 @stock_decorator
-def buy(request, stock, quantity, price, json):
+def _buy(request, stock, quantity, price, quote):
     quantity = int(quantity)
     price = Decimal(price)
 
-    request.account.buy(stock, quantity, price, json)
+    request.account.buy(stock, quantity, price, quote)
     messages.success(request, 'Successfully buy {0} {1} at ${2}'.format(quantity, stock.symbol, price))
     return redirect('portfolio.views.index')
 
 
 @login_required
+def sell(request, symbol, quantity, price):
+    if settings.ASYNC_ORDERS:
+        return _queue(request, SELL, symbol, quantity, price)
+    return _sell(request, symbol=symbol, quantity=quantity, price=price)
+
+
 @stock_decorator
-def sell(request, stock, quantity, price, json):
+def _sell(request, stock, quantity, price, quote):
     quantity = int(quantity)
     price = Decimal(price)
 
-    request.account.sell(stock, quantity, price, json)
+    request.account.sell(stock, quantity, price, quote)
     messages.success(request, 'Successfully sell {0} {1} at ${2}'.format(quantity, stock.symbol, price))
     return redirect('portfolio.views.index')
+
+
+@login_required
+def analytics(request):
+    """
+    Cost basis, P&L and exposure of the account as json
+    """
+    summary = summarize(request.account)
+    return HttpResponse(jsonlib.dumps(summary), content_type='application/json')
+
+
+@login_required
+def leaderboard(request):
+    return TemplateResponse(request, 'portfolio/leaderboard.html', {
+        'entries': top(),
+        'me': rank_of(request.account),
+    })
+
+
+@login_required
+def basket(request):
+    """
+    Executes many orders at once, all or nothing
+    Accepts BasketForm, or a JSON body like
+        {"orders": [{"type": "buy", "symbol": "F", "quantity": 10, "price": "16.68"}]}
+    """
+    is_json = request.META.get('CONTENT_TYPE', '').startswith('application/json')
+    form = BasketForm(None if is_json else (request.POST or None))
+    errors = []
+
+    if request.method == 'POST' and (is_json or form.is_valid()):
+        try:
+            if is_json:
+                orders = [(o.get('type'), o.get('symbol'), o.get('quantity'), o.get('price'))
+                          for o in jsonlib.loads(request.body)['orders']]
+            else:
+                orders = form.cleaned_data['orders']
+            lines = parse_basket(orders)
+            _reload_account(request)
+            execute_basket(request.account, lines)
+        except BasketException as e:
+            errors = e.errors
+        except (ValueError, KeyError, TypeError, AttributeError):
+            errors = [(None, u'Invalid basket')]
+
+        if is_json:
+            if errors:
+                content = {'ok': False, 'errors': [{'line': i, 'error': msg} for i, msg in errors]}
+            else:
+                content = {'ok': True, 'orders': [line.as_dict() for line in lines]}
+            return HttpResponse(
+                jsonlib.dumps(content), status=400 if errors else 200, content_type='application/json')
+
+        if not errors:
+            messages.success(request, 'Successfully executed {0} orders'.format(len(lines)))
+            return redirect('portfolio.views.index')
+
+    return TemplateResponse(request, 'portfolio/basket.html', {'form': form, 'errors': errors})
+
+
+@login_required
+def limit_orders(request):
+    """
+    Open limit orders of the account, POST places a new one
+    Orders are filled by the refresh_quotes worker, see orderbook.py
+    """
+    form = LimitOrderForm(request.POST or None)
+    if request.method == 'POST' and form.is_valid():
+        data = form.cleaned_data
+        try:
+            check_symbol(data['symbol'])
+            stock = Stock.get_stock_from_quote(lookup(data['symbol']))
+        except (CannotFindStockException, EmptySymbolException) as e:
+            messages.warning(request, str(e))
+        except (ConnectionError, Timeout):
+            messages.error(request, u'Cannot connect to Benzinga.')
+        else:
+            if data['type'] == SELL and Position.quantity_of(request.account, stock) < data['quantity']:
+                messages.warning(request, 'You do not have enough stocks')
+            else:
+                LimitOrder.objects.create(
+                    account=request.account, stock=stock, type=data['type'],
+                    quantity=data['quantity'], limit_price=data['limit_price'])
+                hot_symbols.touch(stock.symbol)
+                messages.success(request, 'Placed limit order for {0} {1} at ${2}'.format(
+                    data['quantity'], stock.symbol, data['limit_price']))
+                return redirect('portfolio.views.limit_orders')
+
+    orders = LimitOrder.objects.filter(account=request.account, status=OPEN).\
+        select_related('stock').order_by('-id')
+    return TemplateResponse(request, 'portfolio/limit_orders.html', {'form': form, 'orders': orders})
+
+
+@login_required
+def cancel_limit_order(request, order_id):
+    if request.method != 'POST':
+        return HttpResponseBadRequest('POST only')
+    if LimitOrder.objects.filter(pk=order_id, account=request.account, status=OPEN).update(status=CANCELLED):
+        messages.success(request, 'Cancelled limit order')
+    else:
+        messages.warning(request, 'Limit order is not open anymore')
+    return redirect('portfolio.views.limit_orders')
+
+
+def _order_dict(order):
+    return {
+        'id': order.id,
+        'created_at': order.created_at.isoformat(),
+        'symbol': order.stock.symbol,
+        'type': order.type,
+        'quantity': order.quantity,
+        'price': str(order.price),
+    }
+
+
+@login_required
+def history(request):
+    """
+    Order history, newest first, ?format=json for API
+    """
+    form = HistoryFilterForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest('Invalid filter')
+
+    filters = dict(form.cleaned_data)
+    cursor = filters.pop('cursor')
+    orders, next_cursor = page(
+        filter_orders(request.account, **filters), cursor,
+        archived=lambda before: archived_orders(request.account, before=before, **filters))
+
+    if request.GET.get('format') == 'json':
+        content = {'orders': [_order_dict(o) for o in orders], 'next': next_cursor}
+        return HttpResponse(jsonlib.dumps(content), content_type='application/json')
+
+    next_url = None
+    if next_cursor:
+        query = request.GET.copy()
+        query['cursor'] = next_cursor
+        next_url = '?' + query.urlencode()
+
+    return TemplateResponse(request, 'portfolio/history.html', {
+        'form': form,
+        'orders': orders,
+        'next_url': next_url,
+        'export_query': urlencode(dict((k, v) for k, v in request.GET.items() if k != 'cursor')),
+    })
+
+
+class _Echo(object):
+    """
+    csv.writer writes into it, and we get the written line back
+    """
+    def write(self, value):
+        return value
+
+
+@login_required
+def history_export(request):
+    """
+    Streams the whole filtered history as csv or ndjson (?format=ndjson)
+    """
+    form = HistoryFilterForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest('Invalid filter')
+
+    filters = dict(form.cleaned_data)
+    filters.pop('cursor')
+    rows = export_rows(filter_orders(request.account, **filters),
+                       archived=archived_orders(request.account, **filters))
+
+    if request.GET.get('format') == 'ndjson':
+        names = [name.replace('stock__', '') for name in EXPORT_FIELDS]
+        lines = (jsonlib.dumps(dict(zip(names, row)), default=str) + '\n' for row in rows)
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="orders.ndjson"'
+    else:
+        writer = csv.writer(_Echo())
+        header = [name.replace('stock__', '') for name in EXPORT_FIELDS]
+        lines = (writer.writerow(row) for row in _prepend(header, rows))
+        response = StreamingHttpResponse(lines, content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="orders.csv"'
+    return response
+
+
+def _prepend(first, rows):
+    yield first
+    for row in rows:
+        yield row
+
+
+@login_required
+def autocomplete(request):
+    """
+    Returns [{"symbol": ..., "name": ...}] of symbols or names starting with ?q=
+    """
+    matches = symbol_index().complete(request.GET.get('q', ''))
+    content = [{'symbol': symbol, 'name': name} for symbol, name in matches]
+    return HttpResponse(jsonlib.dumps(content), content_type='application/json')
+
+
+def _stream_symbols(request):
+    """
+    Symbols the account holds and ?symbols=F,GM it watches
+    """
+    symbols = set(Position.objects.filter(account=request.account).values_list('stock__symbol', flat=True))
+    watched = [s for s in request.GET.get('symbols', '').upper().split(',') if s.isalpha()]
+    symbols.update(watched[:settings.QUOTE_STREAM_MAX_SYMBOLS])
+    return symbols
+
+
+@login_required
+def stream(request):
+    """
+    Server-Sent Events of quote changes of _stream_symbols
+    204 when this process streams QUOTE_STREAM_MAX_CONNECTIONS already,
+    browsers do not reconnect then and poll stream_poll instead
+    """
+    subscription = quote_poller.subscribe(_stream_symbols(request))
+    if subscription is None:
+        return HttpResponse(status=204)
+
+    response = StreamingHttpResponse(_QuoteEvents(subscription), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # tell nginx not to buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def stream_poll(request):
+    """
+    Cached quotes of _stream_symbols as json, for clients which did not get a stream
+    """
+    quotes, errors = cached_quotes(_stream_symbols(request), fields=STREAM_FIELDS)
+    content = [as_event(symbol, quote) for symbol, quote in sorted(quotes.items()) if quote.error is None]
+    response = HttpResponse(jsonlib.dumps(content), content_type='application/json')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+class _QuoteEvents(object):
+    """
+    Events of a subscription, the response closes it even if
+    the client left before the first event
+    """
+
+    def __init__(self, subscription):
+        self.subscription = subscription
+        self.closed = False
+
+    def __iter__(self):
+        # the browser reconnects after the stream ends,
+        # so one client can not hold a worker forever
+        end = time.time() + settings.QUOTE_STREAM_MAX_AGE
+        yield 'retry: 3000\n\n'
+        while time.time() < end and not self.closed:
+            quotes = self.subscription.wait(settings.QUOTE_STREAM_HEARTBEAT)
+            if not quotes:
+                yield ': keepalive\n\n'
+            for quote in quotes.values():
+                yield 'event: quote\ndata: {0}\n\n'.format(jsonlib.dumps(quote))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            quote_poller.unsubscribe(self.subscription)
+
+
+def metrics(request):
+    """
+    Prometheus metrics of this process
+    """
+    counters = {
+        'portfolio_quote_cache_total': dict(
+            ('result="{0}"'.format(name), value) for name, value in quote_cache.stats().items()),
+        'portfolio_upstream_circuit_total': {
+            'event="opened"': client.breaker.opened,
+            'event="rejected"': client.breaker.rejected,
+        },
+    }
+    return HttpResponse(perf_metrics.render(counters), content_type='text/plain; version=0.0.4')
@@ -4,6 +4,61 @@ $(function() {
     window.location = window.location.origin + '?symbol=' + $('#input-symbol').val();
   });
 
+  $('#input-symbol').keyup(function(){
+    var q = $(this).val();
+    if (!q) {
+      return;
+    }
+    $.getJSON('/autocomplete/', {q: q}, function(stocks) {
+      var options = $.map(stocks, function(stock) {
+        return $('<option>').val(stock.symbol).text(stock.name);
+      });
+      $('#symbols').empty().append(options);
+    });
+  });
+
+  // live quotes of the viewed stock and positions
+  var showQuote = function(quote) {
+    if (quote.symbol === $('#symbol').html()) {
+      $('#bid-price').html(parseFloat(quote.bid).toFixed(2));
+      $('#bid-size').html(quote.bidsize);
+      $('#ask-price').html(parseFloat(quote.ask).toFixed(2));
+      $('#ask-size').html(quote.asksize);
+      // the worker did not refresh it in time, show it as delayed
+      $('#bid-price, #ask-price').toggleClass('stale', quote.stale);
+    }
+    $('tr.position[data-symbol="' + quote.symbol + '"]').each(function() {
+      var value = parseFloat(quote.bid) * $(this).data('quantity');
+      $(this).find('.market-value').html(value.toFixed(2));
+    });
+  };
+  var query = '?symbols=' + ($('#symbol').html() || '');
+
+  // when the server has no stream left for us, ask every few seconds instead
+  var poll = function() {
+    $.getJSON('/stream/poll/' + query, function(quotes) {
+      $.each(quotes, function(i, quote) { showQuote(quote); });
+    });
+    setTimeout(poll, 2000);
+  };
+
+  if ($('#symbol').length || $('tr.position').length) {
+    if (window.EventSource) {
+      var source = new EventSource('/stream/' + query);
+      source.addEventListener('quote', function(e) {
+        showQuote(JSON.parse(e.data));
+      });
+      source.onerror = function() {
+        // closed, not reconnecting, means 204
+        if (source.readyState === EventSource.CLOSED) {
+          poll();
+        }
+      };
+    } else {
+      poll();
+    }
+  }
+
   $('#btn-buy').click(function(){
     window.location = '/buy/' +
                       $('#symbol').html() + '/' +